@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Replays a stream of robot packets through RobotConnection.new_data, and
+# measures the time per packet. The stream can be a packet trace recorded by
+# the server (see CONGA_PACKET_TRACE in the README; only the packets sent
+# by the robots are used) or, by default, a synthetic one.
+#
+# Then it fuzzes the parser with mutated packets split in random segments,
+# checking that the dispatch table classifies the packets like the original
+# chain of _check_header calls, and that the parser neither fails nor hangs.
+#
+# Usage: bench_frame_dispatch.py [TRACE.jsonl] [FUZZ_ITERATIONS]
+
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+trace_file = None
+iterations = 2000
+for argument in sys.argv[1:]:
+    if argument.isdigit():
+        iterations = int(argument)
+    else:
+        trace_file = argument
+# init.py reads the ports from the command line
+del sys.argv[1:]
+# don't mix the simulated robots with the real ones
+os.environ["HOME"] = tempfile.mkdtemp()
+
+from bench_map_decoder import synthetic_map
+from congaModules.robotClasses import RobotConnection, HEADER_STRUCT, get_packet_handler
+from congaModules.robotMessage import PING, IDENTIFICATION, STATUS, ACK, MAP, ERROR, UNKNOWN
+
+KNOWN_HEADERS = [(0x14, 0x00c80100, 0x01, 0x03e7), (None, 0x0010, 0x0001, 0x00), (None, 0x0018, 0x0001, 0x00),
+                 (None, 0x000000fa, 0x0001, 0x00), (None, 0x0014, 0x0001, 0x00), (None, 0x0016, 0x0001, 0x00)]
+KNOWN_KINDS = [PING, IDENTIFICATION, STATUS, ACK, MAP, ERROR]
+
+
+def legacy_classify(header):
+    """ The chain of _check_header calls that was used in new_data """
+    for kind, (value0, value1, value2, value4) in zip(KNOWN_KINDS, KNOWN_HEADERS):
+        if (value0 is not None) and (value0 != header[0]):
+            continue
+        if (value1 != header[1]) or (value2 != header[2]) or (value4 != header[4]):
+            continue
+        return kind
+    return UNKNOWN
+
+
+class NullWriter(object):
+    """ Replaces the socket; just counts the bytes sent """
+
+    def __init__(self):
+        self.sent = 0
+
+    def write(self, data):
+        self.sent += len(data)
+
+    def writelines(self, data):
+        for block in data:
+            self.sent += len(block)
+
+    def close(self):
+        pass
+
+
+def frame(value1, value2, packet_id, value4, payload = b""):
+    if isinstance(payload, str):
+        payload = payload.encode('utf8')
+    return HEADER_STRUCT.pack(20 + len(payload), value1, value2, packet_id, value4) + payload
+
+
+def identification(device_id):
+    value = {"token": "0", "deviceId": device_id, "appKey": "0", "authCode": "0", "deviceIp": "127.0.0.1", "devicePort": "0"}
+    return frame(0x0010, 0x0001, 1, 0x00, json.dumps({"value": value}))
+
+
+def synthetic_stream(count):
+    """ Mostly pings and status packets, with some maps and errors """
+    random.seed(1)
+    map_payload = json.dumps({"value": {"noteCmd": "102", "map": base64.b64encode(synthetic_map(200)).decode('ascii'),
+                                        "track": "AAAAAAAAAAA=", "chargerPos": "100,100"}})
+    packets = [identification("replay")]
+    for n in range(count):
+        choice = random.random()
+        if choice < 0.6:
+            packets.append(frame(0x00c80100, 0x01, n, 0x03e7))
+        elif choice < 0.95:
+            status = {"value": {"noteCmd": "102", "workState": "2", "battery": str(n % 100)}}
+            packets.append(frame(0x0018, 0x0001, n, 0x00, json.dumps(status)))
+        elif choice < 0.98:
+            packets.append(frame(0x0014, 0x0001, n, 0x00, map_payload))
+        else:
+            packets.append(frame(0x0016, 0x0001, n, 0x00, '{"value":{"errorCode":"1"}}'))
+    return packets
+
+
+def recorded_stream(filename):
+    """ Rebuilds the packets sent by the robots from a packet trace """
+    packets = []
+    with open(filename, "r") as trace:
+        for line in trace:
+            record = json.loads(line)
+            if record["direction"] != "in":
+                continue
+            header = [int(value, 16) for value in record["header"]]
+            if "payload" in record:
+                payload = record["payload"].encode('utf8')
+            else:
+                payload = base64.b64decode(record.get("payload_base64", ""))
+            if record.get("truncated", False):
+                continue
+            packets.append(HEADER_STRUCT.pack(20 + len(payload), *header[1:]) + payload)
+    return packets
+
+
+def new_connection(loop):
+    return RobotConnection(loop, None, NullWriter())
+
+
+def replay(loop, packets, segment):
+    connection = new_connection(loop)
+    data = b"".join(packets)
+    start = time.perf_counter()
+    for pos in range(0, len(data), segment):
+        connection.feed_data(data[pos:pos + segment])
+    elapsed = time.perf_counter() - start
+    assert len(connection._data) == 0
+    connection.close()
+    return elapsed
+
+
+def mutate(packet):
+    """ Changes a random part of a packet """
+    header = list(HEADER_STRUCT.unpack_from(packet))
+    payload = packet[20:]
+    choice = random.randrange(6)
+    if choice == 0:
+        # another known header, with the same payload
+        known = random.choice(KNOWN_HEADERS)
+        header[1:3] = known[1:3]
+        header[4] = known[3]
+    elif choice == 1:
+        header[random.randrange(1, 5)] = random.getrandbits(32)
+    elif choice == 2:
+        header[random.choice((1, 2, 4))] ^= 1 << random.randrange(32)
+    elif choice == 3 and len(payload) != 0:
+        # truncated JSON
+        payload = payload[:random.randrange(len(payload))]
+    elif choice == 4:
+        payload = random.randbytes(random.randrange(64))
+    else:
+        # a JSON document that isn't what the handlers expect
+        payload = json.dumps(random.choice([[], 5, "text", {"value": 3}, {"value": {"deviceId": 1}}, {}])).encode('utf8')
+    # wrong lengths are valid too, as long as they are at least 20 (if not, the
+    # framing can't know where the packet ends)
+    length = 20 + len(payload)
+    if random.random() < 0.05:
+        length = 20
+        payload = b""
+    header[0] = length
+    return HEADER_STRUCT.pack(*header) + payload
+
+
+def fuzz(loop, packets, iterations):
+    random.seed(2)
+    checked = 0
+    for n in range(iterations):
+        connection = new_connection(loop)
+        stream = [identification(f"fuzz{n % 4}")]
+        for a in range(random.randrange(1, 20)):
+            packet = random.choice(packets)
+            if random.random() < 0.7:
+                packet = mutate(packet)
+            header = HEADER_STRUCT.unpack_from(packet)
+            assert get_packet_handler(header)[0] == legacy_classify(header), header
+            checked += 1
+            stream.append(packet)
+        data = b"".join(stream)
+        pos = 0
+        while pos < len(data):
+            size = random.randrange(1, 200)
+            connection.feed_data(data[pos:pos + size])
+            pos += size
+        assert len(connection._data) == 0
+        connection.close()
+    return checked
+
+
+def main():
+    # the fuzzer generates lots of warnings
+    logging.getLogger().setLevel(logging.ERROR + 10)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if trace_file is None:
+        packets = synthetic_stream(20000)
+        print(f"Synthetic stream: {len(packets)} packets")
+    else:
+        packets = recorded_stream(trace_file)
+        print(f"Recorded stream {trace_file}: {len(packets)} packets")
+
+    kinds = {}
+    for packet in packets:
+        kind = get_packet_handler(HEADER_STRUCT.unpack_from(packet))[0]
+        kinds[kind] = kinds.get(kind, 0) + 1
+    print("  " + ", ".join(f"{kind}: {count}" for kind, count in sorted(kinds.items())))
+
+    headers = [HEADER_STRUCT.unpack_from(packet) for packet in packets]
+    for name, function in (("chain of checks", legacy_classify), ("dispatch table", get_packet_handler)):
+        start = time.perf_counter()
+        for header in headers:
+            function(header)
+        elapsed = time.perf_counter() - start
+        print(f"  classify with {name}: {elapsed * 1000000 / len(headers):.2f} us/packet")
+
+    for segment in (65536, 1460, 64):
+        elapsed = replay(loop, packets, segment)
+        print(f"  replay in segments of {segment:>5} bytes: {elapsed * 1000000 / len(packets):.1f} us/packet")
+
+    checked = fuzz(loop, packets, iterations)
+    print(f"Fuzzing: {iterations} streams, {checked} packets, no errors")
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Compares the map decoder in congaModules/mapDecoder.py with the original
+# per-pixel decoder, using synthetic maps of several sizes.
+#
+# Usage: bench_map_decoder.py [REPETITIONS]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from congaModules.mapDecoder import decode_map
+
+
+def legacy_decode(mapa, chargerX, chargerY):
+    """ The decoder that was used in Robot._paint_map """
+
+    mapw = mapa[5] * 256 + mapa[6];
+    pixels = []
+    pos = 9
+    repetitions = 0
+
+    minx = chargerX
+    maxx = chargerX
+    miny = chargerY
+    maxy = chargerY
+    index = 0
+    errorCharger = False
+    if ((chargerX == -1) or (chargerY == -1)):
+        errorCharger = True
+
+    while pos < len(mapa):
+        if ((mapa[pos] & 0xc0) == 0xc0):
+            repetitions *= 64
+            repetitions += mapa[pos] & 0x3F
+            pos += 1
+            continue
+        if (repetitions == 0):
+            repetitions = 1
+        value = mapa[pos]
+        pos += 1
+        for a in range(repetitions):
+            mul = 64
+            for b in range(4):
+                v = (int(value/mul)) & 0x03
+                pixels.append(v)
+                mul /= 4
+                if (v == 0):
+                    index += 1
+                    continue
+                x = index % mapw
+                y = int(index / mapw)
+                index += 1
+                if (errorCharger):
+                    minx = x
+                    miny = y
+                    maxx = x
+                    maxy = y
+                    errorCharger = False
+                else:
+                    if (x < minx):
+                        minx = x
+                    if (y < miny):
+                        miny = y
+                    if (x > maxx):
+                        maxx = x
+                    if (y > maxy):
+                        maxy = y
+        repetitions = 0
+    return pixels, (minx, miny, maxx, maxy)
+
+
+def encode_map(pixels, width, height):
+    """ Builds a robot map from a list of 2-bit pixels (len must be a multiple of 4) """
+
+    packed = []
+    for pos in range(0, len(pixels), 4):
+        packed.append((pixels[pos] << 6) | (pixels[pos + 1] << 4) | (pixels[pos + 2] << 2) | pixels[pos + 3])
+    data = bytearray(b"\x00" * 5)
+    data += bytes((width >> 8, width & 0xFF, height >> 8, height & 0xFF))
+    pos = 0
+    while pos < len(packed):
+        value = packed[pos]
+        run = 1
+        while (pos + run < len(packed)) and (packed[pos + run] == value) and (run < 4095):
+            run += 1
+        if run > 1:
+            if run >= 64:
+                data.append(0xC0 | (run >> 6))
+            data.append(0xC0 | (run & 0x3F))
+        data.append(value)
+        pos += run
+    return bytes(data)
+
+
+def synthetic_map(size, seed = 1):
+    """ A square map with a room: walls on the border, floor inside and
+        noisy zones, so there are both long runs and plain bytes """
+
+    rnd = random.Random(seed)
+    pixels = [0] * (size * size)
+    margin = size // 8
+    for y in range(margin, size - margin):
+        for x in range(margin, size - margin):
+            if (y == margin) or (y == size - margin - 1) or (x == margin) or (x == size - margin - 1):
+                value = 1
+            elif (x // 16 + y // 16) % 5 == 0:
+                value = rnd.choice((0, 1, 2, 2))
+            else:
+                value = 2
+            pixels[x + y * size] = value
+    return encode_map(pixels, size, size)
+
+
+def measure(function, data, repetitions):
+    start = time.perf_counter()
+    for a in range(repetitions):
+        function(data)
+    return (time.perf_counter() - start) / repetitions
+
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"{'size':>10} {'rle bytes':>10} {'legacy ms':>10} {'new ms':>10} {'speedup':>8}")
+    for size in (128, 256, 512, 800):
+        data = synthetic_map(size)
+        for charger in ((-1, -1), (size // 2, size // 2)):
+            pixels, bbox = legacy_decode(data, *charger)
+            grid = decode_map(data, *charger)
+            assert bytes(pixels) == bytes(grid.pixels)
+            assert bbox == (grid.minx, grid.miny, grid.maxx, grid.maxy)
+        legacy = measure(lambda d: legacy_decode(d, -1, -1), data, repetitions)
+        new = measure(lambda d: decode_map(d, -1, -1), data, repetitions)
+        print(f"{size:>4}x{size:<5} {len(data):>10} {legacy * 1000:>10.2f} {new * 1000:>10.2f} {legacy / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
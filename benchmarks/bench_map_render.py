@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Compares the map pictures painted by congaModules/mapRenderer.py with the
+# original renderer (one rectangle per cell and one circle per track point),
+# pixel by pixel, and the time taken by both. The new pictures are checked
+# both painted from scratch and updated in a MapCanvas while the track grows.
+#
+# Usage: bench_map_render.py [REPETITIONS]
+
+import base64
+import io
+import os
+import random
+import sys
+import time
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_map_decoder import synthetic_map
+from congaModules.mapDecoder import decode_map
+from congaModules.mapRenderer import MapCanvas, render_map
+
+
+def legacy_circle(ctx, x, y, radius, strokeStyle, fillStyle):
+    ctx.ellipse([x - radius, y - radius, x + radius, y + radius], fill = strokeStyle)
+    radius = int(radius/2)
+    ctx.ellipse([x - radius, y - radius, x + radius, y + radius], fill = fillStyle)
+
+
+def legacy_render(grid, track, chargerX, chargerY, width, height):
+    """ The painting done in Robot._paint_map, from an already decoded map """
+
+    data = Image.new('RGB', (width, height))
+    ctx = ImageDraw.Draw(data)
+    minx, miny, maxx, maxy = grid.minx, grid.miny, grid.maxx, grid.maxy
+    mapw = grid.width
+    pixels = grid.pixels
+    ctx.rectangle([(0, 0), (width, height)], fill='#ffffff')
+    radius1 = width / (maxx - minx + 1)
+    radius2 = height / (maxy - miny + 1)
+    if (radius2 < radius1):
+        radius1 = radius2
+    radius2 = radius1 / 2
+    radius3 = int(radius1 * 0.8)
+
+    for y in range(miny, maxy+1):
+        for x in range(minx, maxx+1):
+            pos = x + mapw * y
+            if (pixels[pos] == 0):
+                continue
+            if pixels[pos] == 1:
+                fillStyle = '#000000'
+            elif pixels[pos] == 2:
+                fillStyle = '#ffff00'
+            nx = (x - minx) * radius1
+            ny = (y - miny) * radius1
+            ctx.rectangle([(nx, ny), (nx + radius1, ny + radius1)], fill=fillStyle)
+    strokeStyle = '#00ffff'
+    points = []
+    isx = True
+    for a in track:
+        if isx:
+            x = int((a - minx) * radius1 + radius2)
+            points.append(x)
+            isx = False
+        else:
+            y = int((a - miny) * radius1 + radius2)
+            points.append(y)
+            isx = True
+            ctx.ellipse([x - radius3, y - radius3, x + radius3, y + radius3], fill=strokeStyle)
+    ctx.line(points, fill=strokeStyle, width=radius3*2)
+    legacy_circle(ctx, x, y, radius2, '#000000', '#ff00ff')
+    x = (chargerX - minx) * radius1 + radius2
+    y = (chargerY - miny) * radius1 + radius2
+    legacy_circle(ctx, x, y, radius2, '#000000', '#00ff00')
+    return data
+
+
+def synthetic_track(size, points, seed = 1):
+    """ A random walk inside the room of synthetic_map, as x,y byte pairs """
+
+    rnd = random.Random(seed)
+    low = size // 8 + 1
+    high = size - size // 8 - 2
+    x = y = size // 2
+    track = bytearray()
+    for n in range(points):
+        x = min(high, max(low, x + rnd.randint(-2, 2)))
+        y = min(high, max(low, y + rnd.randint(-2, 2)))
+        track += bytes((x, y))
+    return bytes(track)
+
+
+def canvas_render(mapa, track, charger, width, height, steps = 5):
+    """ Paints the map in a MapCanvas adding the track in several steps, like
+        when a robot is cleaning, and returns the last picture decoded from the PNG """
+
+    canvas = MapCanvas()
+    mapData = base64.b64encode(mapa).decode('ascii')
+    chargerPos = f"{charger[0]},{charger[1]}"
+    points = len(track) // 2
+    for step in range(1, steps + 1):
+        trackData = base64.b64encode(bytes(4) + track[:2 * (points * step // steps)]).decode('ascii')
+        data = canvas.paint_png_timed(mapData, trackData, chargerPos, width, height)[0]
+    return Image.open(io.BytesIO(data))
+
+
+def measure(function, repetitions):
+    start = time.perf_counter()
+    for a in range(repetitions):
+        function()
+    return (time.perf_counter() - start) / repetitions
+
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"{'cells':>6} {'points':>7} {'picture':>10} {'legacy ms':>10} {'new ms':>10} {'speedup':>8}")
+    for size in (40, 120, 200):
+        mapa = synthetic_map(size)
+        charger = (size // 2, size // 2)
+        grid = decode_map(mapa, *charger)
+        for points in (1, 50, 300):
+            track = synthetic_track(size, points, size + points)
+            for width, height in ((640, 640), (1280, 1280), (300, 500), (97, 61)):
+                legacy = legacy_render(grid, track, *charger, width, height).tobytes()
+                assert render_map(grid, track, *charger, width, height).convert('RGB').tobytes() == legacy
+                assert canvas_render(mapa, track, charger, width, height).convert('RGB').tobytes() == legacy
+            if points != 300:
+                continue
+            for width, height in ((640, 640), (1280, 1280)):
+                legacy = measure(lambda: legacy_render(grid, track, *charger, width, height), repetitions)
+                new = measure(lambda: render_map(grid, track, *charger, width, height), repetitions)
+                print(f"{size:>6} {points:>7} {width:>4}x{height:<5} {legacy * 1000:>10.2f} {new * 1000:>10.2f} {legacy / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
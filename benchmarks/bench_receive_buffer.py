@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Compares the framing of robot packets using the ReceiveBuffer from
+# congaModules/baseServer.py with the original bytes concatenation and
+# slicing. The packets are sent back-to-back and split in small TCP segments.
+#
+# Usage: bench_receive_buffer.py [SEGMENT_SIZE]
+
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from congaModules.baseServer import ReceiveBuffer
+
+HEADER_STRUCT = struct.Struct("<LLLLL")
+
+
+def make_stream(frames, big_every, big_size):
+    """ Builds a stream with small status packets and, every big_every
+        packets, a big one (like a map) """
+    random.seed(1)
+    data = bytearray()
+    sizes = []
+    for n in range(frames):
+        if (big_every != 0) and (n % big_every == big_every - 1):
+            payload = random.randbytes(big_size)
+        else:
+            payload = b'{"version":"1.0","control":{"targetId":"0","targetType":"6"},"value":{"noteCmd":"102"}}'
+        data += HEADER_STRUCT.pack(20 + len(payload), 0x00c800fa, 0x01090000, n, 0)
+        data += payload
+        sizes.append(len(payload))
+    return bytes(data), sizes
+
+
+def split(data, segment):
+    return [data[pos:pos + segment] for pos in range(0, len(data), segment)]
+
+
+def legacy_framing(segments):
+    """ The framing done by BaseConnection.run and RobotConnection.new_data """
+    sizes = []
+    buffer = b""
+    for segment in segments:
+        buffer += segment
+        while len(buffer) >= 20:
+            header = struct.unpack("<LLLLL", buffer[0:20])
+            if len(buffer) < header[0]:
+                break
+            payload = buffer[20:header[0]]
+            buffer = buffer[header[0]:]
+            sizes.append(len(payload))
+    return sizes
+
+
+def buffer_framing(segments):
+    sizes = []
+    buffer = ReceiveBuffer()
+    for segment in segments:
+        buffer.append(segment)
+        while True:
+            frame = buffer.read_frame(HEADER_STRUCT)
+            if frame is None:
+                break
+            header, payload = frame
+            sizes.append(len(payload))
+    return sizes
+
+
+def measure(function, segments, expected, repeat = 5):
+    """ Returns the best time of several runs, to leave out the noise """
+    best = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        result = function(segments)
+        elapsed = time.perf_counter() - start
+        assert result == expected
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best
+
+
+def main():
+    segment = int(sys.argv[1]) if len(sys.argv) > 1 else 1460
+    print(f"segments of {segment} bytes")
+    print(f"{'frames':>8} {'big frame':>10} {'stream KiB':>11} {'legacy ms':>10} {'buffer ms':>10} {'speedup':>8}")
+    for frames, big_every, big_size in ((20000, 0, 0), (20000, 100, 65536), (2000, 10, 262144), (50, 1, 1048576)):
+        data, expected = make_stream(frames, big_every, big_size)
+        segments = split(data, segment)
+        legacy = measure(legacy_framing, segments, expected)
+        new = measure(buffer_framing, segments, expected)
+        print(f"{frames:>8} {big_size:>10} {len(data) // 1024:>11} {legacy * 1000:>10.1f} {new * 1000:>10.1f} {legacy / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Measures the ping round-trip time of a simulated robot while several
+# maps are being rendered in parallel, for each render mode. It fails if,
+# in the thread and process modes, any ping takes longer than MAX_PING_MS
+# (100 by default): that means that the main loop was blocked by a render.
+#
+# Usage: bench_render_latency.py [MAPS_IN_PARALLEL] [MAX_PING_MS]
+
+import asyncio
+import base64
+import json
+import os
+import statistics
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+parallel = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+max_ping = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.1
+# init.py reads the ports from the command line
+del sys.argv[1:]
+
+from bench_map_decoder import synthetic_map
+from congaModules.robotClasses import robot_server
+from congaModules.robotManager import robot_manager
+from congaModules.renderPool import render_pool
+
+PORT = 21008
+DEVICE_ID = "benchmark"
+
+
+def frame(value1, value2, packet_id, value4, payload = b""):
+    if isinstance(payload, str):
+        payload = payload.encode('utf8')
+    return struct.pack("<LLLLL", 20 + len(payload), value1, value2, packet_id, value4) + payload
+
+
+class SimulatedRobot(object):
+    def __init__(self):
+        self._pongs = {}
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection('127.0.0.1', PORT)
+        identification = {"value": {"token": "0", "deviceId": DEVICE_ID, "appKey": "0", "authCode": "0",
+                                    "deviceIp": "127.0.0.1", "devicePort": "0"}}
+        self._writer.write(frame(0x0010, 0x0001, 1, 0x00, json.dumps(identification)))
+        track = bytes(4) + bytes(v for a in range(2000) for v in (20 + a % 200, 20 + (a // 200) * 10))
+        status = {"value": {"noteCmd": "102", "map": base64.b64encode(synthetic_map(250)).decode('ascii'),
+                            "track": base64.b64encode(track).decode('ascii'), "chargerPos": "125,125"}}
+        self._writer.write(frame(0x0014, 0x0001, 2, 0x00, json.dumps(status)))
+        asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        data = b""
+        while True:
+            received = await self._reader.read(65536)
+            if len(received) == 0:
+                return
+            data += received
+            while len(data) >= 20:
+                header = struct.unpack("<LLLLL", data[:20])
+                if len(data) < header[0]:
+                    break
+                data = data[header[0]:]
+                if (header[1] == 0x00c80111) and (header[3] in self._pongs):
+                    self._pongs[header[3]].set_result(time.perf_counter())
+
+    async def ping(self, packet_id):
+        pong = asyncio.get_running_loop().create_future()
+        self._pongs[packet_id] = pong
+        start = time.perf_counter()
+        self._writer.write(frame(0x00c80100, 0x01, packet_id, 0x03e7))
+        end = await pong
+        del self._pongs[packet_id]
+        return end - start
+
+
+async def render_maps(robot, count):
+    start = time.perf_counter()
+    results = []
+    for a in range(count):
+        # different sizes, so every request is a cache miss
+        dtype, error, answer = robot.send_command("getMap", {"width": str(1280 - a), "height": str(1280 - a)})
+        results.append(answer)
+    for answer in results:
+        if not isinstance(answer, bytes):
+            await answer
+    return time.perf_counter() - start
+
+
+async def run_mode(mode, robot, simulated):
+    render_pool.configure(mode, 4)
+    robot._map_changed()
+    render = asyncio.ensure_future(render_maps(robot, parallel))
+    latencies = []
+    packet_id = 1000
+    while not render.done():
+        latencies.append(await simulated.ping(packet_id))
+        packet_id += 1
+        await asyncio.sleep(0.005)
+    elapsed = await render
+    render_pool.close()
+    latencies.sort()
+    print(f"{mode:>8} {elapsed * 1000:>10.1f} {len(latencies):>6} {statistics.median(latencies) * 1000:>10.2f} {latencies[-1] * 1000:>10.2f}")
+    return latencies
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    robot_server.configure(loop, PORT)
+    simulated = SimulatedRobot()
+    loop.run_until_complete(simulated.connect())
+    loop.run_until_complete(asyncio.sleep(0.5))
+    robot = robot_manager.get_robot(DEVICE_ID)
+    print(f"{parallel} maps of 1280x1280 rendered in parallel")
+    print(f"{'mode':>8} {'total ms':>10} {'pings':>6} {'median ms':>10} {'max ms':>10}")
+    slowest = {}
+    for mode in render_pool.MODES:
+        slowest[mode] = loop.run_until_complete(run_mode(mode, robot, simulated))[-1]
+    robot_server.close()
+    for mode, latency in slowest.items():
+        # the inline mode blocks the loop on purpose; it is the reference
+        if mode != "inline":
+            assert latency <= max_ping, f"a ping took {latency * 1000:.1f} ms while rendering in {mode} mode"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Connects N simulated robots to the robot server, using each transport, and
+# measures the memory used per connection, the number of tasks, and the CPU
+# time used by the server to answer rounds of pings and status packets.
+# The robots run in a separate process.
+#
+# Usage: bench_robot_fleet.py [ROBOTS] [ROUNDS]
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+robots = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+# init.py reads the ports from the command line
+del sys.argv[1:]
+# don't mix the simulated robots with the real ones
+os.environ["HOME"] = tempfile.mkdtemp()
+
+from congaModules.robotClasses import robot_server
+
+PORT = 21009
+HEADER = struct.Struct("<LLLLL")
+
+
+def frame(value1, value2, packet_id, value4, payload = b""):
+    if isinstance(payload, str):
+        payload = payload.encode('utf8')
+    return HEADER.pack(20 + len(payload), value1, value2, packet_id, value4) + payload
+
+
+class SimulatedRobot(asyncio.Protocol):
+    """ A robot that counts the answers received """
+
+    def __init__(self, answers):
+        super().__init__()
+        self._answers = answers
+        self._data = b""
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self._data += data
+        while len(self._data) >= 20:
+            length = HEADER.unpack_from(self._data)[0]
+            if len(self._data) < length:
+                break
+            self._data = self._data[length:]
+            self._answers[0] += 1
+
+
+async def run_robots(prefix, connection):
+    loop = asyncio.get_running_loop()
+    answers = [0]
+    clients = []
+    for n in range(robots):
+        transport, client = await loop.create_connection(lambda: SimulatedRobot(answers), '127.0.0.1', PORT)
+        identification = {"value": {"token": "0", "deviceId": f"{prefix}{n}", "appKey": "0", "authCode": "0",
+                                    "deviceIp": "127.0.0.1", "devicePort": "0"}}
+        transport.write(frame(0x0010, 0x0001, 1, 0x00, json.dumps(identification)))
+        clients.append(client)
+    # one answer to the identification
+    await wait_answers(answers, robots)
+    connection.send("connected")
+    connection.recv()
+
+    start = time.perf_counter()
+    for r in range(rounds):
+        answers[0] = 0
+        status = {"value": {"workState": "2", "battery": str(r % 100)}}
+        packet = frame(0x00c80100, 0x01, 2 + r, 0x03e7) + frame(0x0018, 0x0001, 2 + r, 0x00, json.dumps(status))
+        for client in clients:
+            client.transport.write(packet)
+        # a pong and an ACK of the status per robot
+        await wait_answers(answers, 2 * robots)
+    connection.send(time.perf_counter() - start)
+    for client in clients:
+        client.transport.close()
+
+
+async def wait_answers(answers, count):
+    while answers[0] < count:
+        await asyncio.sleep(0.001)
+
+
+def robots_process(prefix, connection):
+    asyncio.run(run_robots(prefix, connection))
+
+
+def run_transport(transport):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    robot_server.configure(loop, PORT, transport = transport)
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.get_context("fork").Process(target = robots_process, args = (transport, child))
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    process.start()
+    loop.run_until_complete(loop.run_in_executor(None, parent.recv))
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    tasks = len(asyncio.all_tasks(loop))
+
+    cpu = time.process_time()
+    parent.send("start")
+    elapsed = loop.run_until_complete(loop.run_in_executor(None, parent.recv))
+    cpu = time.process_time() - cpu
+    process.join()
+    loop.run_until_complete(asyncio.sleep(0.2))
+    robot_server.close()
+    loop.close()
+    packets = 2 * robots * rounds
+    return f"{transport:>9} {memory / robots / 1024:>10.1f} {tasks:>6} {elapsed * 1000:>9.0f} {cpu * 1000000 / packets:>12.1f}"
+
+
+def main():
+    print(f"{robots} robots, {rounds} rounds of ping + status")
+    print(f"{'transport':>9} {'KiB/robot':>10} {'tasks':>6} {'total ms':>9} {'CPU us/pkt':>12}")
+    # the per-packet prints and logs of the server would dominate the results
+    logging.getLogger().setLevel(logging.WARNING)
+    stdout = sys.stdout
+    for transport in robot_server.TRANSPORTS:
+        sys.stdout = open(os.devnull, "w")
+        try:
+            result = run_transport(transport)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        print(result, flush = True)
+
+
+if __name__ == "__main__":
+    main()
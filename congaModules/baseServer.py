@@ -20,15 +20,29 @@ import asyncio
 from .observer import Signal
 
 class BaseServer(object):
+    """ Accepts connections. There are two transports:
+          "stream": each connection gets a StreamReader/StreamWriter pair and
+                    a task that reads from it (_handle)
+          "protocol": the data arrives through an asyncio.Protocol, which
+                      passes it directly to the connection created by
+                      _new_connection, without a reading task per connection """
+
+    TRANSPORTS = ("stream", "protocol")
 
     def __init__(self):
         super().__init__()
         self._loop = None
         self._server = None
 
-    def configure(self, loop, port, address = ''):
+    def configure(self, loop, port, address = '', transport = "stream"):
+        if transport not in self.TRANSPORTS:
+            logging.error(f"Unknown transport {transport}; using 'stream'")
+            transport = "stream"
         self._loop = loop
-        coro = asyncio.start_server(self._handle, address, port)
+        if transport == "protocol":
+            coro = loop.create_server(lambda: ConnectionProtocol(self._new_connection), address, port)
+        else:
+            coro = asyncio.start_server(self._handle, address, port)
         self._server = loop.run_until_complete(coro)
 
     def close(self):
@@ -39,25 +53,167 @@ class BaseServer(object):
     async def _handle(self, reader, writer):
         pass
 
+    def _new_connection(self, transport):
+        """ Must return the connection object for a new transport, when
+            using the "protocol" transport """
+        raise NotImplementedError()
+
+
+class ConnectionProtocol(asyncio.Protocol):
+    """ Passes the events of a transport to a BaseConnection """
+
+    __slots__ = ('_factory', '_connection')
+
+    def __init__(self, factory):
+        super().__init__()
+        self._factory = factory
+        self._connection = None
+
+    def connection_made(self, transport):
+        self._connection = self._factory(transport)
+
+    def data_received(self, data):
+        self._connection.feed_data(data)
+
+    def eof_received(self):
+        # returning False makes the transport close itself, calling connection_lost
+        return False
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            logging.error(f"Read exception {exc}")
+        self._connection.connection_lost()
+
+
+class ReceiveBuffer(object):
+    """ Buffer for the data received from a socket. The consumed frames just
+        advance a read offset, so extracting a message doesn't copy the rest
+        of the buffer.
+
+        When nothing is pending, the received bytes are used as they are, and
+        when only a few bytes are pending (the start of a frame) they are
+        joined with the new ones; small frames are then sliced directly from
+        the received data. Only when a lot of data is pending (a big frame
+        arriving in many pieces) it is accumulated in a bytearray, whose space
+        already read is reclaimed only when it is more than half the buffer.
+
+        All the positions are relative to the read offset """
+
+    # don't bother compacting below this size; pending data smaller than this is copied to join it with the new data
+    COMPACT_SIZE = 4096
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = b""
+        self._start = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._start
+
+    def append(self, data):
+        buffer = self._buffer
+        start = self._start
+        pending = len(buffer) - start
+        if pending == 0:
+            self._buffer = bytes(data)
+            self._start = 0
+        elif pending < self.COMPACT_SIZE:
+            self._buffer = bytes(buffer[start:]) + data
+            self._start = 0
+        elif isinstance(buffer, bytes):
+            self._buffer = bytearray(memoryview(buffer)[start:])
+            self._buffer += data
+            self._start = 0
+        else:
+            if (start >= self.COMPACT_SIZE) and (start * 2 >= len(buffer)):
+                del buffer[:start]
+                self._start = 0
+            buffer += data
+
+    def find(self, sub, start = 0):
+        """ Returns the position of sub, or -1 if it isn't in the buffer """
+        pos = self._buffer.find(sub, self._start + start)
+        if pos == -1:
+            return -1
+        return pos - self._start
+
+    def peek(self, start, end = None):
+        """ Returns a copy of the data between start and end, without consuming it """
+        offset = self._start
+        if end is None:
+            return bytes(self._buffer[offset + start:])
+        return bytes(self._buffer[offset + start:offset + end])
+
+    def unpack_from(self, packer, offset = 0):
+        """ Decodes the data at offset using a struct.Struct, without copying it """
+        return packer.unpack_from(self._buffer, self._start + offset)
+
+    def read_frame(self, packer):
+        """ For protocols where each message starts with a fixed header whose
+            first field is the total length of the message. Returns a tuple
+            with the decoded header and a copy of the payload, consuming
+            them, or None if the message isn't complete yet """
+        buffer = self._buffer
+        start = self._start
+        size = len(buffer)
+        header_size = packer.size
+        if size - start < header_size:
+            return None
+        header = packer.unpack_from(buffer, start)
+        length = header[0]
+        # a length shorter than the header would never be consumed
+        end = start + (length if length > header_size else header_size)
+        if size < end:
+            return None
+        payload = buffer[start + header_size:end]
+        if end == size:
+            self._buffer = b""
+            self._start = 0
+        else:
+            self._start = end
+        if isinstance(payload, bytes):
+            return header, payload
+        return header, bytes(payload)
+
+    def consume(self, size):
+        """ Marks size bytes as already processed """
+        self._start += size
+        if self._start >= len(self._buffer):
+            self._buffer = b""
+            self._start = 0
+
+    def read(self, size):
+        """ Returns the next size bytes and consumes them """
+        data = self.peek(0, size)
+        self.consume(len(data))
+        return data
+
+    def clear(self):
+        self._buffer = b""
+        self._start = 0
+
 
 class BaseConnection(object):
+    """ A connection. The writer can be a StreamWriter or, when using the
+        "protocol" transport, the transport itself (and reader is None) """
+
     def __init__(self, reader, writer):
         self._reader = reader
         self._writer = writer
-        self._data = b""
+        self._data = ReceiveBuffer()
         self._closed = False
         self.closedSignal = Signal("closed", self)
 
     def new_data(self):
-        """ Called every time new data is added to self._data
+        """ Called every time new data is added to self._data (a ReceiveBuffer)
             Overwrite to process arriving data. The function must
-            remove from self._data the data already processed
+            consume from self._data the data already processed
             @return False if there wasn't enough data for a full message; wait for more data
                     True  if a full message was read and it should be called again because
                           there can be another message in the buffer """
 
         # here just remove the read data
-        self._data = b""
+        self._data.clear()
         return False
 
     def close(self):
@@ -68,6 +224,16 @@ class BaseConnection(object):
             self._closed = True
             self.closedSignal.emit()
 
+    def connection_lost(self):
+        """ Called when the other side closes the socket, or on read errors """
+        self.close()
+
+    def feed_data(self, data):
+        """ Adds received data to the buffer and processes it """
+        self._data.append(data)
+        while self.new_data():
+            pass
+
     async def run(self):
         """ Called whenever there is data to be read in the socket.
             Overwrite only to detect when there are new connections """
@@ -77,15 +243,12 @@ class BaseConnection(object):
                 data = await self._reader.read(65536)
             except Exception as e:
                 logging.error(f"Read exception {e}")
-                self.close()
+                self.connection_lost()
                 break
             if len(data) > 0:
-                self._data += data
-                while True:
-                    if not self.new_data():
-                        break
+                self.feed_data(data)
             else:
                 # socket closed
-                self.close()
+                self.connection_lost()
                 break
 
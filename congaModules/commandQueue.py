@@ -0,0 +1,101 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import collections
+
+from .robotCommands import URGENT, NORMAL, SCRIPT, BACKGROUND
+
+# order in which the lanes are served
+LANES = (URGENT, NORMAL, SCRIPT, BACKGROUND)
+
+# value returned to the callers of a command replaced by a newer one
+SUPERSEDED = '{"superseded":true}'
+
+
+class CommandQueue(object):
+    """ The commands waiting to be sent to a robot. There is a FIFO lane for
+        each priority, and the lanes are served in order: urgent commands
+        (stop, return, manual control...) first, then the normal ones, then
+        the scripts (the 'wait' and 'waitState' steps, and every command
+        queued after them while the script runs) and, at last, the map
+        refreshes.
+
+        While a script step is running (script_gate is not None), the script
+        lane is blocked, but the other lanes are still served.
+
+        A command with a coalesce key replaces a queued one with the same key
+        in the same lane, keeping its position, so only the last value of a
+        setting is sent. This is not done in the script lane, since each step
+        of a script must be executed """
+
+    def __init__(self):
+        super().__init__()
+        self._lanes = {lane: collections.deque() for lane in LANES}
+        self._coalesced = {}
+        self.script_gate = None
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def push(self, request):
+        priority = request.priority
+        if (priority == NORMAL) and ((self.script_gate is not None) or (len(self._lanes[SCRIPT]) != 0)):
+            # keeps the order of the commands of the script
+            priority = SCRIPT
+        lane = self._lanes[priority]
+        if (request.coalesce is not None) and (priority != SCRIPT):
+            key = (priority, request.coalesce)
+            old = self._coalesced.get(key)
+            self._coalesced[key] = request
+            if old is not None:
+                lane[lane.index(old)] = request
+                old.finish(0, SUPERSEDED)
+                return
+        lane.append(request)
+
+    def pop(self):
+        """ Returns the next command to run, or None if there are none available """
+        for priority in LANES:
+            if (priority == SCRIPT) and (self.script_gate is not None):
+                continue
+            lane = self._lanes[priority]
+            if len(lane) != 0:
+                request = lane.popleft()
+                if (request.coalesce is not None) and (self._coalesced.get((priority, request.coalesce)) is request):
+                    del self._coalesced[(priority, request.coalesce)]
+                return request
+        return None
+
+    def cancel_scripts(self, error, value):
+        """ Removes the script commands, and stops the current script step """
+        self._remove(self._lanes[SCRIPT], SCRIPT, error, value)
+        if self.script_gate is not None:
+            self.script_gate.cancel()
+            self.script_gate = None
+
+    def clear(self, error, value):
+        for priority, lane in self._lanes.items():
+            self._remove(lane, priority, error, value)
+        if self.script_gate is not None:
+            self.script_gate.cancel()
+            self.script_gate = None
+
+    def _remove(self, lane, priority, error, value):
+        for request in lane:
+            request.finish(error, value)
+            if (request.coalesce is not None) and (self._coalesced.get((priority, request.coalesce)) is request):
+                del self._coalesced[(priority, request.coalesce)]
+        lane.clear()
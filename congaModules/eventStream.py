@@ -0,0 +1,159 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import asyncio
+import json
+from .observer import Signal
+from .robotManager import SERVER_EPOCH
+from .statusRecord import StatusRecord
+
+
+class EventStream(object):
+    """ Sends server-sent events (text/event-stream) through an HTTP connection.
+        The connection is kept open until the client closes it; a comment is
+        sent periodically as heartbeat, so proxies don't close it """
+
+    def __init__(self, connection, heartbeat = 15):
+        super().__init__()
+        self._connection = connection
+        self._heartbeat = heartbeat
+        self._timer = None
+        self._closed = False
+        self.closedSignal = Signal("closed", self)
+        connection.closedSignal.connect(self._connection_closed)
+
+    def start(self, retry = 3000):
+        connection = self._connection
+        connection.protocol = 'HTTP/1.1'
+        connection.add_header("Content-Type", "text/event-stream")
+        connection.add_header("Cache-Control", "no-store")
+        connection.add_header("Connection", "close")
+        connection.add_header("X-Accel-Buffering", "no")
+        connection.send_answer(f"retry: {retry}\n\n", 200, "OK")
+        self._schedule_heartbeat()
+
+    def send_event(self, data, event = None, event_id = None):
+        """ Sends an event. data can be any object serializable to JSON """
+        if self._closed:
+            return
+        text = ""
+        if event is not None:
+            text += f"event: {event}\n"
+        if event_id is not None:
+            text += f"id: {event_id}\n"
+        text += f"data: {json.dumps(data)}\n\n"
+        self._connection.send_answer(text)
+        self._schedule_heartbeat()
+
+    def close(self):
+        self._connection.close()
+
+    def _schedule_heartbeat(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(self._heartbeat, self._send_heartbeat)
+
+    def _send_heartbeat(self):
+        self._timer = None
+        if self._closed:
+            return
+        self._connection.send_answer(": keepalive\n\n")
+        self._schedule_heartbeat()
+
+    def _connection_closed(self, name, connection):
+        if self._closed:
+            return
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        connection.closedSignal.disconnect(self._connection_closed)
+        self.closedSignal.emit()
+
+
+class RobotStatusStream(EventStream):
+    """ Streams the status of one robot, or of all the robots, as 'status'
+        events. The first event for each robot contains the full status,
+        and the next ones only the entries that changed.
+
+        The event id is the last status revision, which is shared by all the
+        robots, so a client that reconnects sending it in Last-Event-ID only
+        receives what changed since then """
+
+    def __init__(self, connection, manager, robot_id = None, heartbeat = 15):
+        super().__init__(connection, heartbeat)
+        self._manager = manager
+        self._robot_id = robot_id
+        self._robots = {}
+
+    def start(self, last_event_id = None):
+        super().start()
+        revision = self._parse_event_id(last_event_id)
+        if self._robot_id is None:
+            for robot_id in self._manager.get_robot_list():
+                self._add_robot(robot_id, revision)
+            self._manager.new_robot.connect(self._new_robot)
+            if len(self._robots) == 0:
+                self.send_event({}, "norobots")
+        else:
+            self._add_robot(self._robot_id, revision)
+
+    def _add_robot(self, robot_id, version):
+        robot = self._manager.find_robot(robot_id)
+        if robot is None:
+            return
+        self._robots[robot_id] = robot
+        robot.statusChanged.connect(self._status_changed)
+        robot.add_map_watcher()
+        changes = None
+        if version is not None:
+            changes = robot.get_status_changes(version)
+        if changes is None:
+            self._send_status(robot, robot.get_status_values(), True)
+        elif len(changes) != 0:
+            self._send_status(robot, changes, False)
+
+    def _new_robot(self, name, manager, robot_id):
+        if robot_id not in self._robots:
+            self._add_robot(robot_id, None)
+
+    def _status_changed(self, name, robot, version, changes):
+        self._send_status(robot, changes, False)
+
+    def _send_status(self, robot, values, full):
+        data = {"robot": robot.get_identifier(), "connected": robot.is_connected(), "full": full, "values": values}
+        self.send_event(data, "status", self._get_event_id())
+
+    def _get_event_id(self):
+        return f"{SERVER_EPOCH}/{StatusRecord.last_revision}"
+
+    def _parse_event_id(self, event_id):
+        """ Returns the status revision in the event id, or None if the id is
+            not valid or belongs to an older server """
+        if (event_id is None) or (not event_id.startswith(SERVER_EPOCH + "/")):
+            return None
+        try:
+            return int(event_id[len(SERVER_EPOCH) + 1:])
+        except ValueError:
+            return None
+
+    def _connection_closed(self, name, connection):
+        super()._connection_closed(name, connection)
+        for robot in self._robots.values():
+            robot.statusChanged.disconnect(self._status_changed)
+            robot.remove_map_watcher()
+        self._robots = {}
+        self._manager.new_robot.disconnect(self._new_robot)
@@ -16,46 +16,95 @@
 
 import json
 import asyncio
+import logging
+import traceback
+import time
 from urllib.parse import parse_qs
 
 from .baseServer import BaseServer, BaseConnection
+from .router import Router
+from .metrics import metrics
 
 class HTTPServer(BaseServer):
     def __init__(self):
         super().__init__()
-        self._registered_pages = None
+        self._router = None
+        self._keep_alive_timeout = 15
+        self._max_requests = 100
+        self._latencies = {}
 
-    def configure(self, registered_pages, loop, port = 80):
-        self._registered_pages = registered_pages
+    def configure(self, registered_pages, loop, port = 80, keep_alive_timeout = 15, max_requests = 100):
+        """ registered_pages is a dictionary with the routes (see router.py).
+            keep_alive_timeout is the time, in seconds, that an idle connection is kept
+            open waiting for a new request; max_requests is the maximum number of requests
+            served through a single connection """
+        self._router = Router(registered_pages)
+        # the latency histogram of each route, indexed by its handler
+        self._latencies = {handler: metrics.get_route(pattern) for pattern, handler in registered_pages.items()}
+        self._latencies[None] = metrics.get_route("none")
+        self._keep_alive_timeout = keep_alive_timeout
+        self._max_requests = max_requests
         super().configure(loop, port)
 
     async def _handle(self, reader, writer):
-        connection = HTTPConnection(reader, writer, self._registered_pages)
+        connection = HTTPConnection(reader, writer, self._router, self._keep_alive_timeout, self._max_requests,
+                                    self._latencies)
         await connection.run()
 
 
 class HTTPConnection(BaseConnection):
-    """ Manages an specific connection to the HTTP server """
+    """ Manages an specific connection to the HTTP server.
 
-    def __init__(self, reader, writer, registered_pages):
+        The connection supports persistent connections and pipelining: after a
+        handler calls close(), the answer is finished and, if the connection
+        can be kept alive, the state is reset to process the next request """
+
+    MAX_HEADER_SIZE = 65536
+
+    def __init__(self, reader, writer, router, keep_alive_timeout = 15, max_requests = 100, latencies = None):
         super().__init__(reader, writer)
-        self._registered_pages = registered_pages
+        self._router = router
+        self._latencies = latencies if latencies is not None else {}
+        self._keep_alive_timeout = keep_alive_timeout
+        self._max_requests = max_requests
+        self._requests_served = 0
+        self._idle_timer = None
+        self._in_new_data = False
+        self._reset_request()
+        self._start_idle_timer()
+
+    def _reset_request(self):
         self.headers = None
         self.protocol = 'HTTP/1.0'
+        self._body = b""
         self._headers_answer = b""
+        self._answer_header_names = set()
         self._return_error = 200
         self._return_error_text = ""
         self._answer_sent = False
+        self._pending_answer = None
+        self._busy = False
+        self._keep_alive = False
+        self._request_latency = None
+        self._request_start = 0
 
     def new_data(self):
+        if self._busy or self._closed:
+            # the current request is still being answered; keep the next ones in the buffer
+            return False
         if self.headers is None:
             pos = self._data.find(b"\r\n\r\n")
             if pos == -1:
+                if len(self._data) > self.MAX_HEADER_SIZE:
+                    self._send_error_and_close(431, "REQUEST HEADER FIELDS TOO LARGE")
+                return False
+            header = self._data.peek(0, pos).split(b"\r\n")
+            self._data.consume(pos + 4)
+            http_line = header[0].decode('utf8', errors = 'replace').split(" ")
+            if len(http_line) != 3:
+                self._send_error_and_close(400, "BAD REQUEST")
                 return False
-            header = self._data[:pos].split(b"\r\n")
-            self._data = self._data[pos+4:]
             self.headers = {}
-            http_line = header[0].decode('utf8').split(" ")
             self._command = http_line[0]
             self._URI = http_line[1]
             if (len(self._URI) == 0) or (self._URI[0] != '/'):
@@ -65,33 +114,170 @@ class HTTPConnection(BaseConnection):
                 pos = entry.find(b":")
                 if pos != -1:
                     self.headers[entry[:pos].decode('utf8').strip()] = entry[pos+1:].decode('utf8').strip()
-        if 'Content-Length' in self.headers:
-            if len(self._data) < int(self.headers['Content-Length']):
+        if not self._read_body():
+            return False
+
+        self._busy = True
+        self._stop_idle_timer()
+        self._keep_alive = self._wants_keep_alive()
+        if self._protocol == 'HTTP/1.1':
+            self.protocol = 'HTTP/1.1'
+        self._in_new_data = True
+        try:
+            self._process_data()
+        finally:
+            self._in_new_data = False
+        # if the answer was already sent, there can be another request in the buffer
+        return (not self._busy) and (not self._closed) and (len(self._data) != 0)
+
+    def _read_body(self):
+        """ Extracts the body of the current request from the buffer.
+            Returns False if it hasn't arrived completely yet """
+        if 'chunked' in self.get_header('Transfer-Encoding', '').lower():
+            try:
+                result = self._parse_chunked(self._data)
+            except ValueError:
+                self._send_error_and_close(400, "BAD REQUEST")
+                return False
+            if result is None:
                 return False
-        self._process_data()
-        return False
+            self._body, used = result
+            self._data.consume(used)
+            return True
+        length = self.get_header('Content-Length')
+        if length is None:
+            self._body = b""
+            return True
+        try:
+            length = int(length)
+        except ValueError:
+            self._send_error_and_close(400, "BAD REQUEST")
+            return False
+        if len(self._data) < length:
+            return False
+        self._body = self._data.read(length)
+        return True
+
+    def _parse_chunked(self, data):
+        """ Decodes a body with chunked transfer encoding from a ReceiveBuffer.
+            Returns the body and the number of bytes used, or None if it is
+            still incomplete. Raises ValueError if a chunk size is not valid """
+        body = bytearray()
+        pos = 0
+        while True:
+            end = data.find(b"\r\n", pos)
+            if end == -1:
+                return None
+            size = int(data.peek(pos, end).split(b";")[0], 16)
+            if size < 0:
+                raise ValueError("negative chunk size")
+            pos = end + 2
+            if size == 0:
+                # skip the trailer, if any
+                end = data.find(b"\r\n\r\n", pos - 2)
+                if end == -1:
+                    return None
+                return bytes(body), end + 4
+            if len(data) < pos + size + 2:
+                return None
+            body += data.peek(pos, pos + size)
+            pos += size + 2
+
+    def _wants_keep_alive(self):
+        if self._requests_served + 1 >= self._max_requests:
+            return False
+        connection = self.get_header('Connection', '').lower()
+        if self._protocol == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
+
+    def _send_error_and_close(self, error, text):
+        self._keep_alive = False
+        self.send_answer("", error, text)
+        self.close()
+
+    def _start_idle_timer(self):
+        self._stop_idle_timer()
+        if not self._closed:
+            self._idle_timer = asyncio.get_running_loop().call_later(self._keep_alive_timeout, self._idle_timeout)
+
+    def _stop_idle_timer(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def _idle_timeout(self):
+        self._idle_timer = None
+        if not self._busy:
+            self._close_connection()
 
     def _process_data(self):
-        length = 0
-        jump = None
-        path = self.get_path()
-        for page in self._registered_pages:
-            if page[-1] == '*':
-                if path.startswith(page[:-1]):
-                    if length < len(page):
-                        jump = page
-                        length = len(page)
-                continue
-            if path == page:
-                self._registered_pages[page](self)
-                return
-        if jump is not None:
-            self._registered_pages[jump](self)
+        handler, params, allowed = self._router.resolve(self._command, self.get_path())
+        self._request_latency = self._latencies.get(handler)
+        self._request_start = time.perf_counter()
+        if handler is not None:
+            self._call_handler(handler, params)
             return
-        self.send_answer("", 404, "NOT FOUND")
+        if allowed is not None:
+            self.add_header("Allow", ", ".join(allowed))
+            self.send_answer("", 405, "METHOD NOT ALLOWED")
+        else:
+            self.send_answer("", 404, "NOT FOUND")
         self.close()
 
+    def _call_handler(self, handler, params):
+        """ Handlers can be plain functions or coroutines; coroutines are run
+            as a task, so they can await slow operations without blocking the loop.
+            The parameters captured from the path are passed as keyword arguments """
+        result = handler(self, **params)
+        if asyncio.iscoroutine(result):
+            task = asyncio.ensure_future(result)
+            task.add_done_callback(self._handler_done)
+
+    def _handler_done(self, task):
+        if task.cancelled():
+            self._close_connection()
+            return
+        exception = task.exception()
+        if exception is not None:
+            logging.error(f"Exception in HTTP handler: {''.join(traceback.format_exception(exception))}")
+            if not self._answer_sent:
+                self.send_answer("", 500, "INTERNAL SERVER ERROR")
+            self._keep_alive = False
+            self.close()
+
+    def close(self):
+        """ Called by the handlers when the answer is complete. The socket is
+            closed only if the connection can't be kept alive """
+        if self._closed:
+            return
+        if not self._answer_sent:
+            self.send_answer(b"", 500, "INTERNAL SERVER ERROR")
+        self._flush_answer(True)
+        if not self._keep_alive:
+            self._close_connection()
+            return
+        self._requests_served += 1
+        self._reset_request()
+        self._start_idle_timer()
+        if not self._in_new_data:
+            # the answer was sent by a coroutine; process the requests that arrived meanwhile
+            asyncio.get_running_loop().call_soon(self._process_buffer)
+
+    def _process_buffer(self):
+        while self.new_data():
+            pass
+
+    def _close_connection(self):
+        self._stop_idle_timer()
+        super().close()
+
+    def connection_lost(self):
+        self._keep_alive = False
+        self._close_connection()
+
     def add_header(self, name, value):
+        self._answer_header_names.add(name.lower())
         self._headers_answer += (f'{name}: {value}\r\n').encode('utf8')
 
     def send_answer_json_close(self, data):
@@ -102,20 +288,84 @@ class HTTPConnection(BaseConnection):
         self.close()
 
     def send_answer(self, data, error = 200, text = ''):
+        """ Sends data to the client. The first call sends the status line and
+            the headers too. If the handler didn't specify how the answer is
+            delimited, it is kept until close() to add a Content-Length """
+        if self._closed:
+            return
         if isinstance(data, str):
             data = data.encode('utf8')
-        if not self._answer_sent:
-            cmd = (f'{self.protocol} {error} {text}\r\n').encode('utf8')
-            cmd += self._headers_answer
-            cmd += b'\r\n'
-            cmd += data
-        else:
-            cmd = data
+        if self._answer_sent:
+            # more data: if the length wasn't specified, the answer ends when the socket is closed
+            self._flush_answer(False)
+            self._writer.write(data)
+            return
         self._answer_sent = True
-        self._writer.write(cmd)
+        self._return_error = error
+        self._return_error_text = text
+        names = self._answer_header_names
+        self._pending_answer = data
+        if 'connection' in names:
+            if b'connection: close' in self._headers_answer.lower():
+                self._keep_alive = False
+            # the handler manages the connection by itself (like in event streams)
+            self._flush_answer(False)
+        elif ('content-length' in names) or ('transfer-encoding' in names):
+            self._flush_answer(False)
+
+    def _flush_answer(self, finished):
+        """ Sends the headers and the pending data. If finished is True, the
+            answer is complete, so the length is known """
+        data = self._pending_answer
+        if data is None:
+            return
+        self._pending_answer = None
+        names = self._answer_header_names
+        headers = self._headers_answer
+        has_length = ('content-length' in names) or ('transfer-encoding' in names)
+        if (not has_length) and (not finished):
+            self._keep_alive = False
+        if (not has_length) and finished and (self._return_error not in (204, 304)):
+            headers += f'Content-Length: {len(data)}\r\n'.encode('utf8')
+        if 'connection' not in names:
+            if self._keep_alive:
+                headers += b'Connection: keep-alive\r\n'
+            else:
+                headers += b'Connection: close\r\n'
+        cmd = (f'{self.protocol} {self._return_error} {self._return_error_text}\r\n').encode('utf8')
+        self._writer.write(cmd + headers + b'\r\n' + data)
+        if self._request_latency is not None:
+            # until the answer starts, so the event streams are measured too
+            self._request_latency.observe(time.perf_counter() - self._request_start)
+            self._request_latency = None
 
     def get_data(self):
-        return self._data
+        return self._body
+
+    def get_header(self, name, default = None):
+        """ Returns the value of a request header, ignoring the case of the name """
+        if name in self.headers:
+            return self.headers[name]
+        name = name.lower()
+        for key in self.headers:
+            if key.lower() == name:
+                return self.headers[key]
+        return default
+
+    def check_etag(self, etag):
+        """ Adds the ETag header to the answer. If the client already has
+            that version, answers with a 304 and returns True; in that case
+            the caller must not send the data """
+        self.add_header("ETag", etag)
+        self.add_header("Cache-Control", "no-cache")
+        client_etags = self.get_header('If-None-Match')
+        if client_etags is None:
+            return False
+        client_etags = [tag.strip() for tag in client_etags.split(',')]
+        if (etag not in client_etags) and ('*' not in client_etags):
+            return False
+        self.send_answer(b"", 304, "Not Modified")
+        return True
 
     def get_uri(self):
         return self._URI
@@ -139,15 +389,16 @@ class HTTPConnection(BaseConnection):
             return data
 
     def convert_data(self):
-        if ('Content-Type' in self.headers):
-            if self.headers['Content-Type'] == 'application/x-www-form-urlencoded':
-                tmpdata = parse_qs(self._data.decode('utf8'))
+        content_type = self.get_header('Content-Type')
+        if content_type is not None:
+            if content_type == 'application/x-www-form-urlencoded':
+                tmpdata = parse_qs(self._body.decode('utf8'))
                 data = {}
                 for element in tmpdata:
                     data[element] = tmpdata[element][0]
-                self._data = data
-            elif self.headers['Content-Type'].startswith('application/json'):
-                self._data = json.loads(self._data)
+                self._body = data
+            elif content_type.startswith('application/json'):
+                self._body = json.loads(self._body)
 
     def send_chunked(self, text):
         chunk = f'{hex(len(text))[2:]}\r\n{text}\r\n'
@@ -0,0 +1,66 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONBackend(object):
+    """ Encodes and decodes JSON with the standard library or, if it is
+        installed, with orjson, which is much faster with big payloads
+        like the maps.
+
+        Backends:
+          "auto": orjson if available, else the standard library
+          "stdlib": the json module
+          "orjson": the orjson module """
+
+    BACKENDS = ("auto", "stdlib", "orjson")
+
+    def __init__(self):
+        super().__init__()
+        self.name = None
+        self.loads = None
+        self.dumps = None
+        self.configure("auto")
+
+    def configure(self, backend = "auto"):
+        if backend not in self.BACKENDS:
+            logging.error(f"Unknown JSON backend {backend}; using 'auto'")
+            backend = "auto"
+        if (backend == "orjson") and (orjson is None):
+            logging.error("The orjson module is not installed; using the standard library")
+            backend = "stdlib"
+        if backend == "auto":
+            backend = "stdlib" if orjson is None else "orjson"
+        self.name = backend
+        if backend == "orjson":
+            self.loads = orjson.loads
+            self.dumps = self._orjson_dumps
+        else:
+            self.loads = json.loads
+            self.dumps = json.dumps
+
+    @staticmethod
+    def _orjson_dumps(data):
+        return orjson.dumps(data).decode('utf8')
+
+json_backend = JSONBackend()
@@ -0,0 +1,121 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import re
+
+# The map sent by the robot starts with a 9 bytes header (width is stored in
+# bytes 5-6 and height in bytes 7-8, big endian), followed by a run-length
+# encoded stream. Each byte with the two upper bits set (0xC0) is a repetition
+# prefix that adds six bits to the repetition counter; any other byte contains
+# four 2-bit pixels (0: unknown, 1: wall, 2: floor), most significant first.
+
+MAP_HEADER_SIZE = 9
+
+# byte -> the four pixels it contains, already expanded
+_PIXEL_LUT = tuple(bytes(((v >> 6) & 0x03, (v >> 4) & 0x03, (v >> 2) & 0x03, v & 0x03)) for v in range(256))
+
+# either a repetition prefix followed by the repeated byte, or a run of plain bytes
+_RUN_RE = re.compile(rb'([\xc0-\xff]+)([\x00-\xbf])|([\x00-\xbf]+)')
+
+
+class MapGrid(object):
+    """ A decoded map: one byte per cell, in row-major order, plus the bounding
+        box of all the known cells (and the charger, if its position is valid).
+        If there is nothing to paint, minx > maxx """
+
+    def __init__(self, width, height, pixels, minx, miny, maxx, maxy):
+        self.width = width
+        self.height = height
+        self.pixels = pixels
+        self.minx = minx
+        self.miny = miny
+        self.maxx = maxx
+        self.maxy = maxy
+
+    def is_empty(self):
+        return self.minx > self.maxx
+
+
+def expand_pixels(data, pos = MAP_HEADER_SIZE):
+    """ Expands the run-length stream in data, starting at pos, into a bytearray
+        with one pixel per byte """
+
+    lut = _PIXEL_LUT
+    chunks = []
+    for match in _RUN_RE.finditer(data, pos):
+        plain = match.group(3)
+        if plain is not None:
+            chunks.append(b"".join(map(lut.__getitem__, plain)))
+            continue
+        repetitions = 0
+        for prefix in match.group(1):
+            repetitions = repetitions * 64 + (prefix & 0x3F)
+        if repetitions == 0:
+            repetitions = 1
+        chunks.append(lut[match.group(2)[0]] * repetitions)
+    return bytearray(b"".join(chunks))
+
+
+def bounding_box(pixels, width, chargerX = -1, chargerY = -1):
+    """ Returns (minx, miny, maxx, maxy) for the non-zero pixels, doing a single
+        pass over the rows. The charger position is included when it is valid """
+
+    if (chargerX == -1) or (chargerY == -1):
+        minx = miny = 0
+        maxx = maxy = -1
+    else:
+        minx = maxx = chargerX
+        miny = maxy = chargerY
+    if width <= 0:
+        return minx, miny, maxx, maxy
+
+    empty = minx > maxx
+    y = 0
+    for start in range(0, len(pixels), width):
+        row = pixels[start:start + width]
+        stripped = row.lstrip(b'\x00')
+        if len(stripped) != 0:
+            left = len(row) - len(stripped)
+            right = len(stripped.rstrip(b'\x00')) + left - 1
+            if empty:
+                minx = left
+                maxx = right
+                miny = y
+                maxy = y
+                empty = False
+            else:
+                if left < minx:
+                    minx = left
+                if right > maxx:
+                    maxx = right
+                if y < miny:
+                    miny = y
+                if y > maxy:
+                    maxy = y
+        y += 1
+    return minx, miny, maxx, maxy
+
+
+def decode_map(data, chargerX = -1, chargerY = -1):
+    """ Decodes a binary map (already base64-decoded) into a MapGrid """
+
+    if len(data) < MAP_HEADER_SIZE:
+        return MapGrid(0, 0, bytearray(), *bounding_box(b"", 0, chargerX, chargerY))
+    width = data[5] * 256 + data[6]
+    height = data[7] * 256 + data[8]
+    pixels = expand_pixels(data, MAP_HEADER_SIZE)
+    minx, miny, maxx, maxy = bounding_box(pixels, width, chargerX, chargerY)
+    return MapGrid(width, height, pixels, minx, miny, maxx, maxy)
@@ -0,0 +1,95 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import logging
+import time
+
+# cleaning (1), or returning to base (4 or 9): the map only changes in these states
+WORKING_STATES = ('1', '4', '9')
+
+# a map that grows or shrinks at least this number of bytes is a big change
+BIG_CHANGE = 256
+
+
+class MapRefreshPolicy(object):
+    """ Decides how often a robot is asked for its map while it is working.
+
+        While someone is watching the map (there is an event stream open, or
+        the map was requested in the last watch_timeout seconds) it is asked
+        every 'active' seconds. If the map doesn't change, the interval is
+        doubled up to 'maximum' seconds, and it goes back to 'active' after a
+        big change. When nobody is watching, it is asked every 'idle' seconds,
+        or never if 'idle' is zero """
+
+    def __init__(self, active = 2, maximum = 8, idle = 30, watch_timeout = 10):
+        super().__init__()
+        self.active = active
+        self.maximum = max(active, maximum)
+        self.idle = idle
+        self.watch_timeout = watch_timeout
+
+    def next_interval(self, interval, watched, change):
+        """ Returns the seconds until the next refresh, or None to stop asking.
+            change is the number of bytes that the map grew or shrank in the
+            last refresh (at least 1 if it changed), or None if it is unknown """
+        if not watched:
+            return self.idle if self.idle > 0 else None
+        if (interval is None) or (interval < self.active) or (change is not None and change >= BIG_CHANGE):
+            return self.active
+        if change == 0:
+            return min(interval * 2, self.maximum)
+        return min(interval, self.maximum)
+
+
+class MapRefreshLimiter(object):
+    """ Limits the map refreshes asked to all the robots together, so a
+        server with many robots doesn't flood its link with maps. It is a
+        token bucket that allows 'rate' refreshes per second, with bursts
+        of up to 'rate' refreshes (or one, if rate is smaller) """
+
+    def __init__(self):
+        super().__init__()
+        self._rate = 0
+        self._capacity = 1
+        self._tokens = 0
+        self._last = 0
+        self.configure(10)
+
+    def configure(self, rate = 10):
+        """ rate is the number of refreshes per second; zero disables the limit """
+        if rate < 0:
+            logging.error(f"Invalid map refresh rate {rate}; using 10")
+            rate = 10
+        self._rate = rate
+        self._capacity = max(1, rate)
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+
+    def acquire(self):
+        """ Returns zero if a refresh can be sent now, or the number of seconds
+            to wait before trying again """
+        if self._rate == 0:
+            return 0
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self._rate
+
+
+map_refresh_limiter = MapRefreshLimiter()
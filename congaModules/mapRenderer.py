@@ -0,0 +1,309 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import base64
+import io
+import operator
+import threading
+import time
+
+from PIL import Image, ImageDraw
+
+from .mapDecoder import decode_map
+
+# Palette used for the map pictures. The first four entries are the values
+# of the map pixels, so the decoded grid can be used directly as image data.
+COLOR_BACKGROUND = 0
+COLOR_WALL = 1
+COLOR_FLOOR = 2
+COLOR_TRACK = 4
+COLOR_ROBOT = 5
+COLOR_CHARGER = 6
+COLOR_BORDER = 7
+
+_PALETTE = [
+    0xff, 0xff, 0xff, # 0: unknown, painted as background
+    0x00, 0x00, 0x00, # 1: wall
+    0xff, 0xff, 0x00, # 2: floor
+    0xff, 0xff, 0x00, # 3: not used by the robot; painted as floor
+    0x00, 0xff, 0xff, # track
+    0xff, 0x00, 0xff, # robot
+    0x00, 0xff, 0x00, # charger
+    0x00, 0x00, 0x00, # border of the robot and the charger
+]
+
+
+class MapGeometry(object):
+    """ Translates map coordinates into picture coordinates """
+
+    def __init__(self, grid, width, height):
+        self.minx = grid.minx
+        self.miny = grid.miny
+        self.cells_w = grid.maxx - grid.minx + 1
+        self.cells_h = grid.maxy - grid.miny + 1
+        radius1 = width / self.cells_w
+        radius2 = height / self.cells_h
+        if radius2 < radius1:
+            radius1 = radius2
+        self.cell = radius1
+        self.half_cell = radius1 / 2
+        self.track_radius = int(radius1 * 0.8) # each point is 20cm wide, and the robot is 32cm wide
+
+    def to_picture(self, x, y):
+        return (int((x - self.minx) * self.cell + self.half_cell),
+                int((y - self.miny) * self.cell + self.half_cell))
+
+
+def new_picture(width, height):
+    picture = Image.new('P', (width, height), COLOR_BACKGROUND)
+    picture.putpalette(_PALETTE)
+    return picture
+
+
+# translates the map pixels into a mask of the known cells
+_KNOWN_CELLS = bytes([0] + [255] * 255)
+
+
+def _covering_cells(count, cell, limit):
+    """ Returns, for each pixel of a row (or column) of the picture, the cells
+        that cover it. Each cell covers from its origin to origin + cell, both
+        included, rounded like the rectangles painted by PIL, so it overlaps
+        its neighbour by one pixel (or more, if the cells are smaller than a
+        pixel). The result is a list of layers: layers[0][pixel] is the last
+        cell covering the pixel, layers[1][pixel] the previous one... and
+        'count' (an unknown cell) where there are no more """
+    covering = [[] for pixel in range(limit)]
+    for index in range(count):
+        origin = index * cell
+        first = int(origin)
+        if first >= limit:
+            break
+        for pixel in range(first, min(int(origin + cell), limit - 1) + 1):
+            covering[pixel].append(index)
+    depth = max(len(cells) for cells in covering)
+    return [[cells[-1 - layer] if len(cells) > layer else count for cells in covering] for layer in range(depth)]
+
+
+def _merge_layers(mode, size, layers):
+    """ Returns a picture with the first known pixel of the layers (byte strings) """
+    picture = Image.frombuffer(mode, size, layers[-1], 'raw', mode, 0, 1)
+    for layer in reversed(layers[:-1]):
+        mask = Image.frombuffer('L', size, layer.translate(_KNOWN_CELLS), 'raw', 'L', 0, 1)
+        picture.paste(Image.frombuffer(mode, size, layer, 'raw', mode, 0, 1), (0, 0), mask)
+    return picture
+
+
+def paint_grid(picture, grid, geometry):
+    """ Paints the known cells of the map exactly like painting each one as a
+        rectangle, in row order, but scaling the whole rows and columns: each
+        pixel gets the last known cell that covers it """
+
+    width = grid.width
+    cells_w = geometry.cells_w
+    cells_h = geometry.cells_h
+    pixels = grid.pixels
+    picture_w, picture_h = picture.size
+    column_layers = [operator.itemgetter(*layer) for layer in _covering_cells(cells_w, geometry.cell, picture_w)]
+    row_layers = _covering_cells(cells_h, geometry.cell, picture_h)
+
+    # horizontally: each row of the map (plus an unknown cell at the end) is expanded to the picture width
+    layers = [[] for layer in column_layers]
+    for y in range(grid.miny, grid.maxy + 1):
+        start = grid.minx + width * y
+        row = pixels[start:start + cells_w]
+        row += bytes(cells_w + 1 - len(row))
+        for layer, getter in zip(layers, column_layers):
+            layer.append(bytes(getter(row)))
+    scaled = _merge_layers('P', (picture_w, cells_h), [b"".join(layer) for layer in layers]).tobytes()
+
+    # vertically: the rows are repeated (plus an unknown row at the end) to the picture height
+    rows = [scaled[offset:offset + picture_w] for offset in range(0, len(scaled), picture_w)]
+    rows.append(bytes(picture_w))
+    layers = [b"".join([rows[index] for index in layer]) for layer in row_layers]
+    picture.paste(_merge_layers('P', (picture_w, picture_h), layers), (0, 0))
+
+
+def paint_track(ctx, points, radius, fill = COLOR_TRACK):
+    """ Paints the track as a circle at each point, joined by a polyline """
+
+    if len(points) == 0:
+        return
+    for x, y in points:
+        ctx.ellipse([x - radius, y - radius, x + radius, y + radius], fill=fill)
+    ctx.line(points, fill=fill, width=radius * 2)
+
+
+def paint_circle(ctx, x, y, radius, strokeStyle, fillStyle):
+    ctx.ellipse([x - radius, y - radius, x + radius, y + radius], fill = strokeStyle)
+    radius = int(radius/2)
+    ctx.ellipse([x - radius, y - radius, x + radius, y + radius], fill = fillStyle)
+
+
+def track_points(track, geometry):
+    """ Converts the track (pairs of x,y bytes) into picture coordinates """
+
+    points = []
+    for pos in range(0, len(track) - 1, 2):
+        points.append(geometry.to_picture(track[pos], track[pos + 1]))
+    return points
+
+
+def paint_markers(ctx, geometry, robot_position, chargerX, chargerY):
+    """ Paints the robot (at the last point of the track) and the charger """
+
+    if robot_position is not None:
+        x, y = robot_position
+        paint_circle(ctx, x, y, geometry.half_cell, COLOR_BORDER, COLOR_ROBOT)
+    if (chargerX != -1) and (chargerY != -1):
+        x = (chargerX - geometry.minx) * geometry.cell + geometry.half_cell
+        y = (chargerY - geometry.miny) * geometry.cell + geometry.half_cell
+        paint_circle(ctx, x, y, geometry.half_cell, COLOR_BORDER, COLOR_CHARGER)
+
+
+def decode_track(trackData):
+    """ Returns the track points as x,y byte pairs, without the 4 bytes header """
+
+    track = base64.b64decode(trackData) [4:]
+    return track[:len(track) & ~1]
+
+
+def render_map(grid, track, chargerX, chargerY, width, height):
+    """ Returns a picture with the map, the track, the robot and the charger """
+
+    picture = new_picture(width, height)
+    if grid.is_empty():
+        return picture
+    geometry = MapGeometry(grid, width, height)
+    paint_grid(picture, grid, geometry)
+    ctx = ImageDraw.Draw(picture)
+    points = track_points(track, geometry)
+    paint_track(ctx, points, geometry.track_radius)
+    paint_markers(ctx, geometry, points[-1] if len(points) != 0 else None, chargerX, chargerY)
+    return picture
+
+
+class MapCanvas(object):
+    """ Persistent picture of the map of a robot, to avoid repainting the whole
+        track every time. The grid and the track are kept in separate layers:
+        when the track grows only the new segment is added to the track layer,
+        and when the map changes only the grid is repainted. Both layers are
+        discarded when the bounding box or the picture size change.
+        It can be used from several threads """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._map_data = None
+        self._charger_pos = None
+        self._grid = None
+        self._chargerX = -1
+        self._chargerY = -1
+        self._layout = None
+        self._geometry = None
+        self._grid_picture = None
+        self._track_layer = None
+        self._track = b""
+        self._robot_position = None
+
+    def paint_png_timed(self, mapData, trackData, chargerPos, width, height, compress_level = 6, optimize = False):
+        """ Returns a tuple with the PNG data of the map and the seconds spent
+            decoding the data, painting the picture and encoding it """
+        start = time.perf_counter()
+        with self._lock:
+            picture, decode_time = self._paint(mapData, trackData, chargerPos, width, height)
+        painted = time.perf_counter()
+        data = encode_png(picture, compress_level, optimize)
+        return data, decode_time, painted - start - decode_time, time.perf_counter() - painted
+
+    def _paint(self, mapData, trackData, chargerPos, width, height):
+        """ Returns the picture, and the seconds spent decoding the data """
+        if len(mapData) == 0:
+            return Image.new('RGB', (width, height)), 0.0
+
+        started = time.perf_counter()
+        if (mapData != self._map_data) or (chargerPos != self._charger_pos):
+            charger = chargerPos.split(',')
+            self._chargerX = int(charger[0])
+            self._chargerY = int(charger[1])
+            self._grid = decode_map(base64.b64decode(mapData), self._chargerX, self._chargerY)
+            self._map_data = mapData
+            self._charger_pos = chargerPos
+            self._grid_picture = None
+        track = decode_track(trackData)
+        decode_time = time.perf_counter() - started
+        grid = self._grid
+        if grid.is_empty():
+            return new_picture(width, height), decode_time
+
+        layout = (grid.minx, grid.miny, grid.maxx, grid.maxy, width, height)
+        if layout != self._layout:
+            self._layout = layout
+            self._geometry = MapGeometry(grid, width, height)
+            self._grid_picture = None
+            self._track_layer = None
+        geometry = self._geometry
+
+        if self._grid_picture is None:
+            self._grid_picture = new_picture(width, height)
+            paint_grid(self._grid_picture, grid, geometry)
+
+        if (self._track_layer is None) or (not track.startswith(self._track)):
+            self._track_layer = Image.new('1', (width, height), 0)
+            self._track = b""
+            self._robot_position = None
+        if len(track) > len(self._track):
+            # start at the last point already painted, to join both segments
+            start = max(0, len(self._track) - 2)
+            points = track_points(track[start:], geometry)
+            paint_track(ImageDraw.Draw(self._track_layer), points, geometry.track_radius, 1)
+            self._track = track
+            self._robot_position = points[-1]
+
+        picture = self._grid_picture.copy()
+        picture.paste(COLOR_TRACK, (0, 0), self._track_layer)
+        paint_markers(ImageDraw.Draw(picture), geometry, self._robot_position, self._chargerX, self._chargerY)
+        return picture, decode_time
+
+
+def encode_png(picture, compress_level = 6, optimize = False):
+    f = io.BytesIO()
+    picture.save(f, "PNG", compress_level = compress_level, optimize = optimize)
+    return f.getvalue()
+
+
+def paint_map_png_timed(mapData, trackData, chargerPos, width, height, compress_level = 6, optimize = False):
+    """ Paints the map from the values sent by the robot (base64 map and track,
+        and "x,y" charger position) and returns a tuple with the PNG data and
+        the seconds spent decoding the data, painting the picture and encoding
+        it. It receives and returns only plain data, so it can be run in a
+        worker process """
+
+    start = time.perf_counter()
+    if len(mapData) != 0:
+        mapa = base64.b64decode(mapData)
+        track = decode_track(trackData)
+        charger = chargerPos.split(',')
+        chargerX = int(charger[0])
+        chargerY = int(charger[1])
+        grid = decode_map(mapa, chargerX, chargerY)
+        decoded = time.perf_counter()
+        picture = render_map(grid, track, chargerX, chargerY, width, height)
+    else:
+        decoded = start
+        picture = Image.new('RGB', (width, height))
+    painted = time.perf_counter()
+    data = encode_png(picture, compress_level, optimize)
+    return data, decoded - start, painted - decoded, time.perf_counter() - painted
@@ -0,0 +1,223 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import bisect
+
+from .robotMessage import PING, IDENTIFICATION, STATUS, ACK, MAP, ERROR, UNKNOWN
+
+# the kinds of packets sent by the robots, as classified by RobotConnection
+FRAME_KINDS = (PING, IDENTIFICATION, STATUS, ACK, MAP, ERROR, UNKNOWN)
+
+# upper bounds of the buckets of the histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """ Counts the observed values in buckets with fixed upper bounds, plus
+        one for the values bigger than the last bound """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def add(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.sum += other.sum
+        self.count += other.count
+
+
+class RobotMetrics(object):
+    """ The metrics of a robot. The connection updates the fields directly,
+        so nothing is allocated for each packet. queue is the command queue
+        of the current connection, or None if the robot isn't connected """
+
+    __slots__ = ('frames', 'bytes_in', 'bytes_out', 'ack_latency', 'acks_lost', 'queue')
+
+    def __init__(self):
+        self.frames = dict.fromkeys(FRAME_KINDS, 0)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.ack_latency = Histogram()
+        self.acks_lost = 0
+        self.queue = None
+
+    def add(self, other):
+        for kind, count in other.frames.items():
+            self.frames[kind] += count
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.ack_latency.add(other.ack_latency)
+        self.acks_lost += other.acks_lost
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics(object):
+    """ Collects the metrics of the server, and exports them in the Prometheus
+        text format. The values are only formatted when they are exported.
+
+        The metrics of the robots forgotten by the RobotManager are added to
+        'retired', so the totals never go backwards """
+
+    def __init__(self):
+        super().__init__()
+        self._robots = {}
+        # the packets received before the robot identifies itself
+        self.unidentified = RobotMetrics()
+        self.retired = RobotMetrics()
+        self.render_decode = Histogram()
+        self.render_paint = Histogram()
+        self.render_encode = Histogram()
+        self.loop_lag = Histogram()
+        self._routes = {}
+        self._gauges = {}
+        self._loop = None
+        self._probe_interval = 1
+        self._probe_due = 0
+        self._probe_timer = None
+
+    def get_robot(self, robot_id):
+        robot_metrics = self._robots.get(robot_id)
+        if robot_metrics is None:
+            robot_metrics = RobotMetrics()
+            self._robots[robot_id] = robot_metrics
+        return robot_metrics
+
+    def forget_robot(self, robot_id):
+        robot_metrics = self._robots.pop(robot_id, None)
+        if robot_metrics is not None:
+            self.retired.add(robot_metrics)
+
+    def get_route(self, route):
+        """ Returns the histogram for the latency of the HTTP requests to a route """
+        histogram = self._routes.get(route)
+        if histogram is None:
+            histogram = Histogram()
+            self._routes[route] = histogram
+        return histogram
+
+    def add_gauge(self, name, description, function):
+        """ Adds a value that is obtained calling function each time that the metrics are exported """
+        self._gauges[name] = (description, function)
+
+    def observe_render(self, decode, paint, encode):
+        self.render_decode.observe(decode)
+        self.render_paint.observe(paint)
+        self.render_encode.observe(encode)
+
+    def start(self, loop, interval = 1):
+        """ Starts measuring the event loop lag: how late a timer is run every interval seconds """
+        self.stop()
+        self._loop = loop
+        self._probe_interval = interval
+        self._probe_due = loop.time() + interval
+        self._probe_timer = loop.call_at(self._probe_due, self._probe)
+
+    def stop(self):
+        if self._probe_timer is not None:
+            self._probe_timer.cancel()
+            self._probe_timer = None
+
+    def _probe(self):
+        now = self._loop.time()
+        self.loop_lag.observe(max(0.0, now - self._probe_due))
+        self._probe_due = now + self._probe_interval
+        self._probe_timer = self._loop.call_at(self._probe_due, self._probe)
+
+    def render(self):
+        lines = []
+        total = RobotMetrics()
+        total.add(self.unidentified)
+        total.add(self.retired)
+        for robot_metrics in self._robots.values():
+            total.add(robot_metrics)
+        robots = [(f'robot="{_escape(robot_id)}"', robot_metrics) for robot_id, robot_metrics in self._robots.items()]
+
+        self._add_header(lines, "conga_frames_received_total", "counter", "Packets received from the robots, by kind")
+        for kind, count in total.frames.items():
+            lines.append(f'conga_frames_received_total{{kind="{kind}"}} {count}')
+        self._add_header(lines, "conga_robot_frames_received_total", "counter", "Packets received from each robot, by kind")
+        for labels, robot_metrics in robots:
+            for kind, count in robot_metrics.frames.items():
+                lines.append(f'conga_robot_frames_received_total{{{labels},kind="{kind}"}} {count}')
+
+        for name, field, description in (("bytes_received", "bytes_in", "Bytes received from"),
+                                         ("bytes_sent", "bytes_out", "Bytes sent to"),
+                                         ("acks_lost", "acks_lost", "Commands never acknowledged by")):
+            self._add_header(lines, f"conga_{name}_total", "counter", f"{description} the robots")
+            lines.append(f"conga_{name}_total {getattr(total, field)}")
+            self._add_header(lines, f"conga_robot_{name}_total", "counter", f"{description} each robot")
+            for labels, robot_metrics in robots:
+                lines.append(f"conga_robot_{name}_total{{{labels}}} {getattr(robot_metrics, field)}")
+
+        self._add_header(lines, "conga_ack_latency_seconds", "histogram", "Time until the robots acknowledge a command")
+        self._add_histogram(lines, "conga_ack_latency_seconds", "", total.ack_latency)
+        self._add_header(lines, "conga_robot_ack_latency_seconds", "histogram", "Time until each robot acknowledges a command")
+        for labels, robot_metrics in robots:
+            self._add_histogram(lines, "conga_robot_ack_latency_seconds", labels, robot_metrics.ack_latency)
+
+        self._add_header(lines, "conga_robot_command_queue_depth", "gauge", "Commands waiting to be sent to each connected robot")
+        for labels, robot_metrics in robots:
+            if robot_metrics.queue is not None:
+                lines.append(f"conga_robot_command_queue_depth{{{labels}}} {len(robot_metrics.queue)}")
+
+        for phase, histogram in (("decode", self.render_decode), ("paint", self.render_paint), ("encode", self.render_encode)):
+            name = f"conga_map_{phase}_seconds"
+            self._add_header(lines, name, "histogram", f"Time spent in the {phase} phase of the map pictures")
+            self._add_histogram(lines, name, "", histogram)
+
+        self._add_header(lines, "conga_http_request_seconds", "histogram", "Time until the answer to each HTTP request starts")
+        for route, histogram in self._routes.items():
+            self._add_histogram(lines, "conga_http_request_seconds", f'route="{_escape(route)}"', histogram)
+
+        self._add_header(lines, "conga_event_loop_lag_seconds", "histogram", "Delay of the timers of the main loop")
+        self._add_histogram(lines, "conga_event_loop_lag_seconds", "", self.loop_lag)
+
+        for name, (description, function) in self._gauges.items():
+            self._add_header(lines, name, "gauge", description)
+            lines.append(f"{name} {function()}")
+        lines.append("")
+        return "\n".join(lines)
+
+    def _add_header(self, lines, name, kind, description):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def _add_histogram(self, lines, name, labels, histogram):
+        separator = "," if labels else ""
+        cumulative = 0
+        for bound, count in zip(histogram.bounds, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {histogram.count}')
+        labels = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{labels} {histogram.sum}")
+        lines.append(f"{name}_count{labels} {histogram.count}")
+
+
+metrics = Metrics()
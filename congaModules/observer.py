@@ -14,21 +14,188 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
+import asyncio
+import collections
+import inspect
+import logging
+import time
+import weakref
+
+
 class Signal(object):
+    """ Calls the connected callbacks, in connection order, from emit """
     def __init__(self, name, owner):
         self._owner = owner
         self._name = name
-        self._cb = []
+        self._cb = {} # used as an ordered set
 
     def connect(self, function):
-        if function not in self._cb:
-            self._cb.append(function)
+        self._cb[function] = True
 
     def disconnect(self, function):
-        if function in self._cb:
-            self._cb.remove(function)
+        self._cb.pop(function, None)
 
     def emit(self, *args):
-        for fn in self._cb:
+        # a copy, since the callbacks can connect or disconnect others
+        for fn in tuple(self._cb):
             fn(self._name, self._owner, *args)
 
+
+class SubscriberStats(object):
+    """ Statistics of a subscriber of an AsyncSignal. The times are in seconds:
+        'wait' is the time between the emit and the call to the callback, and
+        'run' the time that the callback took """
+
+    __slots__ = ('delivered', 'dropped', 'coalesced', 'errors', 'wait_total', 'wait_max', 'run_total', 'run_max')
+
+    def __init__(self):
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def as_dict(self):
+        data = {key: getattr(self, key) for key in self.__slots__}
+        data['wait_avg'] = (self.wait_total / self.delivered) if self.delivered != 0 else 0.0
+        data['run_avg'] = (self.run_total / self.delivered) if self.delivered != 0 else 0.0
+        return data
+
+
+class _AsyncSubscriber(object):
+    """ A subscriber of an AsyncSignal, with its pending events and the task that delivers them """
+
+    def __init__(self, reference, name, maxsize, policy, key):
+        super().__init__()
+        self.reference = reference
+        self.name = name
+        self.policy = policy
+        self.key = key
+        self.maxsize = maxsize
+        if policy == AsyncSignal.COALESCE:
+            self.pending = collections.OrderedDict()
+        else:
+            self.pending = collections.deque()
+        self.task = None
+        self.stats = SubscriberStats()
+
+
+class AsyncSignal(object):
+    """ Like Signal, but the callbacks are called from their own task, so the
+        emitter never waits for them. Callbacks can be functions or coroutine
+        functions.
+
+        Each subscriber has a queue with up to 'maxsize' pending events. When it
+        is full, the policy decides what to do with a new event:
+          DROP_OLDEST: the oldest pending event is discarded
+          COALESCE: only the last pending event with the same key is kept (the
+                    key is key(*args), or None if key is None, so only the last
+                    event is kept); if there are 'maxsize' keys pending, the
+                    oldest one is discarded
+
+        Only weak references to the callbacks are kept, so the subscribers of
+        dead objects are removed automatically. This means that a lambda or a
+        local function must be referenced somewhere else to keep receiving
+        events """
+
+    DROP_OLDEST = "drop_oldest"
+    COALESCE = "coalesce"
+
+    def __init__(self, name, owner):
+        super().__init__()
+        self._owner = owner
+        self._name = name
+        self._subscribers = {}
+
+    def _get_key(self, function):
+        if inspect.ismethod(function):
+            return (id(function.__self__), id(function.__func__))
+        return (id(function), None)
+
+    def connect(self, function, maxsize = 64, policy = DROP_OLDEST, key = None):
+        if policy not in (self.DROP_OLDEST, self.COALESCE):
+            raise ValueError(f"Unknown policy {policy}")
+        subscriber_key = self._get_key(function)
+        if subscriber_key in self._subscribers:
+            return
+        remove = lambda reference: self._remove(subscriber_key)
+        if inspect.ismethod(function):
+            reference = weakref.WeakMethod(function, remove)
+        else:
+            reference = weakref.ref(function, remove)
+        self._subscribers[subscriber_key] = _AsyncSubscriber(reference, function.__qualname__, max(1, maxsize), policy, key)
+
+    def disconnect(self, function):
+        self._remove(self._get_key(function))
+
+    def _remove(self, subscriber_key):
+        subscriber = self._subscribers.pop(subscriber_key, None)
+        if subscriber is None:
+            return
+        subscriber.pending.clear()
+        if subscriber.task is not None:
+            subscriber.task.cancel()
+
+    def emit(self, *args):
+        if len(self._subscribers) == 0:
+            return
+        now = time.perf_counter()
+        for subscriber in tuple(self._subscribers.values()):
+            pending = subscriber.pending
+            if subscriber.policy == self.COALESCE:
+                key = None if subscriber.key is None else subscriber.key(*args)
+                if key in pending:
+                    del pending[key]
+                    subscriber.stats.coalesced += 1
+                elif len(pending) >= subscriber.maxsize:
+                    pending.popitem(last = False)
+                    subscriber.stats.dropped += 1
+                pending[key] = (now, args)
+            else:
+                if len(pending) >= subscriber.maxsize:
+                    pending.popleft()
+                    subscriber.stats.dropped += 1
+                pending.append((now, args))
+            if subscriber.task is None:
+                subscriber.task = asyncio.ensure_future(self._deliver(subscriber))
+
+    async def _deliver(self, subscriber):
+        """ Calls the callback with the pending events, and ends when there are no more """
+        try:
+            while len(subscriber.pending) != 0:
+                if subscriber.policy == self.COALESCE:
+                    emitted, args = subscriber.pending.popitem(last = False)[1]
+                else:
+                    emitted, args = subscriber.pending.popleft()
+                function = subscriber.reference()
+                if function is None:
+                    break
+                stats = subscriber.stats
+                start = time.perf_counter()
+                try:
+                    result = function(self._name, self._owner, *args)
+                    # release the reference while waiting, so the subscriber can die
+                    function = None
+                    if inspect.isawaitable(result):
+                        await result
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    stats.errors += 1
+                    logging.exception(f"Error in {subscriber.name}, subscribed to {self._name}")
+                end = time.perf_counter()
+                stats.delivered += 1
+                stats.wait_total += start - emitted
+                stats.wait_max = max(stats.wait_max, start - emitted)
+                stats.run_total += end - start
+                stats.run_max = max(stats.run_max, end - start)
+        finally:
+            subscriber.task = None
+
+    def get_stats(self):
+        """ Returns a list with the statistics of each subscriber """
+        return [dict(subscriber.stats.as_dict(), name = subscriber.name, pending = len(subscriber.pending))
+                for subscriber in tuple(self._subscribers.values())]
@@ -0,0 +1,135 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import base64
+import json
+import logging
+import logging.handlers
+import queue
+
+
+class _RawQueueHandler(logging.handlers.QueueHandler):
+    """ Puts the records in the queue without formatting them; the trace
+        records only contain immutable data, so the formatting can be
+        done by the listener thread """
+
+    def prepare(self, record):
+        return record
+
+
+class PacketFormatter(logging.Formatter):
+    """ Formats a trace record as a line of JSON """
+
+    def __init__(self, max_payload = 4096):
+        super().__init__()
+        self._max_payload = max_payload
+
+    def format(self, record):
+        payload = record.payload
+        data = {
+            "time": round(record.created, 6),
+            "robot": record.robot,
+            "direction": record.direction,
+            "header": [f"0x{value:08x}" for value in record.header],
+            "size": len(payload)
+        }
+        if len(payload) > self._max_payload:
+            payload = payload[:self._max_payload]
+            data["truncated"] = True
+        if len(payload) != 0:
+            try:
+                data["payload"] = payload.decode('utf8')
+            except UnicodeDecodeError:
+                data["payload_base64"] = base64.b64encode(payload).decode('ascii')
+        return json.dumps(data)
+
+
+class PacketTrace(object):
+    """ Writes the packets exchanged with the robots to a JSONL file.
+
+        It is off by default, and can be enabled for all the robots or only
+        for some of them. The records are put in a queue, and a thread
+        formats and writes them, so, with the trace disabled, the only
+        cost in the event loop is is_enabled() """
+
+    def __init__(self):
+        super().__init__()
+        self._robots = set()
+        self._all = False
+        self._filename = None
+        self._max_payload = 4096
+        self._listener = None
+        self._logger = logging.getLogger("congaserver.packets")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.DEBUG)
+
+    def configure(self, filename, robots = "", max_payload = 4096):
+        """ robots is a comma-separated list of robot identifiers, or 'all' """
+        self._filename = filename
+        self._max_payload = max_payload
+        for robot_id in robots.split(","):
+            robot_id = robot_id.strip()
+            if robot_id != "":
+                self.enable(robot_id)
+
+    def enable(self, robot_id = None):
+        """ Enables the trace for a robot, or for all if robot_id is None or 'all' """
+        if (robot_id is None) or (robot_id == "all"):
+            self._all = True
+        else:
+            self._robots.add(robot_id)
+        self._start()
+
+    def disable(self, robot_id = None):
+        """ Disables the trace for a robot, or for all if robot_id is None or 'all' """
+        if (robot_id is None) or (robot_id == "all"):
+            self._all = False
+            self._robots.clear()
+        else:
+            self._robots.discard(robot_id)
+
+    def is_enabled(self, robot_id):
+        return self._all or (robot_id in self._robots)
+
+    def trace(self, robot_id, direction, header, payload):
+        """ Adds a packet to the trace. direction is 'in' or 'out', header is
+            the tuple with the five values and payload a bytes object """
+        self._logger.debug("packet", extra = {"robot": robot_id, "direction": direction, "header": header, "payload": payload})
+
+    def _start(self):
+        if self._listener is not None:
+            return
+        if self._filename is None:
+            logging.error("Packet trace enabled, but there is no trace file configured")
+            return
+        records = queue.SimpleQueue()
+        handler = logging.FileHandler(self._filename)
+        handler.setFormatter(PacketFormatter(self._max_payload))
+        self._listener = logging.handlers.QueueListener(records, handler)
+        self._logger.addHandler(_RawQueueHandler(records))
+        self._listener.start()
+        logging.info(f"Packet trace written to {self._filename}")
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
+            for handler in list(self._logger.handlers):
+                self._logger.removeHandler(handler)
+
+packet_trace = PacketTrace()
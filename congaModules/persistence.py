@@ -0,0 +1,256 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import asyncio
+import concurrent.futures
+import configparser
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+
+# values accepted as true by _getPersistentBoolean, like configparser does
+BOOLEAN_STATES = {'1': True, 'yes': True, 'true': True, 'on': True,
+                  '0': False, 'no': False, 'false': False, 'off': False}
+
+
+class IniBackend(object):
+    """ Stores the properties of each robot in its own data_<id>.ini file,
+        with a section named like the robot (the original format) """
+
+    def __init__(self, path):
+        super().__init__()
+        self._path = path
+
+    def _get_filename(self, robot_id):
+        return os.path.join(self._path, f"data_{robot_id}.ini")
+
+    def load(self, robot_id):
+        config = configparser.ConfigParser(interpolation = None)
+        filename = self._get_filename(robot_id)
+        if os.path.exists(filename):
+            config.read(filename)
+        if robot_id not in config:
+            return {}
+        return dict(config[robot_id])
+
+    def save(self, robot_id, values):
+        """ Replaces the file atomically, so a power cut never leaves it half written """
+        config = configparser.ConfigParser(interpolation = None)
+        config[robot_id] = values
+        filename = self._get_filename(robot_id)
+        descriptor, temporary = tempfile.mkstemp(dir = self._path, prefix = f".data_{robot_id}.", suffix = ".tmp")
+        try:
+            with os.fdopen(descriptor, "w") as configfile:
+                config.write(configfile)
+                configfile.flush()
+                os.fsync(configfile.fileno())
+            os.replace(temporary, filename)
+        except:
+            os.unlink(temporary)
+            raise
+        try:
+            directory = os.open(self._path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(directory)
+        except OSError:
+            pass
+        finally:
+            os.close(directory)
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(object):
+    """ Stores the properties of all the robots in a single SQLite database.
+        The properties of a robot that isn't in the database yet are imported
+        from its ini file, if there is one.
+
+        The database is in WAL mode, and the reads (done in the main loop) use
+        their own connection, so they never wait for a write in progress """
+
+    def __init__(self, path, filename = "robots.sqlite3"):
+        super().__init__()
+        self._ini = IniBackend(path)
+        self._lock = threading.Lock()
+        filename = os.path.join(path, filename)
+        self._db = sqlite3.connect(filename, check_same_thread = False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS properties (robot TEXT NOT NULL, key TEXT NOT NULL, "
+                             "value TEXT NOT NULL, PRIMARY KEY (robot, key))")
+        self._reader = sqlite3.connect(filename)
+
+    def load(self, robot_id):
+        rows = self._reader.execute("SELECT key, value FROM properties WHERE robot = ?", (robot_id,)).fetchall()
+        if len(rows) == 0:
+            return self._ini.load(robot_id)
+        return dict(rows)
+
+    def save(self, robot_id, values):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM properties WHERE robot = ?", (robot_id,))
+            self._db.executemany("INSERT INTO properties (robot, key, value) VALUES (?, ?, ?)",
+                                 [(robot_id, key, value) for key, value in values.items()])
+
+    def close(self):
+        self._reader.close()
+        with self._lock:
+            self._db.close()
+
+
+class RobotProperties(object):
+    """ The persistent properties of a robot: pairs of strings, with the keys
+        in lowercase. They are read the first time they are needed, and the
+        changes are written by the store in the background. defaults contains
+        the values of the properties that haven't been set """
+
+    def __init__(self, store, robot_id, defaults):
+        super().__init__()
+        self._store = store
+        self._robot_id = robot_id
+        self._defaults = defaults
+        self._values = None
+
+    def _get_values(self):
+        if self._values is None:
+            self._values = self._store.load(self._robot_id)
+        return self._values
+
+    def __contains__(self, key):
+        key = key.lower()
+        return (key in self._get_values()) or (key in self._defaults)
+
+    def get(self, key, default = None):
+        key = key.lower()
+        values = self._get_values()
+        if key in values:
+            return values[key]
+        return self._defaults.get(key, default)
+
+    def get_all(self):
+        data = dict(self._defaults)
+        data.update(self._get_values())
+        return data
+
+    def set(self, key, value):
+        values = self._get_values()
+        values[key.lower()] = str(value)
+        self._store.save(self._robot_id, values)
+
+
+class PersistentStore(object):
+    """ Reads and writes the persistent properties of the robots. The writes
+        are delayed 'delay' seconds, so several changes in a row (and changes
+        in several robots) are written together, and done in a thread, so the
+        main loop never waits for the disk.
+
+        Backends:
+          "ini": a data_<id>.ini file per robot
+          "sqlite": a single robots.sqlite3 database for all the robots """
+
+    BACKENDS = ("ini", "sqlite")
+
+    def __init__(self):
+        super().__init__()
+        self._backend = None
+        self._path = None
+        self._delay = 2
+        self._pending = {}
+        self._timer = None
+        self._writing = None
+        # the values being written by _writing
+        self._written_values = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "persistence")
+
+    def configure(self, backend = "ini", path = None, delay = 2):
+        if backend not in self.BACKENDS:
+            logging.error(f"Unknown persistence backend {backend}; using 'ini'")
+            backend = "ini"
+        if path is not None:
+            self._path = path
+        self.flush_now()
+        if self._backend is not None:
+            self._backend.close()
+        if backend == "sqlite":
+            self._backend = SQLiteBackend(self._path)
+        else:
+            self._backend = IniBackend(self._path)
+        self._delay = max(0, delay)
+
+    def get_properties(self, robot_id, defaults):
+        return RobotProperties(self, robot_id, defaults)
+
+    def load(self, robot_id):
+        if robot_id in self._pending:
+            return dict(self._pending[robot_id])
+        if robot_id in self._written_values:
+            return dict(self._written_values[robot_id])
+        return self._backend.load(robot_id)
+
+    def save(self, robot_id, values):
+        """ Schedules writing the values. values is stored by reference, so the
+            latest changes are written even if they are done after calling this """
+        self._pending[robot_id] = values
+        if (self._timer is None) and (self._writing is None):
+            self._timer = asyncio.get_running_loop().call_later(self._delay, self._flush)
+
+    def _flush(self):
+        self._timer = None
+        pending = {robot_id: dict(values) for robot_id, values in self._pending.items()}
+        self._pending = {}
+        self._written_values = pending
+        self._writing = asyncio.get_running_loop().run_in_executor(self._executor, self._write, pending)
+        self._writing.add_done_callback(self._written)
+
+    def _written(self, future):
+        self._writing = None
+        self._written_values = {}
+        if len(self._pending) != 0:
+            # changes done while writing the previous ones
+            self._timer = asyncio.get_running_loop().call_later(self._delay, self._flush)
+
+    def _write(self, pending):
+        for robot_id, values in pending.items():
+            try:
+                self._backend.save(robot_id, values)
+            except Exception as e:
+                logging.error(f"Failed to store the properties of {robot_id}: {e}")
+
+    def flush_now(self):
+        """ Writes the pending changes, waiting for them to be stored """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # the write in progress, if any, is done before the next one, since the executor has one thread
+        pending = {robot_id: dict(values) for robot_id, values in self._pending.items()}
+        self._pending = {}
+        if len(pending) != 0:
+            self._executor.submit(self._write, pending).result()
+
+    def close(self):
+        self.flush_now()
+        self._executor.shutdown(wait = True)
+        if self._backend is not None:
+            self._backend.close()
+            self._backend = None
+
+
+persistent_store = PersistentStore()
@@ -0,0 +1,54 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+from collections import OrderedDict
+
+
+class RenderCache(object):
+    """ LRU cache for rendered pictures. Entries are evicted when there are
+        more than max_entries, or when the stored bytes exceed max_bytes """
+
+    def __init__(self, max_entries = 8, max_bytes = 4 * 1024 * 1024):
+        super().__init__()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+
+    def get(self, key):
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self._max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._entries[key] = data
+        self._size += len(data)
+        while (len(self._entries) > self._max_entries) or (self._size > self._max_bytes):
+            key, old = self._entries.popitem(last=False)
+            self._size -= len(old)
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
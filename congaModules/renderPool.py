@@ -0,0 +1,89 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+
+from .mapRenderer import paint_map_png_timed
+from .metrics import metrics
+
+
+class RenderPool(object):
+    """ Runs the map painting and the PNG encoding outside the event loop.
+
+        Modes:
+          "inline": paint in the event loop (the old behaviour)
+          "thread": use a pool of threads (PIL releases the GIL while encoding)
+          "process": use a pool of processes """
+
+    MODES = ("inline", "thread", "process")
+
+    def __init__(self):
+        super().__init__()
+        self._executor = None
+        self._mode = "inline"
+        self._workers = 0
+        self.compress_level = 6
+        self.optimize = False
+
+    def configure(self, mode = "thread", workers = 2, compress_level = 6, optimize = False):
+        if mode not in self.MODES:
+            logging.error(f"Unknown render mode {mode}; using 'thread'")
+            mode = "thread"
+        self.close()
+        self._mode = mode
+        self._workers = max(1, workers)
+        self.compress_level = compress_level
+        self.optimize = optimize
+        if mode == "thread":
+            self._executor = concurrent.futures.ThreadPoolExecutor(self._workers, thread_name_prefix = "render")
+        elif mode == "process":
+            if "fork" in multiprocessing.get_all_start_methods():
+                # congaserver.py is not import-safe, so the workers must not re-import it
+                context = multiprocessing.get_context("fork")
+            else:
+                context = None
+            self._executor = concurrent.futures.ProcessPoolExecutor(self._workers, mp_context = context)
+        logging.info(f"Map render mode: {mode}, {self._workers} workers")
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait = False)
+            self._executor = None
+        self._mode = "inline"
+
+    async def paint_map(self, mapData, trackData, chargerPos, width, height, canvas = None):
+        """ Returns the PNG data with the map. If a MapCanvas is passed, it is
+            used to paint only what changed since the last call; canvases
+            can't be shared with other processes, so in "process" mode
+            the whole map is painted every time """
+        if (canvas is not None) and (self._mode != "process"):
+            function = canvas.paint_png_timed
+        else:
+            function = paint_map_png_timed
+        if self._executor is None:
+            result = function(mapData, trackData, chargerPos, width, height, self.compress_level, self.optimize)
+        else:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._executor, function, mapData, trackData, chargerPos,
+                                                width, height, self.compress_level, self.optimize)
+        # the times are measured by the worker, since it can be another process
+        metrics.observe_render(result[1], result[2], result[3])
+        return result[0]
+
+render_pool = RenderPool()
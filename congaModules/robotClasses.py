@@ -16,33 +16,118 @@
 
 import logging
 import datetime
-import json
 import struct
 import asyncio
-import types
 import traceback
 import sys
 
 from .robotManager import robot_manager
 from .baseServer import BaseServer, BaseConnection
 from .observer import Signal
+from .packetTrace import packet_trace
+from .robotMessage import RobotMessage, PING, IDENTIFICATION, STATUS, ACK, MAP, ERROR, UNKNOWN
+from .robotCommands import robot_commands, CommandError, encode_control, encode_body, SCRIPT, BACKGROUND
+from .commandQueue import CommandQueue
+from .jsonBackend import json_backend
+from .metrics import metrics
+
+# length, and four values whose meaning depends on the packet
+HEADER_STRUCT = struct.Struct("<LLLLL")
+
+PACKET_ACK_PAYLOAD = b'{"msg":"OK","result":0,"version":"1.0"}\n'
+
+# handlers for the packets sent by the robots, indexed by (header[1], header[2], header[4])
+_packet_handlers = {}
+
+
+def packet_handler(kind, value1, value2, value4, length = None):
+    """ Decorator to register a RobotConnection method as the handler of a kind
+        of packet. If length is not None, the packet must have that length too """
+    def register(function):
+        key = (value1, value2, value4)
+        if key in _packet_handlers:
+            raise ValueError(f"There is already a handler for packets {key}")
+        _packet_handlers[key] = (kind, length, function)
+        return function
+    return register
+
+
+def get_packet_handler(header):
+    """ Returns the kind of a packet and the RobotConnection method that manages it """
+    entry = _packet_handlers.get((header[1], header[2], header[4]))
+    if (entry is None) or ((entry[1] is not None) and (entry[1] != header[0])):
+        return UNKNOWN, RobotConnection._unknown_packet
+    return entry[0], entry[2]
+
+
+class InFlightCommand(object):
+    """ A command sent to a robot that is waiting for its ACK. The future
+        receives the ACK message, or None if it never arrives """
+
+    __slots__ = ('packet_id', 'body', 'future', 'retries', 'sent', 'timer')
+
+    def __init__(self, packet_id, body, future, retries, sent):
+        self.packet_id = packet_id
+        self.body = body
+        self.future = future
+        self.retries = retries
+        self.sent = sent
+        self.timer = None
+
 
 class RobotServer(BaseServer):
 
+    def __init__(self):
+        super().__init__()
+        self.ack_timeout = 5
+        self.ack_retries = 1
+        self.command_window = 1
+
+    def configure_commands(self, ack_timeout = 5, ack_retries = 1, command_window = 1):
+        """ Sets the seconds to wait for each ACK, the number of times that a command is
+            resent if its ACK doesn't arrive, and how many commands can wait for their
+            ACKs at the same time (the robots seem to manage only one) """
+        if ack_timeout <= 0:
+            logging.error(f"Invalid ACK timeout {ack_timeout}; using 5")
+            ack_timeout = 5
+        if command_window < 1:
+            logging.error(f"Invalid command window {command_window}; using 1")
+            command_window = 1
+        self.ack_timeout = ack_timeout
+        self.ack_retries = max(0, ack_retries)
+        self.command_window = command_window
+
     async def _handle(self, reader, writer):
         connection = RobotConnection(self._loop, reader, writer)
         await connection.run()
 
+    def _new_connection(self, transport):
+        return RobotConnection(self._loop, None, transport)
+
 class RobotConnection(BaseConnection):
+    """ Manages the connection with a robot.
+
+        There are no long-lived tasks per connection: the commands are run by
+        a task that exists only while the queue has commands, and the manual
+        control by a task that exists only while the robot is being driven.
+        The map refreshes are scheduled by the Robot (see request_map) """
+
     def __init__(self, loop, reader, writer):
         super().__init__(reader, writer)
         logging.info("Connected a new robot")
         self._loop = loop
         self._identified = False
-        self._packet_queue = asyncio.Queue()
-        self._wait_for_ack = asyncio.Event()
+        self._packet_queue = CommandQueue()
+        self._commands_task = None
+        # the metrics of the robot, once it identifies itself
+        self._metrics = metrics.unidentified
+        # commands waiting for their ACK, indexed by packet id
+        self._in_flight = {}
+        self._window_free = asyncio.Event()
+        self._ack_timeout = robot_server.ack_timeout
+        self._ack_retries = robot_server.ack_retries
+        self._command_window = robot_server.command_window
         self._wait_for_status = asyncio.Event()
-        self._wait_for_status2 = asyncio.Event()
         self._packet_id = 1
         self._token = None
         self._deviceId = None
@@ -50,31 +135,24 @@ class RobotConnection(BaseConnection):
         self._authCode = None
         self._deviceIP = None
         self._devicePort = None
+        self._control_prefix = None
         self._end_tasks = False
-        self._waiting_for_command = None
         self.statusUpdate = Signal("status", self)
         self._state = 0
         self._current_direction = 0
         self._desired_direction = 0
-        self._map_counter = 0
         self._manual_event = asyncio.Event()
-        self._loop.create_task(self.execute_commands())
-        self._loop.create_task(self.manual_loop())
-        self._loop.create_task(self.ask_maps())
+        self._manual_task = None
 
 
     async def manual_loop(self):
-        """ Manages the manual control of the robot """
-
-        params = types.SimpleNamespace()
-        params.command = "108"
-        params.suffix_commands = None
-        params.wait_for_ack = True
+        """ Manages the manual control of the robot. It ends after the robot stops """
 
         while not self._end_tasks:
             try:
                 if self._current_direction == 0:
-                    await self._manual_event.wait()
+                    if not self._manual_event.is_set():
+                        break
                     self._manual_event.clear()
                 else:
                     try:
@@ -83,403 +161,346 @@ class RobotConnection(BaseConnection):
                     except asyncio.TimeoutError:
                         # after 2.2 seconds without receiving calls, stop the robot
                         if self._current_direction != 0:
-                            params.prefix_commands = f'"direction":"5","tag":"{self._current_direction}"'
+                            body = self._manual_body(5, self._current_direction)
                             self._current_direction = 0
                             self._desired_direction = 0
-                            await self._send_packet(params)
+                            await self._send_and_wait(body)
                         continue
                 if self._end_tasks:
                     break
                 if (self._current_direction != 0) and (self._desired_direction != self._current_direction):
                     # changing direction, so first stop the robot
-                    params.prefix_commands = f'"direction":"5","tag":"{self._current_direction}"'
+                    body = self._manual_body(5, self._current_direction)
                     self._current_direction = 0
-                    await self._send_packet(params)
+                    await self._send_and_wait(body)
                 self._current_direction = self._desired_direction
                 if self._current_direction != 0:
-                    params.prefix_commands = f'"direction":"{self._current_direction}"'
-                    await self._send_packet(params)
+                    await self._send_and_wait(self._manual_body(self._current_direction))
             except:
                 traceback.print_exc()
+        self._manual_task = None
 
 
-    async def ask_maps(self):
-        """ Manages asking the map periodically when the robot is working """
+    @staticmethod
+    def _manual_body(direction, tag = None):
+        if tag is None:
+            return encode_body("108", f'"direction":"{direction}"')
+        return encode_body("108", f'"direction":"{direction}","tag":"{tag}"')
 
-        while not self._end_tasks:
-            # when cleaning (1), or returning to base (4 or 9), refresh the status
-            if ((self._state == '1') or (self._state == '4') or (self._state == '9')):
-                if (self._packet_queue.empty()) and (not self._wait_for_ack.is_set()):
-                    if (self._map_counter == 0):
-                        self.send_command("updateMap", {})
-                    self._map_counter += 1
-                    if self._map_counter >= 2:
-                        self._map_counter = 0
-                await asyncio.sleep(1)
-            else:
-                await self._wait_for_status2.wait()
-                self._wait_for_status2.clear()
+
+    def request_map(self):
+        """ Asks the robot for its map. The requests are sent only when there
+            is nothing else to send, and never pile up """
+        if not self._identified:
+            return
+        request = robot_commands.build("updateMap", {})
+        request.priority = BACKGROUND
+        self._queue_command(request)
+
+
+    def _queue_command(self, request):
+        self._packet_queue.push(request)
+        self._run_commands()
+
+
+    def _run_commands(self):
+        if (self._commands_task is None) and (not self._end_tasks):
+            self._commands_task = self._loop.create_task(self.execute_commands())
 
 
     async def execute_commands(self):
+        """ Runs the queued commands. It ends when there are no more commands available """
+        try:
+            await self._execute_commands()
+        finally:
+            self._commands_task = None
+
+
+    async def _execute_commands(self):
         while not self._end_tasks:
-            parameters = await self._packet_queue.get()
-            if parameters is None:
-                self._packet_queue.task_done()
+            request = self._packet_queue.pop()
+            if request is None:
                 break
+            if request.action is None:
+                ack = await self._send_packet(request.body, request.wait_for_ack)
+                if ack is not None:
+                    # the next command can be sent before this ACK arrives if the window allows it
+                    ack.add_done_callback(lambda future, request = request: self._finish_request(request, future.result()))
+                elif self._end_tasks:
+                    request.finish(3, '"Not connected"')
+                else:
+                    request.finish(0, "{}")
+            elif request.action in ('wait', 'waitState'):
+                # the script steps wait for the previous commands to be acknowledged
+                await self._wait_for_window(1)
+                if not self._end_tasks:
+                    self._start_script_step(request)
+            else:
+                self._execute_action(request)
+                request.finish(0, "{}")
 
-            if parameters.command == 'waitState':
-                while ((parameters.state != self._state) and (
-                       (parameters.state != 'home') or
-                       ((self._state != '5') and (self._state != '6') and (self._state != '10')))):
-                    print(f"Waiting for state {parameters.state}")
-                    await self._wait_for_status.wait()
-                    self._wait_for_status.clear()
 
-            elif parameters.command == 'wait':
-                print(f"Waiting {parameters.seconds} seconds")
-                await asyncio.sleep(parameters.seconds)
+    def _finish_request(self, request, ack):
+        if self._end_tasks:
+            request.finish(3, '"Not connected"')
+        elif ack is None:
+            request.finish(9, '"No ACK from the robot"')
+        elif ack.value is None:
+            request.finish(0, "{}")
+        else:
+            request.finish(0, json_backend.dumps(ack.value))
+
+
+    def _execute_action(self, request):
+        """ Executes a command managed by the server itself """
+        if request.action == 'manual':
+            self._desired_direction = request.argument
+            self._manual_event.set()
+            if self._manual_task is None:
+                self._manual_task = self._loop.create_task(self.manual_loop())
+
+        elif request.action == 'cancelScript':
+            self._packet_queue.cancel_scripts(10, '"Cancelled"')
+
+        elif request.action == 'close':
+            logging.info("Closing connection by command")
+            sys.exit(-1)
+
+
+    def _start_script_step(self, request):
+        """ Runs a 'wait' or 'waitState' step. Only the commands queued after it
+            in the script wait for it to finish; the other ones are still sent """
+        gate = self._loop.create_task(self._script_step(request))
+        self._packet_queue.script_gate = gate
+        gate.add_done_callback(lambda task, request = request: self._script_step_done(request, task))
+
+
+    async def _script_step(self, request):
+        if request.action == 'waitState':
+            state = request.argument
+            while ((not self._end_tasks) and (state != self._state) and (
+                   (state != 'home') or
+                   ((self._state != '5') and (self._state != '6') and (self._state != '10')))):
+                logging.debug("Waiting for state %s", state)
+                await self._wait_for_status.wait()
+                self._wait_for_status.clear()
+        else:
+            logging.debug("Waiting %s seconds", request.argument)
+            await asyncio.sleep(request.argument)
 
-            elif parameters.command == 'manual':
-                self._desired_direction = parameters.direction
-                self._manual_event.set()
 
-            elif parameters.command == 'close':
-                logging.info("Closing connection by command")
-                sys.exit(-1)
-            else: # rest of commands
-                await self._send_packet(parameters)
+    def _script_step_done(self, request, task):
+        if self._packet_queue.script_gate is task:
+            self._packet_queue.script_gate = None
+        if self._end_tasks:
+            request.finish(3, '"Not connected"')
+        elif task.cancelled():
+            request.finish(10, '"Cancelled"')
+        else:
+            request.finish(0, "{}")
+            self._run_commands()
+
 
-            self._packet_queue.task_done()
+    async def _wait_for_window(self, size):
+        """ Waits until there are less than size commands waiting for their ACK """
+        while (not self._end_tasks) and (len(self._in_flight) >= size):
+            self._window_free.clear()
+            await self._window_free.wait()
 
 
-    async def _send_packet(self, parameters):
-        while self._wait_for_ack.is_set():
-            await self._wait_for_ack.wait()
+    async def _send_packet(self, body, wait_for_ack = True):
+        """ Sends a command; body is the encoded data after the control prefix.
+            If it waits for the ACK, returns a future that receives the ACK message
+            (or None if it doesn't arrive); if not, returns None """
+        await self._wait_for_window(self._command_window)
         if self._end_tasks:
-            return
+            return None
         self._packet_id += 1
-        data = '{"cmd":0,"control":{"authCode":"'
-        data += self._authCode
-        data += '","deviceIp":"'
-        data += self._deviceIP
-        data += '","devicePort":"'
-        data += self._devicePort
-        data += '","targetId":"1","targetType":"3"},"seq":0,"value":{'
-        if parameters.prefix_commands is not None:
-            data += parameters.prefix_commands+','
-        data += '"transitCmd":"'
-        data += parameters.command
-        data += '"'
-        if parameters.suffix_commands is not None:
-            data += ','+parameters.suffix_commands
-        data += '}}\n'
-        print(f"Sending command {data}")
-        self._send_binary_packet(0x00c800fa, 0x01090000, self._packet_id, 0x00, data)
-        if parameters.wait_for_ack:
-            self._waiting_for_command = self._packet_id
-            await self._wait_for_ack.wait()
-            self._wait_for_ack.clear()
-
-
-    def send_command(self, command, params):
+        self._send_binary_packet(0x00c800fa, 0x01090000, self._packet_id, 0x00, self._control_prefix + body)
+        if not wait_for_ack:
+            return None
+        command = InFlightCommand(self._packet_id, body, self._loop.create_future(), self._ack_retries, self._loop.time())
+        self._in_flight[command.packet_id] = command
+        command.timer = self._loop.call_later(self._ack_timeout, self._ack_timeout_expired, command)
+        return command.future
+
+
+    async def _send_and_wait(self, body):
+        """ Sends a command and waits for its ACK """
+        ack = await self._send_packet(body)
+        if ack is not None:
+            await ack
+
+
+    def _ack_timeout_expired(self, command):
+        if self._in_flight.get(command.packet_id) is not command:
+            return
+        if command.retries > 0:
+            command.retries -= 1
+            logging.warning("No ACK from %s for packet %d; sending it again", self._deviceId, command.packet_id)
+            self._send_binary_packet(0x00c800fa, 0x01090000, command.packet_id, 0x00, self._control_prefix + command.body)
+            command.timer = self._loop.call_later(self._ack_timeout, self._ack_timeout_expired, command)
+            return
+        logging.warning("No ACK from %s for packet %d; giving up", self._deviceId, command.packet_id)
+        self._metrics.acks_lost += 1
+        self._end_in_flight(command, None)
+
+
+    def _end_in_flight(self, command, ack):
+        del self._in_flight[command.packet_id]
+        if command.timer is not None:
+            command.timer.cancel()
+            command.timer = None
+        if not command.future.done():
+            command.future.set_result(ack)
+        self._window_free.set()
+
+
+    def send_command(self, command, params, wait_ack = False):
+        """ Queues a command. If wait_ack is True, the answer is a future that
+            receives (error, value) once the command has been executed """
         if not self._identified:
             logging.error("Sent a command before the robot has identified itself")
-            return "application/json", 4, "Not identified"
+            return "application/json", 4, '"Not identified"'
+        try:
+            request = robot_commands.build(command, params)
+        except CommandError as e:
+            return "application/json", e.code, e.text
+        if wait_ack:
+            request.future = self._loop.create_future()
+        self._queue_command(request)
+        if wait_ack:
+            return "application/json", 0, request.future
+        return "application/json", 0, "{}"
 
-        parameters = types.SimpleNamespace()
-        parameters.command = None
-        parameters.wait_for_ack = True
-        parameters.prefix_commands = None
-        parameters.suffix_commands = None
 
-        if command == 'wait':
-            if 'seconds' not in params:
-                return "application/json", 6, "Missing parameter (seconds)"
-            try:
-                parameters.seconds = float(params['seconds'])
-            except:
-                return "application/json", 7, "Invalid value for seconds"
-            parameters.command = 'wait'
-        elif command == 'waitState':
-            if 'state' not in params:
-                return "application/json", 6, "Missing parameter (state)"
-            if params['state'] == 'cleaning':
-                parameters.state = '1'
-            elif params['state'] == 'stopped':
-                parameters.state = '2'
-            elif params['state'] == 'returning':
-                parameters.state = '4'
-            elif params['state'] == 'charging':
-                parameters.state = '5'
-            elif params['state'] == 'charged':
-                parameters.state = '6'
-            elif params['state'] == 'home':
-                parameters.state = 'home'
-            else:
-                return "application/json", 7, "Invalid value (valid values are 'cleaning', 'stopped', 'returning', 'charging', 'charged' and 'home'"
-            parameters.command = 'waitState'
-        elif command == 'clean':
-            logging.info("Starting to clean")
-            parameters.command = '100'
-        elif command == 'stop':
-            logging.info("Stopping cleaning")
-            parameters.command = '102'
-        elif command == 'return':
-            logging.info("Returning to base")
-            parameters.command = '104'
-        elif command == 'updateMap':
-            logging.info("Asking map")
-            parameters.command = '131'
-        elif command == 'sound':
-            if "status" not in params:
-                return "application/json", 6, "Missing parameter (status)"
-            if params['status'] == '0':
-                logging.info("Disabling sound")
-                parameters.command = '125'
-            elif params['status'] == '1':
-                logging.info("Enabling sound")
-                parameters.command = '123'
-            else:
-                return "application/json", 7, "Invalid value (valid values are 0 and 1)"
-        elif command == 'fan':
-            parameters.command = '110'
-            if 'speed' not in params:
-                return "application/json", 6, "Missing parameter (speed)"
-            if params['speed'] == '0':
-                parameters.prefix_commands = '"fan":"1"' # OFF
-            elif params['speed'] == '1':
-                parameters.prefix_commands = '"fan":"4"' # ECO
-            elif params['speed'] == '2':
-                parameters.prefix_commands = '"fan":"2"' # NORMAL
-            elif params['speed'] == '3':
-                parameters.prefix_commands = '"fan":"3"' # TURBO
-            else:
-                return "application/json", 7, "Invalid value (valid values are 0, 1, 2 and 3)"
-            logging.info(f"Setting fan to {params['speed']}")
-        elif command == 'watertank':
-            parameters.command = '145'
-            if 'speed' not in params:
-                return "application/json", 6, "Missing parameter (speed)"
-            if params['speed'] == '0':
-                parameters.suffix_commands = '"waterTank":"255"' # OFF
-            elif params['speed'] == '1':
-                parameters.suffix_commands = '"waterTank":"60"' # SMALL
-            elif params['speed'] == '2':
-                parameters.suffix_commands = '"waterTank":"40"' # NORMAL
-            elif params['speed'] == '3':
-                parameters.suffix_commands = '"waterTank":"20"' # FAST
-            else:
-                return "application/json", 7, "Invalid value (valid values are 0, 1, 2 and 3)"
-            logging.info(f"Setting water to {params['speed']}")
-        elif command == 'mode':
-            parameters.command = '106'
-            if 'type' not in params:
-                return "application/json", 6, "Missing parameter (type)"
-            if params['type'] == 'auto':
-                parameters.prefix_commands = '"mode":"11"'
-            elif params['type'] == 'gyro':
-                parameters.prefix_commands = '"mode":"1"'
-            elif params['type'] == 'random':
-                parameters.prefix_commands = '"mode":"3"'
-            elif params['type'] == 'borders':
-                parameters.prefix_commands = '"mode":"4"'
-            elif params['type'] == 'area':
-                parameters.prefix_commands = '"mode":"6"'
-            elif params['type'] == 'x2':
-                parameters.prefix_commands = '"mode":"8"'
-            elif params['type'] == 'scrub':
-                parameters.prefix_commands = '"mode":"10"'
-            else:
-                return "application/json", 7, "Invalid value (valid values are 'auto','giro','random','borders','area','x2','scrub')"
-            logging.info(f"Setting mode to {params['type']}")
-        elif command == 'notifyConnection': # seems to be sent whenever the tablet connects to the server
-            parameters.command = '400'
-            parameters.wait_for_ack = False
-            logging.info("Web client opened")
-        elif command == 'askStatus': # seems to ask the robot to send a Status packet
-            parameters.command = '98'
-            parameters.wait_for_ack = False
-            logging.info("Asking status")
-        elif command == 'goForward':
-            parameters.command = 'manual'
-            parameters.direction = 1
-        elif command == 'goBack':
-            parameters.command = 'manual'
-            parameters.direction = 2
-        elif command == 'turnLeft':
-            parameters.command = 'manual'
-            parameters.direction = 3
-        elif command == 'turnRight':
-            parameters.command = 'manual'
-            parameters.direction = 4
-        elif command == 'stayStill':
-            parameters.command = 'manual'
-            parameters.direction = 0
-        elif command == 'radar':
-            parameters.command = '143'
-        elif command == 'closeConnection':
-            parameters.command = 'close'
-        else:
-            logging.error(f"Unknown command {command}")
-            return "application/json", 5, "Unknown command"
+    def get_device_ip(self):
+        return self._deviceIP
 
-        self._packet_queue.put_nowait(parameters)
-        return "application/json", 0, "{}"
+
+    def send_script(self, commands):
+        """ Queues a list of (command, params) that must be executed in order,
+            even if some of them would have more priority """
+        if not self._identified:
+            logging.error("Sent a script before the robot has identified itself")
+            return
+        try:
+            requests = [robot_commands.build(command, params) for command, params in commands]
+        except CommandError as e:
+            logging.error(f"Invalid script: {e}")
+            return
+        for request in requests:
+            request.priority = SCRIPT
+            self._queue_command(request)
 
 
     def close(self):
-        print("Robot disconnected")
+        if self._closed:
+            return
+        logging.info("Robot disconnected")
         self._identified = False
         self._end_tasks = True
-        self._wait_for_ack.set()
+        for command in list(self._in_flight.values()):
+            self._end_in_flight(command, None)
+        self._window_free.set()
         self._wait_for_status.set()
-        self._wait_for_status2.set()
         self._manual_event.set()
-        self._packet_queue.put_nowait(None)
+        self._packet_queue.clear(3, '"Not connected"')
+        if self._metrics.queue is self._packet_queue:
+            self._metrics.queue = None
         super().close()
 
     def new_data(self):
-        if len(self._data) < 20:
-            return False
-        data_header = self._data[0:20]
-        header = struct.unpack("<LLLLL", self._data[0:20])
-        if len(self._data) < header[0]:
+        frame = self._data.read_frame(HEADER_STRUCT)
+        if frame is None:
             return False
-        payload = self._data[20:header[0]]
-        self._data = self._data[header[0]:]
-        try:
-            header_str = ""
-            c = 0
-            for n in data_header:
-                d = hex(n)[2:]
-                if n < 16:
-                    d = "0"+d
-                header_str += d + " "
-                c += 1
-                if (c%4 == 0) and (c < 20):
-                    header_str += "| "
-            logging.info(f"Received packet with values {header_str}")
-        except:
-            traceback.print_exc()
-
-        # process the packet
-        # PING
-        if self._check_header(header, 0x14, 0x00c80100, 0x01,0x03e7):
-            print("Pong")
-            self._send_binary_packet(0x00c80111, 0x01080001, header[3], 0x03e7)
-            return True
-        # Identification
-        if self._check_header(header, None, 0x0010, 0x0001, 0x00):
-            self._send_payload(payload)
-            self._log_payload(payload, "connection")
-            payload = json.loads(payload)
-            self._token = payload['value']['token']
-            self._deviceId = payload['value']['deviceId']
-            self._appKey = payload['value']['appKey']
-            self._authCode = payload['value']['authCode']
-            self._deviceIP = payload['value']['deviceIp']
-            self._devicePort = payload['value']['devicePort']
-            robot_manager.get_robot(self._deviceId).connected(self)
-            self._identified = True
-            now = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-            self._send_binary_packet(0x00c80011, 0x01, header[3], 0x00, '{"msg":"login succeed","result":0,"version":"1.0","time":"'+now+'"}')
-            logging.info(f"Robot identified as {self._deviceId} at IP {self._deviceIP}")
-            return True
-        # Status
-        if self._check_header(header, None, 0x0018, 0x0001, 0x00):
-            print("Status")
-            self._send_binary_packet(0x00c80019, 0x01, header[3], 0x01, '{"msg":"OK","result":0,"version":"1.0"}\n')
-            self._send_payload(payload)
-            self._log_payload(payload, "status")
-            self._wait_for_status.set()
-            self._wait_for_status2.set()
-            return True
-        # ACK
-        if self._check_header(header, None, 0x000000fa, 0x0001, 0x00):
-            if self._waiting_for_command is not None:
-                if header[3] == self._waiting_for_command:
-                    self._send_payload(payload)
-                    self._waiting_for_command = None
-                    self._wait_for_ack.set()
-                    print("ACK fine")
-                else:
-                    print("ACK error")
-            return True
-        # Map
-        if self._check_header(header, None, 0x0014, 0x0001, 0x00):
-            print("Map")
-            self._send_payload(payload)
-            self._log_payload(payload, "map")
-            return True
-        # Error
-        if self._check_header(header, None, 0x0016, 0x0001, 0x00):
-            print("Error")
-            self._log_payload(payload, "error")
-            self._send_binary_packet(0x00c80019, 0x01, header[3], 0x01, '{"msg":"OK","result":0,"version":"1.0"}\n')
-            return True
-        print("Unknown packet")
-        print(header)
-        print(payload)
-        logging.info(f"Unknown packet {header} {payload}")
+        header, payload = frame
+        kind, handler = get_packet_handler(header)
+        robot_metrics = self._metrics
+        robot_metrics.frames[kind] += 1
+        robot_metrics.bytes_in += header[0]
+        message = RobotMessage(kind, header, payload)
+        if packet_trace.is_enabled(self._deviceId):
+            packet_trace.trace(self._deviceId, "in", header, payload)
+        handler(self, message)
         return True
 
-    def _log_payload(self, payload, type):
+    @packet_handler(PING, 0x00c80100, 0x01, 0x03e7, length = 0x14)
+    def _ping_packet(self, message):
+        self._send_binary_packet(0x00c80111, 0x01080001, message.packet_id, 0x03e7)
+
+    @packet_handler(IDENTIFICATION, 0x0010, 0x0001, 0x00)
+    def _identification_packet(self, message):
+        value = message.value
         try:
-            jsonPayload = json.loads(payload)
-        except:
-            print(f'Payload is not a JSON file: "{payload}"')
-            logging.error(f'Payload is not a JSON file: "{payload}"')
+            identification = [value[key] for key in ('token', 'deviceId', 'appKey', 'authCode', 'deviceIp', 'devicePort')]
+        except (KeyError, TypeError):
+            logging.warning("Invalid identification packet: %s", message.payload)
             return
-        logging.info(f"New {type}: {json.dumps(jsonPayload, sort_keys=True, indent=4)}\n\n")
+        self._update_status(message)
+        traced = packet_trace.is_enabled(self._deviceId)
+        self._token, self._deviceId, self._appKey, self._authCode, self._deviceIP, self._devicePort = identification
+        self._control_prefix = encode_control(self._authCode, self._deviceIP, self._devicePort)
+        if (not traced) and packet_trace.is_enabled(self._deviceId):
+            # the identification arrived before knowing which robot was this
+            packet_trace.trace(self._deviceId, "in", message.header, message.payload)
+        self._metrics = metrics.get_robot(self._deviceId)
+        self._metrics.queue = self._packet_queue
+        robot_manager.get_robot(self._deviceId).connected(self)
+        self._identified = True
+        now = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+        self._send_binary_packet(0x00c80011, 0x01, message.packet_id, 0x00, '{"msg":"login succeed","result":0,"version":"1.0","time":"'+now+'"}')
+        logging.info(f"Robot identified as {self._deviceId} at IP {self._deviceIP}")
+
+    @packet_handler(STATUS, 0x0018, 0x0001, 0x00)
+    def _status_packet(self, message):
+        self._send_binary_packet(0x00c80019, 0x01, message.packet_id, 0x01, PACKET_ACK_PAYLOAD)
+        self._update_status(message)
+        self._wait_for_status.set()
 
-    def _send_payload(self, payload):
-        if len(payload) == 0:
+    @packet_handler(ACK, 0x000000fa, 0x0001, 0x00)
+    def _ack_packet(self, message):
+        command = self._in_flight.get(message.packet_id)
+        if command is None:
+            # late ACKs, or ACKs for commands that don't wait for them
+            logging.debug("ACK with unknown id %d from %s", message.packet_id, self._deviceId)
             return
-        try:
-            jsonPayload = json.loads(payload)
-        except:
-            print(f'Payload is not a JSON file: "{payload}"')
+        latency = self._loop.time() - command.sent
+        self._metrics.ack_latency.observe(latency)
+        logging.debug("ACK from %s for packet %d after %.1f ms", self._deviceId, message.packet_id, latency * 1000)
+        self._update_status(message)
+        self._end_in_flight(command, message)
+
+    @packet_handler(MAP, 0x0014, 0x0001, 0x00)
+    def _map_packet(self, message):
+        self._update_status(message)
+
+    @packet_handler(ERROR, 0x0016, 0x0001, 0x00)
+    def _error_packet(self, message):
+        logging.warning("Error packet from %s: %s", self._deviceId, message.payload)
+        self._send_binary_packet(0x00c80019, 0x01, message.packet_id, 0x01, PACKET_ACK_PAYLOAD)
+
+    def _unknown_packet(self, message):
+        logging.warning("Unknown packet from %s: %s %s", self._deviceId, message.header, message.payload)
+
+    def _update_status(self, message):
+        """ Keeps track of the work state, and notifies the new values """
+        value = message.value
+        if not isinstance(value, dict):
             return
 
-        if ('value' in jsonPayload) and ('workState' in jsonPayload['value']):
-            old_state = self._state
-            self._state = jsonPayload['value']['workState']
-            if (old_state != self._state) and ((self._state == "1") or (self._state == "4") or (self._state == "9")):
-                self._map_counter = 0
+        if 'workState' in value:
+            self._state = value['workState']
 
-        self.statusUpdate.emit(jsonPayload)
-
-    def _check_header(self, header, value0, value1, value2, value4):
-        if (value0 is not None) and (value0 != header[0]):
-            return False
-        if (value1 is not None) and (value1 != header[1]):
-            return False
-        if (value2 is not None) and (value2 != header[2]):
-            return False
-        if (value4 is not None) and (value4 != header[4]):
-            return False
-        return True
+        self.statusUpdate.emit(message)
 
     def _send_binary_packet(self, value1, value2, packet_id, value3, data = b""):
-        logging.info(f"Sending packet with id {hex(packet_id)}")
         if isinstance(data, str):
             data = data.encode('utf8')
-        header = bytearray(struct.pack("<LLLLL", 20 + len(data), value1, value2, packet_id, value3))
-        self._writer.write(header + data)
-        # data2 = struct.unpack("BBBBBBBBBBBBBBBBBBBB", header)
-        # c = 0
-        # for n in data2:
-        #     d = hex(n)[2:]
-        #     if n < 16:
-        #         d = "0"+d
-        #     print(d + " ", end="")
-        #     c += 1
-        #     if (c%4 == 0) and (c < 20):
-        #         print("| ", end="")
-        # print()
-        # if len(data) > 0:
-        #     print("    '"+ data.decode('utf8').replace('\n','\\n\n    ').replace('\r','\\r') + "'")
-        # print()
+        header = HEADER_STRUCT.pack(20 + len(data), value1, value2, packet_id, value3)
+        self._writer.writelines((header, data))
+        self._metrics.bytes_out += 20 + len(data)
+        if packet_trace.is_enabled(self._deviceId):
+            packet_trace.trace(self._deviceId, "out", (20 + len(data), value1, value2, packet_id, value3), data)
 
 robot_server = RobotServer()
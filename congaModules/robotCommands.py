@@ -0,0 +1,217 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import json
+import logging
+
+# where a parameter is put in the "value" object of the packet: before or after "transitCmd"
+PREFIX = "prefix"
+SUFFIX = "suffix"
+# the parameter selects the transit code itself
+TRANSIT = "transit"
+
+# priorities of the commands; see CommandQueue
+URGENT = 0
+NORMAL = 1
+SCRIPT = 2
+BACKGROUND = 3
+
+
+class CommandError(Exception):
+    """ A command can't be sent; code is the error returned to the HTTP client,
+        and text the message, already encoded as JSON """
+
+    def __init__(self, code, text):
+        super().__init__(text)
+        self.code = code
+        self.text = json.dumps(text)
+
+
+def encode_control(authCode, deviceIp, devicePort):
+    """ Returns the start of the command packets for a robot, up to the "value" object """
+    control = f'"authCode":{json.dumps(authCode)},"deviceIp":{json.dumps(deviceIp)},"devicePort":{json.dumps(devicePort)}'
+    return ('{"cmd":0,"control":{' + control + ',"targetId":"1","targetType":"3"},"seq":0,"value":{').encode('utf8')
+
+
+def encode_body(transit, prefix = None, suffix = None):
+    """ Returns the rest of a command packet, after the control data. prefix and suffix
+        are already encoded "key":"value" pairs """
+    body = f'"transitCmd":"{transit}"'
+    if prefix is not None:
+        body = prefix + ',' + body
+    if suffix is not None:
+        body += ',' + suffix
+    return (body + '}}\n').encode('utf8')
+
+
+class Parameter(object):
+    """ A parameter of a command. If values is not None, it maps the values accepted
+        from the HTTP clients into the values sent to the robot; if convert is not
+        None, it is called to convert the value. If key is not None, the value is
+        sent to the robot in the "value" object with that key, in the position
+        given by position (PREFIX, SUFFIX or TRANSIT) """
+
+    def __init__(self, name, values = None, key = None, position = PREFIX, convert = None):
+        super().__init__()
+        self.name = name
+        self.values = values
+        self.key = key
+        self.position = position
+        self.convert = convert
+
+    def parse(self, params):
+        if self.name not in params:
+            raise CommandError(6, f"Missing parameter ({self.name})")
+        value = params[self.name]
+        if self.values is not None:
+            if value not in self.values:
+                valid = [str(entry) for entry in self.values]
+                raise CommandError(7, f"Invalid value for {self.name} (valid values are {', '.join(valid[:-1])} and {valid[-1]})")
+            return self.values[value]
+        if self.convert is not None:
+            try:
+                return self.convert(value)
+            except (TypeError, ValueError):
+                raise CommandError(7, f"Invalid value for {self.name}")
+        return value
+
+
+class CommandRequest(object):
+    """ A command ready to be queued. If action is None, body contains the data to
+        send to the robot; if not, it is a command executed by the server itself
+        ('wait', 'waitState', 'manual', 'close' or 'cancelScript') and argument is its value.
+        Queued commands with the same coalesce key replace each other.
+
+        If future is not None, it receives a tuple (error, value) once the command
+        has been executed (and acknowledged by the robot, if it waits for an ACK),
+        with value encoded as JSON """
+
+    __slots__ = ('name', 'action', 'body', 'wait_for_ack', 'argument', 'priority', 'coalesce', 'future')
+
+    def __init__(self, name, action, body, wait_for_ack, argument = None, priority = NORMAL, coalesce = None):
+        self.name = name
+        self.action = action
+        self.body = body
+        self.wait_for_ack = wait_for_ack
+        self.argument = argument
+        self.priority = priority
+        self.coalesce = coalesce
+        self.future = None
+
+    def finish(self, error, value):
+        if (self.future is not None) and (not self.future.done()):
+            self.future.set_result((error, value))
+
+
+class Command(object):
+    """ A command accepted in the robot/<id>/<command> URIs. If coalesce is True,
+        a queued command is replaced by a newer one with the same name """
+
+    def __init__(self, name, transit = None, parameters = (), wait_for_ack = True, action = None, argument = None, log = None,
+                 priority = NORMAL, coalesce = False):
+        super().__init__()
+        self.name = name
+        self.transit = transit
+        self.parameters = parameters
+        self.wait_for_ack = wait_for_ack
+        self.action = action
+        self.argument = argument
+        self.log = log
+        self.priority = priority
+        self.coalesce = name if coalesce else None
+        # the packets for each combination of values are encoded only once
+        self._bodies = {}
+
+    def build(self, params):
+        values = tuple(parameter.parse(params) for parameter in self.parameters)
+        if self.log is not None:
+            logging.info(self.log.format(**params))
+        if self.action is not None:
+            argument = values[0] if len(values) != 0 else self.argument
+            return CommandRequest(self.name, self.action, None, self.wait_for_ack, argument, self.priority, self.coalesce)
+        body = self._bodies.get(values)
+        if body is None:
+            body = self._encode(values)
+            self._bodies[values] = body
+        return CommandRequest(self.name, None, body, self.wait_for_ack, None, self.priority, self.coalesce)
+
+    def _encode(self, values):
+        transit = self.transit
+        prefix = []
+        suffix = []
+        for parameter, value in zip(self.parameters, values):
+            if parameter.position == TRANSIT:
+                transit = value
+            elif parameter.key is not None:
+                pair = f'{json.dumps(parameter.key)}:{json.dumps(value)}'
+                if parameter.position == PREFIX:
+                    prefix.append(pair)
+                else:
+                    suffix.append(pair)
+        return encode_body(transit, ','.join(prefix) if prefix else None, ','.join(suffix) if suffix else None)
+
+
+class CommandRegistry(object):
+    """ The commands that can be sent to the robots """
+
+    def __init__(self):
+        super().__init__()
+        self._commands = {}
+
+    def add(self, name, **kwargs):
+        self._commands[name] = Command(name, **kwargs)
+
+    def build(self, name, params):
+        """ Returns a CommandRequest, or raises CommandError """
+        command = self._commands.get(name)
+        if command is None:
+            logging.error(f"Unknown command {name}")
+            raise CommandError(5, "Unknown command")
+        return command.build(params)
+
+
+robot_commands = CommandRegistry()
+
+robot_commands.add('wait', action = 'wait', priority = SCRIPT, parameters = [Parameter('seconds', convert = float)])
+robot_commands.add('waitState', action = 'waitState', priority = SCRIPT, parameters = [
+    Parameter('state', {'cleaning': '1', 'stopped': '2', 'returning': '4', 'charging': '5', 'charged': '6', 'home': 'home'})])
+robot_commands.add('clean', transit = '100', log = "Starting to clean")
+robot_commands.add('stop', transit = '102', priority = URGENT, log = "Stopping cleaning")
+robot_commands.add('return', transit = '104', priority = URGENT, log = "Returning to base")
+robot_commands.add('updateMap', transit = '131', coalesce = True)
+robot_commands.add('sound', coalesce = True, parameters = [Parameter('status', {'0': '125', '1': '123'}, position = TRANSIT)],
+                   log = "Setting sound to {status}")
+robot_commands.add('fan', transit = '110', coalesce = True, log = "Setting fan to {speed}", parameters = [
+    # OFF, ECO, NORMAL and TURBO
+    Parameter('speed', {'0': '1', '1': '4', '2': '2', '3': '3'}, key = 'fan', position = PREFIX)])
+robot_commands.add('watertank', transit = '145', coalesce = True, log = "Setting water to {speed}", parameters = [
+    # OFF, SMALL, NORMAL and FAST
+    Parameter('speed', {'0': '255', '1': '60', '2': '40', '3': '20'}, key = 'waterTank', position = SUFFIX)])
+robot_commands.add('mode', transit = '106', coalesce = True, log = "Setting mode to {type}", parameters = [
+    Parameter('type', {'auto': '11', 'gyro': '1', 'random': '3', 'borders': '4', 'area': '6', 'x2': '8', 'scrub': '10'},
+              key = 'mode', position = PREFIX)])
+# seems to be sent whenever the tablet connects to the server
+robot_commands.add('notifyConnection', transit = '400', wait_for_ack = False, log = "Web client opened")
+# seems to ask the robot to send a Status packet
+robot_commands.add('askStatus', transit = '98', wait_for_ack = False, log = "Asking status")
+robot_commands.add('goForward', action = 'manual', argument = 1, priority = URGENT)
+robot_commands.add('goBack', action = 'manual', argument = 2, priority = URGENT)
+robot_commands.add('turnLeft', action = 'manual', argument = 3, priority = URGENT)
+robot_commands.add('turnRight', action = 'manual', argument = 4, priority = URGENT)
+robot_commands.add('stayStill', action = 'manual', argument = 0, priority = URGENT)
+robot_commands.add('radar', transit = '143')
+robot_commands.add('closeConnection', action = 'close', priority = URGENT)
+robot_commands.add('cancelScript', action = 'cancelScript', priority = URGENT, log = "Cancelling script")
@@ -14,270 +14,494 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
-import configparser
+import asyncio
+import collections
+import itertools
 import json
+import logging
 import os
+import time
 import traceback
 
-from PIL import Image, ImageDraw
-import io
-import base64
-
-from .observer import Signal
+from .observer import Signal, AsyncSignal
+from .renderPool import render_pool
+from .mapRenderer import MapCanvas
+from .renderCache import RenderCache
+from .packetTrace import packet_trace
+from .mapRefresh import MapRefreshPolicy, map_refresh_limiter, WORKING_STATES
+from .persistence import persistent_store, BOOLEAN_STATES
+from .metrics import metrics
+from .statusRecord import StatusRecord, STATUS_KEYS, LARGE_KEYS
 from init import running_in_docker
 
+# makes the map ETags and the status versions different after each server restart
+SERVER_EPOCH = f"{int(time.time()):x}"
+
+# the entries sent in a status delta when no fields are specified
+DELTA_KEYS = tuple(key for key in STATUS_KEYS if key not in LARGE_KEYS)
+
+# values of the persistent properties that haven't been set
+PROPERTY_DEFAULTS = {
+    'water': '0',
+    'fan': '2',
+    'mode': '0',
+    'battery_guard_enabled': '1',
+    'battery_guard_level': '80',
+    'battery_guard_times': '3',
+    'map_refresh_active': '2',
+    'map_refresh_max': '8',
+    'map_refresh_idle': '30',
+}
+
 
 class RobotManager(object):
-    def __init__(self, config_path):
+    """ Registry of the robots. A Robot is created when it contacts the server,
+        and is kept while it is connected; the disconnected ones are kept in
+        an idle cache, and the least recently used ones are forgotten when
+        there are more than max_idle (unless someone is listening to them).
+
+        The robots are indexed by IP, work state and error code; the indexes
+        are kept up to date with the status changes of each robot """
+
+    # secondary indexes, and the function that returns the value of each robot
+    INDEXES = {
+        'ip': lambda robot: robot.get_ip(),
+        'state': lambda robot: robot.get_status_value('workState'),
+        'error': lambda robot: robot.get_status_value('errorCode'),
+    }
+
+    def __init__(self, max_idle = 256):
         super().__init__()
         self._robots = {} # contains Robot objects, one per physical robot, identified by the DeviceId
-        self._config_path = config_path
+        self._connected = {} # ids of the connected robots, in connection order
+        self._idle = collections.OrderedDict() # ids of the disconnected robots, the oldest first
+        self._max_idle = max_idle
+        self._indexes = {name: {} for name in self.INDEXES}
+        self._indexed_values = {}
         self.new_robot = Signal('new', self)
+        # the status changes of all the robots, for exporters that must never delay the robots
+        self.robot_events = AsyncSignal('robotEvents', self)
+
+    def configure(self, max_idle = 256):
+        self._max_idle = max(0, max_idle)
+        self._evict_idle()
 
     def get_robot(self, deviceId):
-        if deviceId not in self._robots:
-            self._robots[deviceId] = Robot(deviceId, self._config_path)
+        """ Returns the robot, creating it if it is unknown. Must be called
+            only with the identifiers received from the robots themselves """
+        robot = self._robots.get(deviceId)
+        if robot is None:
+            robot = Robot(deviceId)
+            self._robots[deviceId] = robot
+            self._indexed_values[deviceId] = {}
+            robot.statusChanged.connect(self._robot_changed)
+            self._idle[deviceId] = True
+            self._evict_idle(deviceId)
             self.new_robot.emit(deviceId)
-        return self._robots[deviceId]
+        elif deviceId in self._idle:
+            self._idle.move_to_end(deviceId)
+        return robot
+
+    def find_robot(self, deviceId):
+        """ Like get_robot, but returns None if the robot is unknown """
+        return self._robots.get(deviceId)
 
     def get_robot_list(self):
-        l = []
-        for a in self._robots:
-            l.append(a)
-        return l
+        return list(self._robots)
+
+    def get_connected_list(self):
+        return list(self._connected)
+
+    def query(self, connected = None, offset = 0, limit = None, **filters):
+        """ Returns the identifiers of the robots that match all the filters (ip,
+            state or error, using the indexes), and are connected or not (if
+            connected is not None). Filtered results are sorted by identifier """
+        if len(filters) == 0:
+            if connected:
+                robot_ids = self._connected
+            elif connected is None:
+                robot_ids = self._robots
+            else:
+                robot_ids = self._idle
+        else:
+            sets = []
+            for name, value in filters.items():
+                if name not in self._indexes:
+                    raise KeyError(name)
+                sets.append(self._indexes[name].get(value, ()))
+            sets.sort(key = len)
+            matches = set(sets[0]).intersection(*sets[1:])
+            if connected is not None:
+                matches = [robot_id for robot_id in matches if (robot_id in self._connected) == connected]
+            robot_ids = sorted(matches)
+        if limit is None:
+            return list(itertools.islice(robot_ids, offset, None))
+        return list(itertools.islice(robot_ids, offset, offset + limit))
+
+    def _robot_changed(self, name, robot, version, changes):
+        robot_id = robot.get_identifier()
+        self._update_indexes(robot)
+        if robot.is_connected():
+            if robot_id not in self._connected:
+                self._idle.pop(robot_id, None)
+                self._connected[robot_id] = True
+        elif robot_id in self._connected:
+            del self._connected[robot_id]
+            self._idle[robot_id] = True
+            self._evict_idle(robot_id)
+        self.robot_events.emit(robot_id, version, changes)
+
+    def _update_indexes(self, robot):
+        robot_id = robot.get_identifier()
+        values = self._indexed_values[robot_id]
+        for name, getter in self.INDEXES.items():
+            value = getter(robot)
+            if value == '':
+                value = None
+            old = values.get(name)
+            if old == value:
+                continue
+            index = self._indexes[name]
+            if old is not None:
+                index[old].discard(robot_id)
+                if len(index[old]) == 0:
+                    del index[old]
+            if value is not None:
+                index.setdefault(value, set()).add(robot_id)
+            values[name] = value
+
+    def _evict_idle(self, keep = None):
+        """ Forgets the least recently used disconnected robots, except keep """
+        excess = len(self._idle) - self._max_idle
+        if excess <= 0:
+            return
+        for robot_id in list(self._idle):
+            if excess == 0:
+                break
+            robot = self._robots[robot_id]
+            if (robot_id == keep) or robot.has_watchers():
+                continue
+            excess -= 1
+            del self._idle[robot_id]
+            del self._robots[robot_id]
+            robot.statusChanged.disconnect(self._robot_changed)
+            metrics.forget_robot(robot_id)
+            for name, value in self._indexed_values.pop(robot_id).items():
+                if value is not None:
+                    self._indexes[name][value].discard(robot_id)
+                    if len(self._indexes[name][value]) == 0:
+                        del self._indexes[name][value]
 
 
 class Robot(object):
     """ Manages each physical robot """
-    def __init__(self, identifier, config_path):
+    def __init__(self, identifier):
 
         super().__init__()
 
-        self._persistentData = configparser.ConfigParser()
-        self._configFile = os.path.join(config_path, f"data_{identifier}.ini")
-        if os.path.exists(self._configFile):
-            self._persistentData.read(self._configFile)
-        if identifier not in self._persistentData:
-            self._persistentData[identifier] = {}
-
+        self._properties = persistent_store.get_properties(identifier, PROPERTY_DEFAULTS)
         self._identifier = identifier
         self._connection = None
-        self._notecmdValues = {}
-        self._notecmdKeys = ['workState','workMode','fan','direction','brush','battery','voice','error','standbyMode',
-                             'waterTank','clearComponent','waterMark','version','attract','deviceIp','devicePort',
-                             'cleanGoon', 'clearArea','clearTime','clearSign','clearModule','isFinish','chargerPos',
-                             'map','track','errorCode','doTime',
-                             'appKey','deviceType','authCode','funDefine','nonce_str','version','sign']
+        self._status = StatusRecord()
+        self._mapKeys = frozenset(('map', 'track', 'chargerPos'))
+        self._map_version = 0
+        self._render_cache = RenderCache()
+        self._pending_renders = {}
+        self._map_canvas = MapCanvas()
+        self.statusChanged = Signal("statusChanged", self)
         self._modes = ["auto", "gyro", "random", "borders", "area", "x2", "scrub"]
-        self._defPersistent('water', '0')
-        self._defPersistent('fan', '2')
-        self._defPersistent('mode', '0')
-        self._defPersistent('battery_guard_enabled', '1')
-        self._defPersistent('battery_guard_level', '80')
-        self._defPersistent('battery_guard_times', '3')
+        self._map_timer = None
+        self._map_interval = None
+        self._map_change = None
+        self._map_watchers = 0
+        self._map_requested = None
+        # whether the current refresh interval was chosen for a map that someone is watching
+        self._map_watched_interval = False
         self._resetStatus()
 
-    def _defPersistent(self, key, value):
-        if key not in self._persistentData[self._identifier]:
-            self._persistentData[self._identifier][key] = value
-
     def connected(self, connection):
         if self._connection is not None:
-            print("Closing old robot connection and opening a new one")
+            logging.info("Closing old robot connection and opening a new one")
             self._connection.closedSignal.disconnect(self.disconnected)
             self._connection.close()
         self._connection = connection
         connection.closedSignal.connect(self.disconnected)
         connection.statusUpdate.connect(self.statusUpdate)
+        # the answer to getStatus changes (it was 'Not connected'), although no value did
+        self._status.touch()
+        self._status_changed({})
+
+    def is_connected(self):
+        return self._connection is not None
+
+    def has_watchers(self):
+        """ True if there are clients receiving the status changes of this robot """
+        return self._map_watchers != 0
+
+    def get_ip(self):
+        if self._connection is not None:
+            return self._connection.get_device_ip()
+        return self._status.deviceIp
+
+    def get_status_value(self, key):
+        return self._status.get(key)
+
+    def get_identifier(self):
+        return self._identifier
 
     def _resetStatus(self):
-        for key in self._notecmdKeys:
-            self._notecmdValues[key] = ''
+        changes = self._status.reset()
+        self._map_changed()
+        self._status_changed(changes)
         self._current_workState = -1
         self._battery_changes_counter = 0
 
     def disconnected(self, name, connection):
         self._connection = None
         self._resetStatus()
+        self._update_map_timer()
+
+    def get_status(self, compact = False):
+        """ Returns the status as JSON; it is only encoded again after a change """
+        if compact:
+            return self._status.to_compact_json()
+        return self._status.to_json()
+
+    def get_status_values(self):
+        return self._status.as_dict()
+
+    def get_status_etag(self):
+        """ Returns the ETag for the current status, or None if the robot is not connected """
+        if self._connection is None:
+            return None
+        return f'"{SERVER_EPOCH}-s{self._status.revision}"'
+
+    def _update_values(self, values):
+        """ Stores the known keys from values, updates the map version if any
+            of the data used to paint the map has changed, and notifies the
+            changes """
+        changes = self._status.update(values)
+        if len(changes) == 0:
+            return
+        if not self._mapKeys.isdisjoint(changes):
+            self._map_changed()
+        self._status_changed(changes)
+
+    def _status_changed(self, changes):
+        self.statusChanged.emit(self._status.revision, changes)
+
+    def get_status_version(self):
+        return self._status.revision
+
+    def get_status_changes(self, version, keys = None):
+        """ Returns a dictionary with the status entries changed after the
+            specified version, or None if it is not a valid version """
+        return self._status.changed_since(version, keys)
+
+    def get_status_delta(self, since = None, fields = None):
+        """ Returns, as JSON, the status entries changed after the version
+            'since' (all of them if it is None or from a previous server run)
+            and the version to send in the next call. The map and the track
+            are only included if they are in 'fields' """
+        if fields is None:
+            keys = DELTA_KEYS
+        else:
+            keys = [key for key in STATUS_KEYS if key in fields]
+        values = None
+        revision = self._parse_status_version(since)
+        if revision is not None:
+            values = self.get_status_changes(revision, keys)
+        full = values is None
+        if full:
+            values = {key: self._status.get(key) for key in keys}
+        return json.dumps({"version": f"{SERVER_EPOCH}-{self._status.revision}", "full": full, "values": values})
+
+    def _parse_status_version(self, version):
+        if version is None:
+            return None
+        epoch, _, revision = version.rpartition('-')
+        if (epoch != SERVER_EPOCH) or (not revision.isdigit()):
+            return None
+        return int(revision)
+
+    def _map_changed(self):
+        self._map_version += 1
+        self._render_cache.clear()
+
+    def get_map_version(self):
+        return self._map_version
+
+    def watch_map(self):
+        """ Called whenever a client asks for the map """
+        self._map_requested = time.monotonic()
+        self._map_watched()
+
+    def add_map_watcher(self):
+        """ Called when a client starts receiving the status changes, which include the map """
+        self._map_watchers += 1
+        self._map_watched()
+
+    def remove_map_watcher(self):
+        self._map_watchers = max(0, self._map_watchers - 1)
+
+    def _get_map_policy(self):
+        return MapRefreshPolicy(self._getPersistentInteger('map_refresh_active', 2),
+                                self._getPersistentInteger('map_refresh_max', 8),
+                                self._getPersistentInteger('map_refresh_idle', 30))
+
+    def _is_map_watched(self, policy):
+        if self._map_watchers != 0:
+            return True
+        return (self._map_requested is not None) and (time.monotonic() - self._map_requested < policy.watch_timeout)
+
+    def _is_working(self):
+        return (self._connection is not None) and (self._status.workState in WORKING_STATES)
+
+    def _map_watched(self):
+        """ If nobody was watching the map, it was being refreshed slowly
+            (or not at all), so it is refreshed now """
+        if not self._map_watched_interval:
+            self._map_interval = None
+            self._schedule_map_refresh(0)
+
+    def _update_map_timer(self):
+        """ Starts or stops refreshing the map, depending on whether the robot is working """
+        if self._is_working():
+            if self._map_timer is None:
+                self._map_interval = None
+                self._schedule_map_refresh(0)
+        elif self._map_timer is not None:
+            self._map_timer.cancel()
+            self._map_timer = None
+
+    def _schedule_map_refresh(self, delay):
+        if self._map_timer is not None:
+            self._map_timer.cancel()
+            self._map_timer = None
+        if self._is_working():
+            self._map_timer = asyncio.get_running_loop().call_later(delay, self._refresh_map)
+
+    def _refresh_map(self):
+        self._map_timer = None
+        if not self._is_working():
+            return
+        policy = self._get_map_policy()
+        watched = self._is_map_watched(policy)
+        interval = policy.next_interval(self._map_interval, watched, self._map_change)
+        self._map_watched_interval = watched
+        if interval is None:
+            # nobody is watching; watch_map and add_map_watcher start the refreshes again
+            self._map_interval = None
+            return
+        delay = map_refresh_limiter.acquire()
+        if delay != 0:
+            self._map_timer = asyncio.get_running_loop().call_later(delay, self._refresh_map)
+            return
+        self._map_change = None
+        self._map_interval = interval
+        self._connection.request_map()
+        self._map_timer = asyncio.get_running_loop().call_later(interval, self._refresh_map)
+
+    def _get_map_change(self, values):
+        """ Returns how many bytes the map data grew or shrank (at least 1 if it
+            changed), or 0 if it didn't change """
+        change = 0
+        changed = False
+        for key in self._mapKeys:
+            if (key in values) and (values[key] != self._status.get(key)):
+                changed = True
+                change += abs(len(str(values[key])) - len(self._status.get(key)))
+        if changed:
+            return max(change, 1)
+        return 0
+
+    def _get_map_size(self, params):
+        try:
+            w = int(params['width'])
+        except:
+            w = 640
+        try:
+            h = int(params['height'])
+        except:
+            h = 640
+        return w, h
+
+    def get_map_etag(self, params):
+        """ Returns the ETag for the map picture of the specified size,
+            or None if the robot is not connected """
+        if self._connection is None:
+            return None
+        w, h = self._get_map_size(params)
+        return f'"{SERVER_EPOCH}-{self._map_version}-{w}x{h}"'
+
+    async def _paint_map(self, key, width, height):
+        """ Paints the map in the render pool and stores it in the cache """
+        try:
+            data = await render_pool.paint_map(self._status.map, self._status.track,
+                                               self._status.chargerPos, width, height,
+                                               self._map_canvas)
+            if key[0] == self._map_version:
+                self._render_cache.put(key, data)
+            return data
+        finally:
+            del self._pending_renders[key]
+
+    def _get_map(self, width, height):
+        """ Returns the PNG data for the map, or an awaitable that will return it.
+            Simultaneous requests for the same picture share a single render """
+        key = (self._map_version, width, height)
+        data = self._render_cache.get(key)
+        if data is not None:
+            return data
+        if key not in self._pending_renders:
+            self._pending_renders[key] = asyncio.ensure_future(self._paint_map(key, width, height))
+        return asyncio.shield(self._pending_renders[key])
+
+    def send_command(self, command, params, wait_ack = False):
+        """ Returns (content type, error, answer). If wait_ack is True, robot commands
+            answer with a future that receives (error, value) when the robot ACKs them """
+        if command == 'setTrace':
+            # can be enabled before the robot connects, to trace the identification too
+            if params.get('enabled', '1') == '0':
+                packet_trace.disable(self._identifier)
+            else:
+                packet_trace.enable(self._identifier)
+            return "application/json", 0, '"OK"'
 
-    def get_status(self):
-        return json.dumps(self._notecmdValues)
-
-    def _paint_map(self, width, height):
-        data = Image.new('RGB', (width, height))
-        if ('map' in self._notecmdValues) and (len(self._notecmdValues['map']) != 0):
-            mapa = base64.b64decode(self._notecmdValues['map'])
-            track = base64.b64decode(self._notecmdValues['track']) [4:]
-            charger = self._notecmdValues['chargerPos'].split(',')
-            chargerX = int(charger[0])
-            chargerY = int(charger[1])
-
-            mapw = mapa[5] * 256 + mapa[6];
-            maph = mapa[7] * 256 + mapa[8];
-            pixels = []
-            pos = 9
-            repetitions = 0
-
-            minx = chargerX
-            maxx = chargerX
-            miny = chargerY
-            maxy = chargerY
-            index = 0
-            errorCharger = False
-            if ((chargerX == -1) or (chargerY == -1)):
-                errorCharger = True
-
-            while pos < len(mapa):
-                if ((mapa[pos] & 0xc0) == 0xc0):
-                    repetitions *= 64
-                    repetitions += mapa[pos] & 0x3F
-                    pos += 1
-                    continue
-                if (repetitions == 0):
-                    repetitions = 1
-                value = mapa[pos]
-                pos += 1
-                for a in range(repetitions):
-                    mul = 64
-                    for b in range(4):
-                        v = (int(value/mul)) & 0x03
-                        pixels.append(v)
-                        mul /= 4
-                        if (v == 0):
-                            index += 1
-                            continue
-                        x = index % mapw
-                        y = int(index / mapw)
-                        index += 1
-                        if (errorCharger):
-                            minx = x
-                            miny = y
-                            maxx = x
-                            maxy = y
-                            errorCharger = False
-                        else:
-                            if (x < minx):
-                                minx = x
-                            if (y < miny):
-                                miny = y
-                            if (x > maxx):
-                                maxx = x
-                            if (y > maxy):
-                                maxy = y
-                repetitions = 0
-
-            ctx = ImageDraw.Draw(data)
-            pos = minx + miny * mapw
-            ctx.rectangle([(0, 0), (width, height)], fill='#ffffff')
-            if (minx <= maxx):
-                radius1 = width / (maxx - minx + 1)
-                radius2 = height / (maxy - miny + 1)
-
-                if (radius2 < radius1):
-                    radius1 = radius2
-                radius2 = radius1 / 2
-                radius3 = int(radius1 * 0.8); # each point is 20cm wide, and the robot is 32cm wide
-
-                for y in range(miny, maxy+1):
-                    for x in range(minx, maxx+1):
-                        pos = x + mapw * y
-                        if (pixels[pos] == 0):
-                            pos += 1
-                            continue
-                        if pixels[pos] == 1:
-                            # Wall
-                            fillStyle = '#000000'
-                        elif pixels[pos] == 2:
-                            # Floor
-                            fillStyle = '#ffff00'
-
-                        nx = (x - minx) * radius1
-                        ny = (y - miny) * radius1
-                        fr1 = nx + radius1
-                        fr2 = ny + radius1
-                        ctx.rectangle([(nx, ny), (fr1, fr2)], fill=fillStyle)
-                        pos += 1
-                strokeStyle = '#00ffff';
-                # Clean zones
-                points = []
-                isx = True
-                for a in track:
-                    if isx:
-                        x = int((a - minx) * radius1 + radius2)
-                        points.append(x)
-                        isx = False
-                    else:
-                        y = int((a - miny) * radius1 + radius2)
-                        points.append(y)
-                        isx = True
-                        ctx.ellipse([x - radius3, y - radius3, x + radius3, y + radius3], fill=strokeStyle)
-                ctx.line(points, fill=strokeStyle, width=radius3*2)
-
-                # robot position
-                fillStyle = '#ff00ff'
-                strokeStyle = '#000000'
-                self._paint_circle(ctx, x, y, radius2, strokeStyle, fillStyle)
-
-                # charger
-                if ((chargerX != -1) and (chargerY != -1)):
-                    fillStyle = '#00ff00'
-                    strokeStyle = '#000000'
-                    x = (chargerX - minx) * radius1 + radius2
-                    y = (chargerY - miny) * radius1 + radius2
-                    self._paint_circle(ctx, x, y, radius2, strokeStyle, fillStyle)
-
-        f = io.BytesIO()
-        data.save(f, "PNG")
-        return f.getvalue()
-
-    def _paint_circle(self, ctx, x, y, radius, strokeStyle, fillStyle):
-        ctx.ellipse([x - radius, y - radius, x + radius, y + radius], fill = strokeStyle)
-        radius = int(radius/2)
-        ctx.ellipse([x - radius, y - radius, x + radius, y + radius], fill = fillStyle)
-
-    def send_command(self, command, params):
         if self._connection is None:
             return "application/json", 3, '"Not connected"'
 
         if command == 'setStatus':
-            for key in params:
-                if key not in self._notecmdKeys:
-                    continue
-                self._notecmdValues[key] = params[key]
-            return "application/json", 0, self.get_status()
+            self._update_values(params)
+            return "application/json", 0, self.get_status(params.get('compact') == '1')
 
         if command == 'getMap':
-            try:
-                w = int(params['width'])
-            except:
-                w = 640
-            try:
-                h = int(params['height'])
-            except:
-                h = 640
-            return "image/png", 0, self._paint_map(w,h)
+            self.watch_map()
+            w, h = self._get_map_size(params)
+            return "image/png", 0, self._get_map(w, h)
 
         if command == 'getStatus':
-            return "application/json", 0, self.get_status()
+            if ('since' in params) or ('fields' in params):
+                fields = params.get('fields')
+                if fields is not None:
+                    fields = frozenset(fields.split(','))
+                return "application/json", 0, self.get_status_delta(params.get('since'), fields)
+            return "application/json", 0, self.get_status(params.get('compact') == '1')
 
         if command == 'getProperty':
             if 'key' not in params:
-                data = {}
-                for key in self._persistentData[self._identifier]:
-                    data[key] = self._persistentData[self._identifier][key]
-                return "application/json", 0, json.dumps(data)
-            if params['key'] not in self._persistentData[self._identifier]:
+                return "application/json", 0, json.dumps(self._properties.get_all())
+            if params['key'] not in self._properties:
                 return "application/json", 8, f'"Key {params["key"]} does not exist in persistent data"'
-            return "application/json", 0, json.dumps({params["key"]: self._persistentData[self._identifier][params["key"]]})
+            return "application/json", 0, json.dumps({params["key"]: self._properties.get(params["key"])})
 
         if command == 'setProperty':
             if 'key' not in params:
                 return "application/json", 6, '"Missing parameter (key)"'
             if 'value' not in params:
                 return "application/json", 6, '"Missing parameter (value)"'
-            self._persistentData[self._identifier][params['key']] = str(params['value'])
-            with open(self._configFile, 'w') as configfile:
-                self._persistentData.write(configfile)
+            # it is written to disk in the background, after a small delay
+            self._properties.set(params['key'], params['value'])
             return "application/json", 0, '"OK"'
 
         if command == 'setDefaults':
@@ -288,7 +512,7 @@ class Robot(object):
             self._resetBattery()
             return "application/json", 0, '"OK"'
 
-        return self._connection.send_command(command, params)
+        return self._connection.send_command(command, params, wait_ack)
 
 
     def _setDefaults(self):
@@ -301,17 +525,19 @@ class Robot(object):
         self._connection.send_command('mode', {'type': fmode})
 
 
-    def statusUpdate(self, signame, sender, status):
-        """ Called whenever the status changes """
-        if 'value' not in status:
+    def statusUpdate(self, signame, sender, message):
+        """ Called whenever the robot sends new values, with the RobotMessage """
+        value = message.value
+        if not isinstance(value, dict):
             return
-        value = status['value']
 
-        if ('noteCmd' in value) or ('transitCmd' in value):
-            for key in value:
-                if key not in self._notecmdKeys:
-                    continue
-                self._notecmdValues[key] = value[key]
+        if ('noteCmd' not in value) and ('transitCmd' not in value):
+            return
+        if 'map' in value:
+            self._map_change = self._get_map_change(value)
+        self._update_values(value)
+        if 'workState' in value:
+            self._update_map_timer()
 
         if ('workState' in value) and ('battery' in value):
             state = value['workState']
@@ -320,60 +546,51 @@ class Robot(object):
             else:
                 if (self._current_workState == "6") and ((state == "5") or (state == "10")):
                     # changed from "charged" to "charging"
-                    try:
-                        if int(value['battery']) <= self._getPersistentInteger('battery_guard_level', 80):
-                            self._battery_changes_counter += 1
-                            if self._battery_changes_counter >= self._getPersistentInteger('battery_guard_times', 3):
-                                if self._getPersistentBoolean('battery_guard_enabled', True):
-                                    self._resetBattery()
-                    except:
-                        pass
+                    battery = self._status.get_int('battery')
+                    if (battery is not None) and (battery <= self._getPersistentInteger('battery_guard_level', 80)):
+                        self._battery_changes_counter += 1
+                        if self._battery_changes_counter >= self._getPersistentInteger('battery_guard_times', 3):
+                            if self._getPersistentBoolean('battery_guard_enabled', True):
+                                self._resetBattery()
             self._current_workState = state
 
     def _getPersistentString(self, key, default = None):
-        if key not in self._persistentData[self._identifier]:
-            return default
-        else:
-            return self._persistentData[self._identifier][key]
+        return self._properties.get(key, default)
 
     def _getPersistentBoolean(self, key, default_value):
-        try:
-            return self._persistentData[self._identifier].getboolean(key, default_value)
-        except:
-            return default_value
+        return BOOLEAN_STATES.get(str(self._properties.get(key, default_value)).lower(), default_value)
 
     def _getPersistentInteger(self, key, default_value):
         try:
-            return self._persistentData[self._identifier].getint(key, default_value)
+            return int(self._properties.get(key, default_value))
         except:
             return default_value
 
 
     def _resetBattery(self):
         self._battery_changes_counter = 0
-        self._connection.send_command('radar', {})
-        self._connection.send_command('wait', {'seconds': '1'})
-        self._connection.send_command('radar', {})
-        self._connection.send_command('wait', {'seconds': '1'})
-        self._connection.send_command('fan', {'speed': '0'})
-        self._connection.send_command('watertank', {'speed': '0'})
-        self._connection.send_command('clean', {})
-        self._connection.send_command('waitState', {'state': 'cleaning'})
-        self._connection.send_command('wait', {'seconds': '4'})
-        self._connection.send_command('stop', {})
-        self._connection.send_command('wait', {'seconds': '1'})
-        self._connection.send_command('fan', {'speed': self._persistentData[self._identifier]['fan']})
-        self._connection.send_command('watertank', {'speed': self._persistentData[self._identifier]['water']})
-        self._connection.send_command('waitState', {'state': 'stopped'})
-        self._connection.send_command('return', {})
-        self._connection.send_command('waitState', {'state': 'home'})
-        #self._connection.send_command('closeConnection', {})
+        self._connection.send_script([
+            ('radar', {}),
+            ('wait', {'seconds': '1'}),
+            ('radar', {}),
+            ('wait', {'seconds': '1'}),
+            ('fan', {'speed': '0'}),
+            ('watertank', {'speed': '0'}),
+            ('clean', {}),
+            ('waitState', {'state': 'cleaning'}),
+            ('wait', {'seconds': '4'}),
+            ('stop', {}),
+            ('wait', {'seconds': '1'}),
+            ('fan', {'speed': self._getPersistentString('fan')}),
+            ('watertank', {'speed': self._getPersistentString('water')}),
+            ('waitState', {'state': 'stopped'}),
+            ('return', {}),
+            ('waitState', {'state': 'home'}),
+            #('closeConnection', {}),
+        ])
 
     def httpDataUpdate(self, data):
-        for key in data:
-            if key not in self._notecmdKeys:
-                continue
-            self._notecmdValues[key] = data[key]
+        self._update_values(data)
 
 
 if running_in_docker:
@@ -382,4 +599,5 @@ else:
     configPath = os.path.join(os.getenv("HOME"), ".config", "congaserver")
     os.makedirs(configPath, exist_ok=True)
 
-robot_manager = RobotManager(configPath)
+persistent_store.configure("ini", configPath)
+robot_manager = RobotManager()
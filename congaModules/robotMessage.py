@@ -0,0 +1,67 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import logging
+
+from .jsonBackend import json_backend
+
+# kinds of packets sent by the robots
+PING = "ping"
+IDENTIFICATION = "identification"
+STATUS = "status"
+ACK = "ack"
+MAP = "map"
+ERROR = "error"
+UNKNOWN = "unknown"
+
+
+class RobotMessage(object):
+    """ A packet received from a robot. The JSON payload is decoded only
+        once, the first time it is needed, and the same objects are shared
+        by everyone that processes the message, so they must not modify it """
+
+    __slots__ = ('kind', 'header', 'payload', '_data', '_decoded')
+
+    def __init__(self, kind, header, payload):
+        self.kind = kind
+        self.header = header
+        self.payload = payload
+        self._data = None
+        self._decoded = False
+
+    @property
+    def packet_id(self):
+        return self.header[3]
+
+    @property
+    def data(self):
+        """ The decoded payload, or None if it is empty or isn't valid JSON """
+        if not self._decoded:
+            self._decoded = True
+            if len(self.payload) != 0:
+                try:
+                    self._data = json_backend.loads(self.payload)
+                except ValueError:
+                    logging.error("Payload of %s packet is not a JSON file: %s", self.kind, self.payload)
+        return self._data
+
+    @property
+    def value(self):
+        """ The 'value' entry of the payload, or None if there isn't one """
+        data = self.data
+        if isinstance(data, dict):
+            return data.get('value')
+        return None
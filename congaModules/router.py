@@ -0,0 +1,145 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+from urllib.parse import unquote
+
+# Routes are defined with a dictionary, where each key is a path pattern and
+# the value is the handler. A pattern can be:
+#
+#   '/robot/list'                 an exact path
+#   '/robot/{robotId}/{action}'   a path with parameters; each one matches a
+#                                 whole, non-empty segment, and is passed to
+#                                 the handler as a keyword argument
+#   '/robot/*'                    a prefix; it matches any path with more
+#                                 segments. If several prefixes match, the
+#                                 longest one is used
+#
+# A pattern can be preceded by the accepted HTTP methods, like 'GET /robot/list'
+# or 'GET,POST /robot/{robotId}/{action}'; without them, any method is accepted.
+# Exact paths have precedence over parameters, and both over prefixes.
+
+
+class _RouteNode(object):
+    __slots__ = ('children', 'param_name', 'param_child', 'handlers', 'wildcard')
+
+    def __init__(self):
+        self.children = {}
+        self.param_name = None
+        self.param_child = None
+        self.handlers = None
+        self.wildcard = None
+
+
+class Router(object):
+    """ Maps paths and methods into handlers. The routes are compiled once into
+        a dictionary for the exact paths and a tree of segments for the rest """
+
+    def __init__(self, routes = None):
+        super().__init__()
+        self._static = {}
+        self._root = _RouteNode()
+        if routes is not None:
+            for pattern in routes:
+                self.add_route(pattern, routes[pattern])
+
+    def add_route(self, pattern, handler):
+        methods = [None]
+        pos = pattern.find(' ')
+        if pos != -1:
+            methods = [method.strip().upper() for method in pattern[:pos].split(',')]
+            pattern = pattern[pos+1:].strip()
+        if (len(pattern) == 0) or (pattern[0] != '/'):
+            raise ValueError(f"Route {pattern} must start with '/'")
+
+        segments = pattern.split('/')[1:]
+        if ('*' not in pattern) and ('{' not in pattern):
+            handlers = self._static.setdefault(pattern, {})
+            for method in methods:
+                handlers[method] = handler
+            return
+
+        node = self._root
+        for index, segment in enumerate(segments):
+            if segment == '*':
+                if index != len(segments) - 1:
+                    raise ValueError(f"Route {pattern}: '*' must be the last segment")
+                if node.wildcard is None:
+                    node.wildcard = {}
+                for method in methods:
+                    node.wildcard[method] = handler
+                return
+            if '*' in segment:
+                raise ValueError(f"Route {pattern}: '*' must be a whole segment")
+            if (len(segment) > 2) and (segment[0] == '{') and (segment[-1] == '}'):
+                name = segment[1:-1]
+                if node.param_child is None:
+                    node.param_name = name
+                    node.param_child = _RouteNode()
+                elif node.param_name != name:
+                    raise ValueError(f"Route {pattern}: parameter {name} conflicts with {node.param_name}")
+                node = node.param_child
+            else:
+                node = node.children.setdefault(segment, _RouteNode())
+        if node.handlers is None:
+            node.handlers = {}
+        for method in methods:
+            node.handlers[method] = handler
+
+    def resolve(self, method, path):
+        """ Returns a tuple (handler, parameters, allowed_methods). If no route
+            matches the path, handler and allowed_methods are None; if a route
+            matches but not for that method, only handler is None """
+        handlers = self._static.get(path)
+        params = {}
+        if handlers is None:
+            best = [-1, None, None]
+            result = self._search(self._root, path.split('/')[1:], 0, {}, best)
+            if result is not None:
+                handlers, params = result
+            elif best[1] is not None:
+                handlers = best[1]
+                params = best[2]
+            else:
+                return None, None, None
+        handler = handlers.get(method)
+        if handler is None:
+            handler = handlers.get(None)
+        if handler is None:
+            return None, None, sorted(handlers)
+        return handler, params, None
+
+    def _search(self, node, segments, index, params, best):
+        if (node.wildcard is not None) and (len(segments) > index) and (index > best[0]):
+            best[0] = index
+            best[1] = node.wildcard
+            best[2] = dict(params)
+        if index == len(segments):
+            if node.handlers is None:
+                return None
+            return node.handlers, dict(params)
+        segment = segments[index]
+        child = node.children.get(segment)
+        if child is not None:
+            result = self._search(child, segments, index + 1, params, best)
+            if result is not None:
+                return result
+        if (node.param_child is not None) and (len(segment) != 0):
+            params[node.param_name] = unquote(segment)
+            result = self._search(node.param_child, segments, index + 1, params, best)
+            del params[node.param_name]
+            if result is not None:
+                return result
+        return None
@@ -0,0 +1,220 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import email.utils
+import gzip
+import logging
+import mimetypes
+import os
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIME_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.htm': 'text/html; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.json': 'application/json',
+    '.svg': 'image/svg+xml',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.ico': 'image/x-icon',
+    '.txt': 'text/plain; charset=utf-8',
+}
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+# files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 256
+
+
+class StaticFile(object):
+    """ A file from the static folder, with its compressed variants """
+
+    def __init__(self, path, stat, data):
+        super().__init__()
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.last_check = time.monotonic()
+        self.mimetype = get_mimetype(path)
+        self.last_modified = email.utils.formatdate(stat.st_mtime, usegmt = True)
+        self.etag = f"{self.mtime_ns:x}-{self.size:x}"
+        self.variants = {None: data}
+        if (len(data) >= MIN_COMPRESS_SIZE) and self.mimetype.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(data, 9, mtime = 0)
+            if len(compressed) < len(data):
+                self.variants['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data)
+                if len(compressed) < len(data):
+                    self.variants['br'] = compressed
+
+    def is_modified(self, stat):
+        return (stat.st_mtime_ns != self.mtime_ns) or (stat.st_size != self.size)
+
+
+def get_mimetype(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in MIME_TYPES:
+        return MIME_TYPES[extension]
+    mimetype, encoding = mimetypes.guess_type(path)
+    if mimetype is None:
+        return 'application/octet-stream'
+    return mimetype
+
+
+def parse_accept_encoding(header):
+    """ Returns the set of encodings accepted by the client """
+    accepted = set()
+    if header is None:
+        return accepted
+    for entry in header.split(','):
+        parts = entry.strip().split(';')
+        encoding = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(encoding)
+    return accepted
+
+
+class StaticFiles(object):
+    """ Serves the files in a folder, keeping them in memory (together with a
+        gzip version, and a brotli one if the module is available). Each entry
+        is checked against the file modification time at most once every
+        check_interval seconds, and reloaded if it changed """
+
+    def __init__(self, root, check_interval = 2, cache_control = "no-cache"):
+        super().__init__()
+        self._root = os.path.realpath(root)
+        self._check_interval = check_interval
+        self._cache_control = cache_control
+        self._files = {}
+
+    def preload(self):
+        """ Loads all the files in the folder """
+        for folder, dirs, files in os.walk(self._root):
+            for filename in files:
+                path = os.path.join(folder, filename)
+                try:
+                    self._load(path, os.stat(path))
+                except OSError as e:
+                    logging.error(f"Can't read static file {path}: {e}")
+        logging.info(f"Loaded {len(self._files)} static files from {self._root}")
+
+    def get_path(self, uri_path):
+        """ Translates the path of an URI into a file path inside the folder,
+            or None if it points outside """
+        path = uri_path
+        while (path != '') and ((path[0] == '/') or (path[0] == '.')):
+            path = path[1:]
+        if path == "":
+            path = "index.html"
+        path = os.path.normpath(os.path.join(self._root, path))
+        if (path != self._root) and (not path.startswith(self._root + os.sep)):
+            return None
+        return path
+
+    def get_file(self, path):
+        """ Returns the StaticFile for path, or None if it doesn't exist.
+            Raises OSError if it can't be read """
+        entry = self._files.get(path)
+        now = time.monotonic()
+        if (entry is not None) and (now - entry.last_check < self._check_interval):
+            return entry
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._files.pop(path, None)
+            return None
+        if not os.path.isfile(path):
+            return None
+        if (entry is not None) and (not entry.is_modified(stat)):
+            entry.last_check = now
+            return entry
+        return self._load(path, stat)
+
+    def _load(self, path, stat):
+        with open(path, "rb") as page:
+            data = page.read()
+        entry = StaticFile(path, stat, data)
+        self._files[path] = entry
+        return entry
+
+    def serve(self, connection):
+        """ Sends the file requested in the connection """
+        path = self.get_path(connection.get_path())
+        try:
+            entry = None if path is None else self.get_file(path)
+        except OSError:
+            logging.error(f"Error reading the file {path}")
+            connection.send_answer('<html><head></head><body><h1>401 Error while reading the file</h1><p>There was an error while trying to read that file</p></body></html>', 401, "Error reading file")
+            connection.close()
+            return
+        if entry is None:
+            connection.send_answer('<html><head></head><body><h1>404 File not found</h1></body></html>', 404, "File not found")
+            connection.close()
+            return
+
+        accepted = parse_accept_encoding(connection.get_header('Accept-Encoding'))
+        encoding = None
+        for candidate in ('br', 'gzip'):
+            if (candidate in accepted) and (candidate in entry.variants):
+                encoding = candidate
+                break
+        etag = f'"{entry.etag}-{encoding}"' if encoding is not None else f'"{entry.etag}"'
+
+        if len(entry.variants) > 1:
+            connection.add_header("Vary", "Accept-Encoding")
+        connection.add_header("Last-Modified", entry.last_modified)
+        connection.add_header("ETag", etag)
+        connection.add_header("Cache-Control", self._cache_control)
+        if self._not_modified(connection, entry, etag):
+            connection.send_answer(b"", 304, "Not Modified")
+            connection.close()
+            return
+        connection.add_header("Content-Type", entry.mimetype)
+        if encoding is not None:
+            connection.add_header("Content-Encoding", encoding)
+        connection.send_answer(entry.variants[encoding], 200, "OK")
+        connection.close()
+
+    def _not_modified(self, connection, entry, etag):
+        client_etags = connection.get_header('If-None-Match')
+        if client_etags is not None:
+            client_etags = [tag.strip() for tag in client_etags.split(',')]
+            return (etag in client_etags) or ('*' in client_etags)
+        since = connection.get_header('If-Modified-Since')
+        if since is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(entry.mtime_ns // 1000000000) <= since
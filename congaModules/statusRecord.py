@@ -0,0 +1,135 @@
+# Copyright 2020 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of OpenDoñita
+#
+# OpenDoñita is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# OpenDoñita is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import json
+
+# the entries of the status of a robot, in the order they are sent to the clients
+STATUS_KEYS = ('workState', 'workMode', 'fan', 'direction', 'brush', 'battery', 'voice', 'error', 'standbyMode',
+               'waterTank', 'clearComponent', 'waterMark', 'version', 'attract', 'deviceIp', 'devicePort',
+               'cleanGoon', 'clearArea', 'clearTime', 'clearSign', 'clearModule', 'isFinish', 'chargerPos',
+               'map', 'track', 'errorCode', 'doTime',
+               'appKey', 'deviceType', 'authCode', 'funDefine', 'nonce_str', 'sign')
+
+STATUS_KEY_SET = frozenset(STATUS_KEYS)
+
+# entries that contain a number; get_int returns them already parsed
+NUMERIC_KEYS = frozenset(('workState', 'workMode', 'fan', 'direction', 'brush', 'battery', 'voice', 'error',
+                          'standbyMode', 'waterTank', 'errorCode', 'clearArea', 'clearTime'))
+
+# entries too big to be sent in every status delta; they are only sent when asked for explicitly
+LARGE_KEYS = frozenset(('map', 'track'))
+
+
+class StatusRecord(object):
+    """ The status of a robot. Each entry is stored in a slot, with the value
+        sent by the robot (usually a string); the numeric entries are also
+        parsed once, when they change.
+
+        revision changes on every change, and the JSON forms of the status are
+        cached until the next one. The revisions come from a counter shared by
+        all the records (last_revision), so a single revision tells what
+        changed in any of them. The revision of the last change of each entry
+        is kept too, so the entries changed after any revision can be obtained """
+
+    __slots__ = STATUS_KEYS + ('revision', '_first_revision', '_numbers', '_changed', '_json', '_compact_json')
+
+    # the last revision given to any record
+    last_revision = 0
+
+    def __init__(self):
+        for key in STATUS_KEYS:
+            setattr(self, key, '')
+        StatusRecord.last_revision += 1
+        self.revision = StatusRecord.last_revision
+        # the changes before this one aren't known
+        self._first_revision = self.revision
+        self._numbers = {}
+        self._changed = {}
+        self._json = None
+        self._compact_json = None
+
+    def get(self, key, default = None):
+        if key not in STATUS_KEY_SET:
+            return default
+        return getattr(self, key)
+
+    def get_int(self, key, default = None):
+        """ Returns the value of a numeric entry, or default if it isn't a number """
+        return self._numbers.get(key, default)
+
+    def update(self, values):
+        """ Stores the known entries of values, and returns a dictionary with the ones that changed """
+        changes = {}
+        for key in STATUS_KEY_SET.intersection(values):
+            value = values[key]
+            if getattr(self, key) == value:
+                continue
+            setattr(self, key, value)
+            changes[key] = value
+            if key in NUMERIC_KEYS:
+                try:
+                    self._numbers[key] = int(value)
+                except (TypeError, ValueError):
+                    self._numbers.pop(key, None)
+        if len(changes) != 0:
+            self._mark_changed(changes)
+        return changes
+
+    def reset(self):
+        """ Empties all the entries, and returns a dictionary with the ones that changed """
+        changes = {key: '' for key in STATUS_KEYS if getattr(self, key) != ''}
+        for key in changes:
+            setattr(self, key, '')
+        self._numbers.clear()
+        self._mark_changed(changes)
+        return changes
+
+    def touch(self):
+        """ Marks the status as changed """
+        StatusRecord.last_revision += 1
+        self.revision = StatusRecord.last_revision
+        self._json = None
+        self._compact_json = None
+
+    def _mark_changed(self, keys):
+        self.touch()
+        for key in keys:
+            self._changed[key] = self.revision
+
+    def changed_since(self, revision, keys = None):
+        """ Returns a dictionary with the entries changed after revision (only
+            those in keys, if it isn't None), or None if revision is a future one
+            or older than the record """
+        if (revision > StatusRecord.last_revision) or (revision < self._first_revision):
+            return None
+        changed = self._changed
+        return {key: getattr(self, key) for key in (STATUS_KEYS if keys is None else keys)
+                if changed.get(key, 0) > revision}
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in STATUS_KEYS}
+
+    def to_json(self):
+        if self._json is None:
+            self._json = json.dumps(self.as_dict())
+        return self._json
+
+    def to_compact_json(self):
+        """ Like to_json, but without the empty entries and the spaces """
+        if self._compact_json is None:
+            data = {key: value for key in STATUS_KEYS if (value := getattr(self, key)) != ''}
+            self._compact_json = json.dumps(data, separators = (',', ':'))
+        return self._compact_json
@@ -17,16 +17,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 import random
-import os
+import signal
 import logging
 import asyncio
-import traceback
+import inspect
+import json
+import time
 
 from init import port_bona, port_http, running_in_docker, html_path
+from init import render_mode, render_workers, png_compress_level, png_optimize, robot_transport
+from init import packet_trace_robots, packet_trace_file, json_backend_name
+from init import ack_timeout, ack_retries, command_window, map_refresh_rate
+from init import persistence_backend, persistence_delay, robot_cache_size
 
 from congaModules.robotManager import robot_manager
 from congaModules.httpClasses import http_server
 from congaModules.robotClasses import robot_server
+from congaModules.renderPool import render_pool
+from congaModules.eventStream import RobotStatusStream
+from congaModules.staticFiles import StaticFiles
+from congaModules.packetTrace import packet_trace
+from congaModules.jsonBackend import json_backend
+from congaModules.mapRefresh import map_refresh_limiter
+from congaModules.persistence import persistent_store
+from congaModules.metrics import metrics
 
 # Errors:
 #
@@ -39,23 +53,42 @@ from congaModules.robotClasses import robot_server
 # 6: Missing parameter
 # 7: Invalid value (out of range, or similar)
 # 8: Key doesn't exist in persistent data
+# 9: Timeout waiting for the robot
+# 10: Command cancelled
 
+# seconds to wait for the answer of a robot when waitAck=1
+COMMAND_TIMEOUT = 10
 
-def robot_clear_time(server_object):
+
+def get_negotiating_robot(server_object):
+    """ Returns the robot that sent the request, or None (after answering
+        with an error) if it didn't send a valid identifier """
     server_object.convert_data()
     data = server_object.get_data()
-    robot = robot_manager.get_robot(data['deviceId'])
-    robot.httpDataUpdate(data)
+    device_id = data.get('deviceId') if isinstance(data, dict) else None
+    if (not isinstance(device_id, str)) or (device_id == ''):
+        server_object.add_header("Content-Type", "application/json")
+        server_object.send_answer('{"error":1, "value":"Missing robot ID"}', 400, "MISSING_ROBOT_ID")
+        server_object.close()
+        return None
+    return robot_manager.get_robot(device_id)
+
+
+def robot_clear_time(server_object):
+    robot = get_negotiating_robot(server_object)
+    if robot is None:
+        return
+    robot.httpDataUpdate(server_object.get_data())
     send_robot_header(server_object)
     server_object.send_chunked('{"msg":"ok","result":"0","version":"1.0.0"}')
     server_object.close()
 
 
 def robot_get_token(server_object):
-    server_object.convert_data()
-
+    robot = get_negotiating_robot(server_object)
+    if robot is None:
+        return
     data = server_object.get_data()
-    robot = robot_manager.get_robot(data['deviceId'])
     robot.httpDataUpdate(data)
     robot_data = {}
     robot_data['appKey'] = data['appKey']
@@ -90,41 +123,106 @@ def send_robot_header(server_object):
     server_object.add_header('Set-Cookie', 'SERVERID=2423aa26fbdf3112bc4aa0453e825ac8|1592686775|1592686775;Path=/')
 
 
-def robot_action(server_object):
-    robots = robot_manager.get_robot_list()
-    uri = server_object.get_path()
-    error = None
-    if uri.startswith('/robot/'):
-        action = uri[7:]
-        pos = action.find('/')
-        if pos == -1:
-            server_object.add_header("Content-Type", "application/json")
-            server_object.send_answer('{"error":1, "value":"Missing robot ID"}', 400, "MISSING_ROBOT_ID")
+def robot_missing_id(server_object):
+    server_object.add_header("Content-Type", "application/json")
+    server_object.send_answer('{"error":1, "value":"Missing robot ID"}', 400, "MISSING_ROBOT_ID")
+    server_object.close()
+
+
+def robot_unknown_command(server_object, robotId):
+    server_object.add_header("Content-Type", "application/json")
+    server_object.send_answer('{"error":5, "value":"Unknown command"}', 200, "")
+    server_object.close()
+
+
+def _get_command_options(params):
+    """ Removes from the parameters the ones used by the server itself, and returns
+        (wait for ACK, timeout), or raises ValueError if the timeout is not valid """
+    wait_ack = params.pop('waitAck', '0') == '1'
+    timeout = float(params.pop('timeout', COMMAND_TIMEOUT))
+    if timeout <= 0:
+        raise ValueError("timeout must be positive")
+    return wait_ack, timeout
+
+
+async def _run_command(robot, action, params, wait_ack, timeout):
+    """ Sends a command to a robot and waits for the answer, if needed.
+        Returns (content type, error, answer) """
+    try:
+        dtype, error, answer = robot.send_command(action, params, wait_ack)
+        if inspect.isawaitable(answer):
+            answer = await asyncio.wait_for(asyncio.shield(answer), timeout)
+            if isinstance(answer, tuple):
+                error, answer = answer
+    except asyncio.TimeoutError:
+        return "application/json", 9, '"Timeout waiting for the robot"'
+    return dtype, error, answer
+
+
+async def robot_broadcast(server_object, action, params, wait_ack, timeout):
+    """ Sends the command to several robots at the same time, and returns the answer
+        of each one. By default the command is sent to all the robots; the robots
+        parameter accepts a comma-separated list of robot identifiers """
+    robot_ids = params.pop('robots', None)
+    if robot_ids is None:
+        robot_ids = robot_manager.get_connected_list()
+    else:
+        robot_ids = [robot_id for robot_id in robot_ids.split(',') if robot_id != '']
+
+    async def run(robot_id):
+        start = time.perf_counter()
+        robot = robot_manager.find_robot(robot_id)
+        if robot is None:
+            dtype, error, answer = "application/json", 2, '"Invalid robot ID"'
+        else:
+            dtype, error, answer = await _run_command(robot, action, dict(params), wait_ack, timeout)
+        if (dtype != "application/json") or (answer is None):
+            answer = 'null'
+        elapsed = (time.perf_counter() - start) * 1000
+        return f'{json.dumps(robot_id)}:{{"error":{error}, "value":{answer}, "time":{elapsed:.1f}}}'
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[run(robot_id) for robot_id in robot_ids])
+    elapsed = (time.perf_counter() - start) * 1000
+    server_object.add_header("Content-Type", "application/json")
+    server_object.send_answer('{"error":0, "value":{"robots":{' + ','.join(results) + f'}}, "time":{elapsed:.1f}}}}}', 200, "")
+    server_object.close()
+
+
+async def robot_action(server_object, robotId, action):
+    params = server_object.get_params()
+    try:
+        wait_ack, timeout = _get_command_options(params)
+    except ValueError:
+        server_object.add_header("Content-Type", "application/json")
+        server_object.send_answer('{"error":7, "value":"Invalid value for timeout"}', 200, "")
+        server_object.close()
+        return
+    if robotId == "all":
+        await robot_broadcast(server_object, action, params, wait_ack, timeout)
+        return
+    robot = robot_manager.find_robot(robotId)
+    if robot is None:
+        server_object.add_header("Content-Type", "application/json")
+        server_object.send_answer('{"error":2, "value":"Invalid robot ID"}', 400, "INVALID_ROBOT_ID")
+        server_object.close()
+        return
+    if action == 'getMap':
+        robot.watch_map()
+        etag = robot.get_map_etag(params)
+        if (etag is not None) and server_object.check_etag(etag):
             server_object.close()
             return
-        robotId = action[:pos]
-        action = action[pos+1:]
-        if robotId == "all":
-            for robot_id in robots:
-                robot = robot_manager.get_robot(robot_id)
-                print(f"Pido {action}")
-                try:
-                    dtype, error, answer = robot.send_command(action, server_object.get_params())
-                except:
-                    traceback.print_exc()
-        else:
-            if robotId in robots:
-                robot = robot_manager.get_robot(robotId)
-                dtype, error, answer = robot.send_command(action, server_object.get_params())
-            else:
-                server_object.add_header("Content-Type", "application/json")
-                server_object.send_answer('{"error":2, "value":"Invalid robot ID"}', 400, "INVALID_ROBOT_ID")
-                server_object.close()
-                return
+    elif action == 'getStatus':
+        etag = robot.get_status_etag()
+        if (etag is not None) and server_object.check_etag(etag):
+            server_object.close()
+            return
+    dtype, error, answer = await _run_command(robot, action, params, wait_ack, timeout)
     if (error is None) or (answer is None):
         answer = '{}'
         error = 0
-        dtype = "Content-Type", "application/json"
+        dtype = "application/json"
     server_object.add_header("Content-Type", dtype)
     if (dtype == "application/json"):
         server_object.send_answer('{"error":' + str(error) + ', "value":'+answer+'}', 200, "")
@@ -133,70 +231,110 @@ def robot_action(server_object):
     server_object.close()
 
 
-def robot_list(server_object):
-    robots = robot_manager.get_robot_list()
-    data = []
-    for robot_id in robots:
-        data.append(robot_id)
-    server_object.send_answer_json_close(data)
+def robot_events(server_object, robotId):
+    """ Keeps the connection open, sending the status changes of the robot (or of all the robots) """
+    if robotId == "all":
+        robotId = None
+    elif robot_manager.find_robot(robotId) is None:
+        server_object.add_header("Content-Type", "application/json")
+        server_object.send_answer('{"error":2, "value":"Invalid robot ID"}', 400, "INVALID_ROBOT_ID")
+        server_object.close()
+        return
+    last_event_id = server_object.get_header('Last-Event-ID')
+    if last_event_id is None:
+        last_event_id = server_object.get_params().get('lastEventId')
+    stream = RobotStatusStream(server_object, robot_manager, robotId)
+    stream.start(last_event_id)
 
 
-def html_server(server_object):
+def robot_list(server_object):
+    """ Returns the identifiers of the robots. They can be filtered by connection
+        state, IP, work state and error code, and paginated with offset and limit """
+    params = server_object.get_params()
+    filters = {}
+    for name in ('ip', 'state', 'error'):
+        if name in params:
+            filters[name] = params[name]
+    connected = params.get('connected')
+    if connected is not None:
+        connected = connected == '1'
+    try:
+        offset = int(params.get('offset', 0))
+        limit = params.get('limit')
+        if limit is not None:
+            limit = int(limit)
+        if (offset < 0) or ((limit is not None) and (limit < 0)):
+            raise ValueError()
+    except ValueError:
+        server_object.add_header("Content-Type", "application/json")
+        server_object.send_answer('{"error":7, "value":"Invalid value for offset or limit"}', 200, "")
+        server_object.close()
+        return
+    server_object.send_answer_json_close(robot_manager.query(connected, offset, limit, **filters))
 
-    path = server_object.get_path()
-    while (path != '') and ((path[0] == '/') or (path[0] == '.')):
-        path = path[1:]
-    if path == "":
-        path = "index.html"
-    path = os.path.join(html_path, path)
-    print(f"Reading file {path}")
-    if os.path.exists(path):
-        try:
-            with open(path, "r") as page:
-                data = page.read()
-            if path.endswith(".js"):
-                mimetype = "application/javascript"
-            elif path.endswith(".html"):
-                mimetype = "text/html"
-            elif path.endswith(".svg"):
-                mimetype = "image/svg+xml"
-            elif path.endswith(".css"):
-                mimetype = "text/css"
-            else:
-                mimetype = None
-            if mimetype is not None:
-                server_object.add_header("Content-Type", mimetype)
-            server_object.send_answer(data, 200, "OK")
-        except:
-            print("Error 401")
-            server_object.send_answer('<html><head></head><body><h1>401 Error while reading the file</h1><p>There was an error while trying to read that file</p></body></html>', 401, "Error reading file")
-    else:
-        print("Error 404")
-        server_object.send_answer('<html><head></head><body><h1>404 File not found</h1></body></html>', 404, "File not found")
+
+def metrics_page(server_object):
+    """ Returns the metrics in the Prometheus text format """
+    server_object.add_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+    server_object.add_header("Cache-Control", "no-store")
+    server_object.send_answer(metrics.render(), 200, "OK")
     server_object.close()
 
 
+def html_server(server_object):
+    static_files.serve(server_object)
+
+
+# see congaModules/router.py for the format of the routes
 registered_pages = {
     '/baole-web/common/sumbitClearTime.do': robot_clear_time,
     '/baole-web/common/getToken.do': robot_get_token,
     '/baole-web/common/*': robot_global,
-    '/robot/list': robot_list,
-    '/robot/*': robot_action,
+    'GET /robot/list': robot_list,
+    'GET /robot/{robotId}/events': robot_events,
+    '/robot/{robotId}/{action}': robot_action,
+    '/robot/{robotId}/*': robot_unknown_command,
+    '/robot/*': robot_missing_id,
+    'GET /metrics': metrics_page,
     '/*': html_server
 }
 
+static_files = StaticFiles(html_path)
+static_files.preload()
+
 loop = asyncio.new_event_loop()  # asyncio.get_event_loop()
 
+render_pool.configure(render_mode, render_workers, png_compress_level, png_optimize)
+packet_trace.configure(packet_trace_file, packet_trace_robots)
+json_backend.configure(json_backend_name)
+map_refresh_limiter.configure(map_refresh_rate)
+persistent_store.configure(persistence_backend, delay = persistence_delay)
+robot_manager.configure(robot_cache_size)
+metrics.add_gauge("conga_robots_connected", "Robots connected to the server", lambda: len(robot_manager.get_connected_list()))
+metrics.add_gauge("conga_robots_known", "Robots known by the server", lambda: len(robot_manager.get_robot_list()))
+metrics.start(loop)
+
 http_server.configure(registered_pages, loop, port_http)
 logging.info("HTTP server started on port " + str(port_http))
-robot_server.configure(loop, port_bona)
+robot_server.configure_commands(ack_timeout, ack_retries, command_window)
+robot_server.configure(loop, port_bona, transport = robot_transport)
 logging.info("Robot server started on port " + str(port_bona))
 
+try:
+    # shut down cleanly (writing the pending properties) when stopped with SIGTERM too
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+except NotImplementedError:
+    pass
+
 try:
     loop.run_forever()
 except:
     pass
 
+metrics.stop()
 robot_server.close()
 http_server.close()
+render_pool.close()
+packet_trace.close()
+persistent_store.close()
 loop.close()
@@ -1,5 +1,8 @@
 var powerWater;
 
+// the status entries used by the app, when polling the status
+const STATUS_FIELDS = "workState,battery,voice,map,track,chargerPos";
+
 $(document).ready(function(){
     powerWater = new PowerWater();
 });
@@ -19,7 +22,7 @@ class PowerWater {
         this._allowStop = false;
         this._audio = true;
         this._counter = 0;
-        this._robot = "all";
+        this._robot = null;
         this._modes = ["auto", "gyro", "random", "borders", "area", "x2", "scrub"];
         this._last_map = "";
         this._last_track = "";
@@ -127,12 +130,12 @@ class PowerWater {
             } else {
                 var status = 1;
             }
-            this._send_command(`robot/all/sound?status=${status}`);
+            this._send_command(`robot/${this._robot}/sound?status=${status}`);
         });
 
         $("#radar").click(() => {
             console.log("Pulsado");
-            this._send_command(`robot/all/radar`);
+            this._send_command(`robot/${this._robot}/radar`);
         });
 
         $("#back").click(() => {
@@ -162,11 +165,63 @@ class PowerWater {
         });
 
         this._set_sizes();
-        this._read_defaults();
+        this._select_robot(() => {
+            this._read_defaults();
+            this._send_command(`robot/${this._robot}/updateMap`);
+            this._send_command(`robot/${this._robot}/notifyConnection`);
+            this._send_command(`robot/${this._robot}/askStatus`);
+            this._start_status_stream();
+        });
+    }
+
+    _select_robot(cb) {
+        // the page controls a single robot: the first one connected to the server
+        this._send_command(`robot/list?connected=1`, (received) => {
+            if ((received['error'] != 0) || (received['value'].length == 0)) {
+                $('#noconga').css('z-index', 10);
+                setTimeout(this._select_robot.bind(this, cb), 1000);
+                return;
+            }
+            this._robot = received['value'][0];
+            cb();
+        });
+    }
+
+    _start_status_stream() {
+        if (!window.EventSource) {
+            this._start_status_polling();
+            return;
+        }
+        this._status = {};
+        this._robots_connected = {};
+        let events = new EventSource(`robot/${this._robot}/events`);
+        events.addEventListener('status', (event) => {
+            let data = JSON.parse(event.data);
+            for (let key in data['values']) {
+                this._status[key] = data['values'][key];
+            }
+            this._robots_connected[data['robot']] = data['connected'];
+            let connected = false;
+            for (let robot in this._robots_connected) {
+                connected = connected || this._robots_connected[robot];
+            }
+            this._process_status({'error': connected ? 0 : 3, 'value': this._status});
+        });
+        events.addEventListener('norobots', () => {
+            $('#noconga').css('z-index', 10);
+        });
+        events.onerror = () => {
+            // the browser retries by itself after network errors, but not if the server doesn't support events
+            if (events.readyState == EventSource.CLOSED) {
+                this._start_status_polling();
+            }
+        };
+    }
+
+    _start_status_polling() {
+        this._status = {};
+        this._status_version = '0';
         this._update_status();
-        this._send_command(`robot/${this._robot}/updateMap`);
-        this._send_command(`robot/${this._robot}/notifyConnection`);
-        this._send_command(`robot/${this._robot}/askStatus`);
         setInterval(this._update_status.bind(this), 1000);
     }
 
@@ -280,66 +335,80 @@ class PowerWater {
     }
 
     _read_status() {
-        this._send_command(`robot/${this._robot}/getStatus`, (received) => {
-            if (received['error'] != 0) {
-                $('#noconga').css('z-index', 10);
-                return;
-            }
-            $('#noconga').css('z-index', 0);
-            console.log(received['value']['battery']);
-            document.getElementById("battery_text_level").innerHTML = `${received['value']['battery']}%`;
-            // audio enabled/disabled
-            if (received['value']['voice'] == "2") {
-                this._audio = true;
-            } else {
-                this._audio = false;
-            }
-            this._set_audio();
-
-            // mode
-            let mode = received['value']['workState'];
-            if ((mode == 4) || (mode == 5) || (mode == 6) || (mode == 9) || (mode ==10)) {
-                this._allowHome = false;
-                this._set_src("#home", "home_disabled.svg");
-            } else {
-                this._allowHome = true;
-                this._set_src("#home", "home_enabled.svg");
-            }
-            if ((mode == 2) || (mode == 5) || (mode == 6) || (mode == 10)) {
-                this._allowStart = true;
-            } else {
-                this._allowStart = false;
-            }
-            if ((mode == 1) || (mode == 4) || (mode == 9)) {
-                this._allowStop = true;
-            } else {
-                this._allowStop = false;
-            }
-            if (this._allowStart) {
-                this._set_src("#startstop", "play_enabled.svg");
-            } else {
-                if (this._allowStop) {
-                    this._set_src("#startstop", "stop_enabled.svg");
-                } else {
-                    this._set_src("#startstop", "play_disabled.svg");
+        // only the entries changed since the last call are received; the map and the track must be asked for explicitly
+        this._send_command(`robot/${this._robot}/getStatus?since=${this._status_version}&fields=${STATUS_FIELDS}`, (received) => {
+            if (received['error'] == 0) {
+                if (received['value']['full']) {
+                    this._status = {};
                 }
+                for (let key in received['value']['values']) {
+                    this._status[key] = received['value']['values'][key];
+                }
+                this._status_version = received['value']['version'];
             }
-            if ((mode == 5) || (mode == 10)) {
-                $("#charging").show();
-            } else {
-                $("#charging").hide();
-            }
-            let bat_level = received['value']['battery'];
-            let aspect = $('#battery').width() / $('#battery').height();
-            if (aspect > 1.0) {
-                $("#battery_level").css("width", `${bat_level}%`);
-                $("#battery_level").css("height", "100%");
+            this._process_status({'error': received['error'], 'value': this._status});
+        });
+    }
+
+    _process_status(received) {
+        if (received['error'] != 0) {
+            $('#noconga').css('z-index', 10);
+            return;
+        }
+        $('#noconga').css('z-index', 0);
+        console.log(received['value']['battery']);
+        document.getElementById("battery_text_level").innerHTML = `${received['value']['battery']}%`;
+        // audio enabled/disabled
+        if (received['value']['voice'] == "2") {
+            this._audio = true;
+        } else {
+            this._audio = false;
+        }
+        this._set_audio();
+
+        // mode
+        let mode = received['value']['workState'];
+        if ((mode == 4) || (mode == 5) || (mode == 6) || (mode == 9) || (mode ==10)) {
+            this._allowHome = false;
+            this._set_src("#home", "home_disabled.svg");
+        } else {
+            this._allowHome = true;
+            this._set_src("#home", "home_enabled.svg");
+        }
+        if ((mode == 2) || (mode == 5) || (mode == 6) || (mode == 10)) {
+            this._allowStart = true;
+        } else {
+            this._allowStart = false;
+        }
+        if ((mode == 1) || (mode == 4) || (mode == 9)) {
+            this._allowStop = true;
+        } else {
+            this._allowStop = false;
+        }
+        if (this._allowStart) {
+            this._set_src("#startstop", "play_enabled.svg");
+        } else {
+            if (this._allowStop) {
+                this._set_src("#startstop", "stop_enabled.svg");
             } else {
-                $("#battery_level").css("height", `${bat_level}%`);
-                $("#battery_level").css("width", "100%");
+                this._set_src("#startstop", "play_disabled.svg");
             }
-            this._update_canvas(received);
-        });
+        }
+        if ((mode == 5) || (mode == 10)) {
+            $("#charging").show();
+        } else {
+            $("#charging").hide();
+        }
+        let bat_level = received['value']['battery'];
+        let aspect = $('#battery').width() / $('#battery').height();
+        if (aspect > 1.0) {
+            $("#battery_level").css("width", `${bat_level}%`);
+            $("#battery_level").css("height", "100%");
+        } else {
+            $("#battery_level").css("height", `${bat_level}%`);
+            $("#battery_level").css("width", "100%");
+        }
+        this._update_canvas(received);
     }
 
     _set_sizes() {
@@ -631,7 +700,7 @@ class PowerWater {
         $(name).addClass("powerwater_active");
         if (update) {
             this._store_value('water', xi);
-            this._send_command(`robot/all/watertank?speed=${xi}`);
+            this._send_command(`robot/${this._robot}/watertank?speed=${xi}`);
         }
     }
 
@@ -647,7 +716,7 @@ class PowerWater {
         $(name).addClass("powerwater_active");
         if (update) {
             this._store_value('fan', xi);
-            this._send_command(`robot/all/fan?speed=${xi}`);
+            this._send_command(`robot/${this._robot}/fan?speed=${xi}`);
         }
     }
 
@@ -661,7 +730,7 @@ class PowerWater {
         if (update) {
             this._store_value('mode', xi);
             let mode = this._modes[xi];
-            this._send_command(`robot/all/mode?type=${mode}`);
+            this._send_command(`robot/${this._robot}/mode?type=${mode}`);
         }
     }
 }
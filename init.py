@@ -10,6 +10,39 @@ html_path = os.path.join(launch_path, "html")
 port_http = 80
 port_bona = 20008
 
+# map rendering, configurable through environment variables
+render_mode = os.getenv("CONGA_RENDER_MODE", "thread") # inline, thread or process
+render_workers = int(os.getenv("CONGA_RENDER_WORKERS", "2"))
+png_compress_level = int(os.getenv("CONGA_PNG_COMPRESS_LEVEL", "6"))
+png_optimize = os.getenv("CONGA_PNG_OPTIMIZE", "0") not in ("", "0", "false", "False")
+
+# robot connections: stream (a StreamReader and a task per robot) or protocol (asyncio.Protocol)
+robot_transport = os.getenv("CONGA_ROBOT_TRANSPORT", "stream")
+
+# commands sent to the robots: seconds to wait for each ACK, number of times a command
+# is resent if the ACK doesn't arrive, and number of commands waiting for their ACK at once
+ack_timeout = float(os.getenv("CONGA_ACK_TIMEOUT", "5"))
+ack_retries = int(os.getenv("CONGA_ACK_RETRIES", "1"))
+command_window = int(os.getenv("CONGA_COMMAND_WINDOW", "1"))
+
+# maximum number of map refreshes per second asked to all the robots together (0 for no limit)
+map_refresh_rate = float(os.getenv("CONGA_MAP_REFRESH_RATE", "10"))
+
+# persistent properties of the robots: stored in an ini file per robot ("ini") or in a single
+# SQLite database ("sqlite"), and written this number of seconds after being changed
+persistence_backend = os.getenv("CONGA_PERSISTENCE", "ini")
+persistence_delay = float(os.getenv("CONGA_PERSISTENCE_DELAY", "2"))
+
+# number of disconnected robots kept in memory
+robot_cache_size = int(os.getenv("CONGA_ROBOT_CACHE", "256"))
+
+# JSON library used to decode the robot packets: auto, stdlib or orjson
+json_backend_name = os.getenv("CONGA_JSON_BACKEND", "auto")
+
+# packet trace: a comma-separated list of robot identifiers, or "all"
+packet_trace_robots = os.getenv("CONGA_PACKET_TRACE", "")
+packet_trace_file = os.getenv("CONGA_PACKET_TRACE_FILE", os.path.join(launch_path, "packets.jsonl"))
+
 
 def init_log(log_level: int = logging.INFO):
     log_path = os.path.join(launch_path, "status.log")